@@ -0,0 +1,38 @@
+from django.core.cache import cache
+
+from wyndo.settings import CATALOG_CACHE_TIMEOUT
+
+CATALOG_VERSION_KEY = "catalog:version"
+
+
+class CatalogCache:
+    """
+    Shared results of the catalog sections every visitor sees. Keys embed
+    a catalog version bumped whenever product cards are rebuilt, so stale
+    entries are never read again and expire on their own.
+    """
+
+    @staticmethod
+    def version() -> int:
+        version = cache.get(CATALOG_VERSION_KEY)
+        if version is None:
+            cache.add(CATALOG_VERSION_KEY, 1, None)
+            version = cache.get(CATALOG_VERSION_KEY, 1)
+        return version
+
+    @staticmethod
+    def bump():
+        try:
+            cache.incr(CATALOG_VERSION_KEY)
+        except ValueError:
+            # Never read before, nothing was cached with it yet
+            cache.add(CATALOG_VERSION_KEY, 1, None)
+
+    @classmethod
+    def get_or_set(cls, name: str, builder, timeout: int = CATALOG_CACHE_TIMEOUT):
+        key = f"catalog:{name}:{cls.version()}"
+        result = cache.get(key)
+        if result is None:
+            result = builder()
+            cache.set(key, result, timeout)
+        return result
@@ -1,22 +1,35 @@
 import logging
 import re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 from os import getenv
 
 import requests
 from django.core.files.base import ContentFile
+from django.db import transaction
+from django.utils import timezone
 
-from inventories.models import Product
+from common.pos.repositories import (
+    ProductCardRepository,
+    UpcLookupRepository,
+    VarianImageRepository,
+    VariantRepository,
+)
+from inventories.models import Product, UpcLookup
+from wyndo.settings import GO_UPC_CONCURRENCY, GO_UPC_MISS_RETRY_DAYS
 
 logger = logging.getLogger(__name__)
 
 
 class GoUPC:
+    TIMEOUT = 30
+
     def __init__(self):
         self._api_key = getenv("GO_UPC_KEY", "")
         self._url = getenv("GO_UPC_URL", "")
 
     def get_product_image_from_url(self, url, code):
-        response = requests.get(url)
+        response = requests.get(url, timeout=self.TIMEOUT)
         img_file = None
         img_name = re.split(r"/", url)[-1]
         img_ext = re.split("\.", img_name)
@@ -27,7 +40,7 @@ class GoUPC:
         return img_name, img_file
 
     def create_product(self, code, retailer):
-        response = requests.get(f"{self._url}/{code}?key={self._api_key}")
+        response = requests.get(f"{self._url}/{code}?key={self._api_key}", timeout=self.TIMEOUT)
         if response.status_code != 200:
             raise ValueError("Problem API call go upc")
         data = response.json()
@@ -50,7 +63,7 @@ class GoUPC:
             return {}
 
         headers = {"Authorization": f"Bearer {self._api_key}"}
-        response = requests.get(f"{self._url}/{code}", headers=headers)
+        response = requests.get(f"{self._url}/{code}", headers=headers, timeout=self.TIMEOUT)
 
         if response.status_code != 200:
             logger.error(f"URL: {self._url}")
@@ -60,8 +73,145 @@ class GoUPC:
             logger.error("status_code %s", response.status_code)
             return {}
 
-        print("Success fetching go upc")
-
         data = response.json()
         product = data.get("product")
         return product
+
+    def is_configured(self) -> bool:
+        return bool(self._api_key and self._url)
+
+    def lookup(self, code: str):
+        """
+        Product information for `code`, or None when Go UPC doesn't know it.
+        Any other failure is raised so the code is looked up again later.
+        """
+        headers = {"Authorization": f"Bearer {self._api_key}"}
+        response = requests.get(f"{self._url}/{code}", headers=headers, timeout=self.TIMEOUT)
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.json().get("product") or None
+
+
+class GoUpcEnrichment:
+    """
+    Applies Go UPC descriptions and images to the variants of a retailer
+    whose UPC is new or changed. Results are stored per code, misses
+    included, so a code is only looked up again when a miss is due for a
+    retry. Lookups run GO_UPC_CONCURRENCY at a time.
+    """
+
+    BATCH_SIZE = 100
+    NO_DESCRIPTION = "No description found."
+
+    def __init__(self, retailer_id, client: GoUPC = None):
+        self._retailer_id = retailer_id
+        self._client = client or GoUPC()
+        self._variant_repository = VariantRepository()
+        self._lookup_repository = UpcLookupRepository()
+        self._image_repository = VarianImageRepository()
+
+    def run(self) -> int:
+        """Enrich the pending variants. Returns the number of variants enriched."""
+        if not self._client.is_configured():
+            return 0
+
+        enriched, product_ids, after_id = 0, set(), 0
+        while variants := self._variant_repository.pending_go_upc(
+            self._retailer_id, after_id=after_id, limit=self.BATCH_SIZE
+        ):
+            after_id = variants[-1].id
+            done = self.enrich(variants)
+            enriched += len(done)
+            product_ids.update(variant.product_id for variant in done)
+
+        if product_ids:
+            ProductCardRepository().refresh(
+                retailer_id=self._retailer_id, product_ids=product_ids
+            )
+        return enriched
+
+    def _lookup(self, code: str):
+        try:
+            product = self._client.lookup(code)
+        except Exception as e:
+            logger.error(f"Error fetching Go UPC Information with upc {code}: {e}")
+            return None
+
+        if product is None:
+            return UpcLookup(
+                code=code,
+                found=False,
+                retry_after=timezone.now() + timedelta(days=GO_UPC_MISS_RETRY_DAYS),
+            )
+        description = product.get("description")
+        return UpcLookup(
+            code=code,
+            found=True,
+            description=None if description == self.NO_DESCRIPTION else description,
+            image_url=product.get("imageUrl"),
+        )
+
+    def _download_image(self, lookup: UpcLookup):
+        try:
+            return self._client.get_product_image_from_url(lookup.image_url, lookup.code)
+        except Exception as e:
+            logger.error(f"Error fetching Go UPC Image with upc {lookup.code}: {e}")
+            return None, None
+
+    def _run_concurrently(self, function, values: list) -> list:
+        if not values:
+            return []
+        with ThreadPoolExecutor(max_workers=min(len(values), GO_UPC_CONCURRENCY)) as executor:
+            return list(executor.map(function, values))
+
+    def enrich(self, variants: list) -> list:
+        """
+        Apply the Go UPC result of each variant's `lookup_code`, looking up
+        the codes without a current result. Returns the variants enriched;
+        the ones whose lookup failed are left for the next run.
+        """
+        codes = {variant.lookup_code for variant in variants}
+        lookups = self._lookup_repository.get_current(codes)
+        missing = sorted(codes - set(lookups))
+        fetched = [lookup for lookup in self._run_concurrently(self._lookup, missing) if lookup]
+        lookups.update(self._lookup_repository.bulk_upsert(fetched))
+
+        image_codes = sorted(
+            {
+                variant.lookup_code
+                for variant in variants
+                if variant.lookup_code in lookups and lookups[variant.lookup_code].image_url
+            }
+        )
+        images = dict(
+            zip(
+                image_codes,
+                self._run_concurrently(
+                    self._download_image, [lookups[code] for code in image_codes]
+                ),
+            )
+        )
+
+        done = []
+        with transaction.atomic():
+            for variant in variants:
+                lookup = lookups.get(variant.lookup_code)
+                if lookup is None:
+                    continue
+                if lookup.found and lookup.description:
+                    variant.description = lookup.description
+                image_name, image = images.get(variant.lookup_code, (None, None))
+                if image is not None:
+                    self._image_repository.update_or_create(
+                        {
+                            "variant": variant,
+                            "image": image,
+                            "image_id": f"{image_name}_{variant.id}",
+                        }
+                    )
+                variant.go_upc_code = variant.lookup_code
+                done.append(variant)
+
+            self._variant_repository.bulk_update_go_upc(done)
+        return done
@@ -1,8 +1,13 @@
-import time
-
-from requests import request
-
-from wyndo.settings import CLOVER_URL
+from common.pos.http import SessionPool
+from common.pos.rate_limit import RateLimiter
+from wyndo.settings import (
+    CLOVER_HTTP_BACKOFF_FACTOR,
+    CLOVER_HTTP_MAX_RETRIES,
+    CLOVER_HTTP_POOL_SIZE,
+    CLOVER_HTTP_TIMEOUT,
+    CLOVER_RATE_LIMIT,
+    CLOVER_URL,
+)
 
 
 class CloverRequestClient:
@@ -10,42 +15,36 @@ class CloverRequestClient:
     HEADERS = {
         "Content-Type": "application/json",
     }
+    SESSIONS = SessionPool(
+        pool_size=CLOVER_HTTP_POOL_SIZE,
+        max_retries=CLOVER_HTTP_MAX_RETRIES,
+        backoff_factor=CLOVER_HTTP_BACKOFF_FACTOR,
+    )
+    RATE_LIMITER = RateLimiter("clover", CLOVER_RATE_LIMIT)
 
     def __init__(self, access_token, merchand_id):
         self._merchant_id = merchand_id
         self._access_token = access_token
-        self._call_count = 0
-        self._last_call_timestamp = time.time()
-
-    def _rate_limit_check(self):
-        current_time = time.time()
-        if current_time - self._last_call_timestamp < 1:
-            self._call_count += 1
-            if self._call_count >= 16:
-                sleep_duration = 1 - (current_time - self._last_call_timestamp)
-                time.sleep(sleep_duration)
-                self._call_count = 0
-                self._last_call_timestamp = time.time()
-        else:
-            self._call_count = 1
-            self._last_call_timestamp = current_time
 
     def _request(self, path, method="GET", params={}, json=None):
-        self._rate_limit_check()
+        self.RATE_LIMITER.acquire(self._merchant_id)
 
         headers = self.HEADERS.copy()
         headers["Authorization"] = f"Bearer {self._access_token}"
-        response = request(
+        response = self.SESSIONS.get().request(
             method=method,
             url=f"{self.HOST}/v3/merchants/{path}",
             json=json,
             params=params,
             headers=headers,
+            timeout=CLOVER_HTTP_TIMEOUT,
         )
         response.raise_for_status()
         return response.json()
 
-    def get_items(self, item_id: str = None, limit=100, offset=0):
+    def get_items(
+        self, item_id: str = None, limit=100, offset=0, modified_since: int = None
+    ):
         params = {
             "expand": "tags,categories,taxRates,modifierGroups,itemStock,item",
         }
@@ -55,19 +54,35 @@ class CloverRequestClient:
         if item_id is None:
             params["offset"] = offset
             params["limit"] = limit
+            if modified_since is not None:
+                params["filter"] = f"modifiedTime>={modified_since}"
         else:
             path += f"/{item_id}"
 
         result = self._request(path=path, params=params)
         return result
 
+    def get_items_by_ids(self, item_ids: list):
+        """Fetch up to `limit` items by id in a single request."""
+        ids = ",".join(f"'{item_id}'" for item_id in item_ids)
+        params = {
+            "expand": "tags,categories,taxRates,modifierGroups,itemStock,item",
+            "filter": f"id in ({ids})",
+            "limit": len(item_ids),
+        }
+        return self._request(path=f"{self._merchant_id}/items", params=params)
+
     def get_item_group(self, group_id):
         path = f"{self._merchant_id}/item_groups/{group_id}"
         return self._request(path=path)
 
-    def get_inventory(self, limit: int = 100, offset: int = 0):
+    def get_inventory(
+        self, limit: int = 100, offset: int = 0, modified_since: int = None
+    ):
         try:
-            items = self.get_items(limit=limit, offset=offset)
+            items = self.get_items(
+                limit=limit, offset=offset, modified_since=modified_since
+            )
             if not items:
                 return []
 
@@ -91,9 +106,17 @@ class CloverRequestClient:
         path = f"{self._merchant_id}/orders/{order_id}?expand=lineItems,customer,orderFulfillmentEvent"
         return self._request(path=path)
 
-    def get_orders(self, limit=100, offset=0):
-        path = f"{self._merchant_id}/orders?expand=lineItems,customer,orderFulfillmentEvent"
-        return self._request(path=path)
+    def get_orders(self, limit=100, offset=0, modified_since: int = None):
+        params = {
+            "expand": "lineItems,customer,orderFulfillmentEvent",
+            "limit": limit,
+            "offset": offset,
+        }
+        if modified_since is not None:
+            params["filter"] = f"modifiedTime>={modified_since}"
+
+        path = f"{self._merchant_id}/orders"
+        return self._request(path=path, params=params)
 
     def create_order(self, payload):
         path = f"{self._merchant_id}/atomic_order/orders/"
@@ -156,9 +179,14 @@ class CloverRequestClient:
             json=payload
         )
 
-    def list_customers(self):
-        path = f"{self._merchant_id}/customers?expand=addresses,emailAddresses,phoneNumbers"
-        return self._request(path=path)
+    def list_customers(self, limit=1000, offset=0):
+        params = {
+            "expand": "addresses,emailAddresses,phoneNumbers",
+            "limit": limit,
+            "offset": offset,
+        }
+        path = f"{self._merchant_id}/customers"
+        return self._request(path=path, params=params)
 
     def get_categories(self):
         path = f"{self._merchant_id}/categories?expand=items"
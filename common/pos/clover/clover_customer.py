@@ -1,6 +1,7 @@
 import logging
 
 from common.pos.clover.clover_client import CloverRequestClient
+from common.pos.repositories import CustomerRepository
 from inventories.models import Customer
 from retailer.models import Retailer
 
@@ -61,37 +62,63 @@ class CloverCustomer:
 
         customer.save()
 
+    FIELDS = [
+        "retailer",
+        "first_name",
+        "last_name",
+        "email",
+        "phone",
+        "address1",
+        "address2",
+        "zip_code",
+        "city",
+        "state",
+        "country",
+    ]
+    PAGE_SIZE = 1000
+
     @staticmethod
     def fetch_all_customers(retailer: Retailer) -> None:
         client = CloverRequestClient(retailer.access_token, retailer.merchant_id)
-        customers = client.list_customers()
-        for element in customers.get("elements", []):
-            _id = element["id"]
-            customer = Customer.objects.filter(origin_id=_id).first()
-
-            if not customer:
-                customer = Customer.objects.create(origin_id=_id, retailer=retailer)
-
-            customer.first_name = element["firstName"]
-            customer.last_name = element["lastName"]
-            customer.origin_id = _id
-            customer.retailer = retailer
-
-            email_addresses = element.get("emailAddresses", {}).get("elements", [])
-            if len(email_addresses) > 0:
-                customer.email = email_addresses[0]['emailAddress']
-
-            addresses = element.get("addresses", {}).get("elements", [])
-            if len(addresses) > 0:
-                address = addresses[0]
-                customer.address1 = address.get('address1')
-                customer.address2 = address.get('address2')
-                customer.zip_code = address.get('zip')
-                customer.city = address.get('city')
-                customer.state = address.get('state')
-                customer.country = address.get('country')
-
-            phone_numbers = element.get("phoneNumbers", {}).get("elements", [])
-            if len(phone_numbers) > 0:
-                customer.phone = phone_numbers[0]['phoneNumber']
-            customer.save()
+        repository = CustomerRepository()
+        offset = 0
+        while True:
+            elements = client.list_customers(
+                limit=CloverCustomer.PAGE_SIZE, offset=offset
+            ).get("elements", [])
+            repository.bulk_upsert(
+                [CloverCustomer.map_customer(element, retailer) for element in elements],
+                CloverCustomer.FIELDS,
+            )
+
+            if len(elements) < CloverCustomer.PAGE_SIZE:
+                return
+            offset += CloverCustomer.PAGE_SIZE
+
+    @staticmethod
+    def map_customer(element: dict, retailer: Retailer) -> Customer:
+        customer = Customer(
+            origin_id=element["id"],
+            retailer=retailer,
+            first_name=element.get("firstName") or "",
+            last_name=element.get("lastName") or "",
+        )
+
+        email_addresses = element.get("emailAddresses", {}).get("elements", [])
+        if len(email_addresses) > 0:
+            customer.email = email_addresses[0]['emailAddress']
+
+        addresses = element.get("addresses", {}).get("elements", [])
+        if len(addresses) > 0:
+            address = addresses[0]
+            customer.address1 = address.get('address1')
+            customer.address2 = address.get('address2')
+            customer.zip_code = address.get('zip')
+            customer.city = address.get('city')
+            customer.state = address.get('state')
+            customer.country = address.get('country')
+
+        phone_numbers = element.get("phoneNumbers", {}).get("elements", [])
+        if len(phone_numbers) > 0:
+            customer.phone = phone_numbers[0]['phoneNumber']
+        return customer
@@ -1,33 +1,50 @@
 import json
 import logging
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 
 from django.core.cache import cache
-from django.core.paginator import Paginator
 from django.db import transaction
+from django.utils import timezone
 
 from common.pos.clover.clover_client import CloverRequestClient
 from common.pos.inventory import Inventory
+from common.goupc import GoUpcEnrichment
+from common.pos.repositories import ProductCardRepository, ProductRepository
 from common.pos.utils import format_price, get_product_prices
 from inventories.models import Variant, Product, Category
+from wyndo.settings import CLOVER_HTTP_POOL_SIZE, CLOVER_ITEM_GROUP_CACHE_TTL
 
 
 class CloverInventory(Inventory):
     PLATFORM = "CLOVER"
+    # Items fetched per request when syncing webhook item ids
+    ITEM_BATCH_SIZE = 50
 
-    def __init__(self, retailer, offset=0, limit=10):
+    def __init__(self, retailer, offset=0, limit=100, modified_since: datetime = None):
         super().__init__(retailer)
         self._request_client = CloverRequestClient(
             retailer.access_token, retailer.merchant_id
         )
         self._merchant_id = retailer.merchant_id
-        self._mapper = CloverProductMapper(self._request_client)
+        self._mapper = CloverProductMapper(self._request_client, self._merchant_id)
         self._offset = offset
         self._limit = limit
+        self._modified_since = modified_since
+        self._product_repository = ProductRepository()
+        self._product_card_repository = ProductCardRepository()
 
     def fetch(self, item_id: str = None):
+        modified_since = (
+            int(self._modified_since.timestamp() * 1000)
+            if self._modified_since is not None
+            else None
+        )
         return (
-            self._request_client.get_inventory(limit=self._limit, offset=self._offset)
+            self._request_client.get_inventory(
+                limit=self._limit, offset=self._offset, modified_since=modified_since
+            )
             if item_id is None
             else self._request_client.get_single_item(item_id)
         )
@@ -54,72 +71,173 @@ class CloverInventory(Inventory):
 
     @transaction.atomic
     def store(self, products):
+        if not products:
+            return
+
+        stored_products = self.store_products(products)
+        stored_variants = self.store_variants(products, stored_products)
+        self.store_variant_categories(products, stored_variants)
+        product_ids = [product.pk for product in stored_products.values()]
+        self._product_repository.update_totals(self._retailer.id, product_ids=product_ids)
+        self._product_card_repository.refresh_listings(self._retailer.id, product_ids)
+
+    def store_products(self, products) -> dict:
+        """
+        Upsert a page of mapped products with one read and two bulk writes.
+        Returns the stored products keyed by origin_id.
+        """
+        existing = {
+            product.origin_id: product
+            for product in Product.objects.filter(
+                inventory=self._inventory,
+                origin_id__in=[product["origin_id"] for product in products],
+            )
+        }
+        now = timezone.now()
+        stored, to_create, to_update = {}, [], []
+
         for product in products:
-            product_db: Product = Product.objects.filter(
-                origin_id=product["origin_id"]
-            ).first()
-            if product_db is not None:
-                if product_db.is_modified_by_admin:
-                    product["name"] = product_db.name
-
-            created_product = self.update_or_create_product(
-                {
-                    "origin": self.PLATFORM,
-                    "origin_id": product["origin_id"],
-                    "name": product["name"],
-                    "min_price": product["min_price"],
-                    "max_price": product["max_price"],
-                    "inventory": self._inventory,
-                    "total_stock": 0,
-                }
+            origin_id = product["origin_id"]
+            if origin_id in stored:
+                continue
+
+            product_db = existing.get(origin_id)
+            if product_db is None:
+                product_db = Product(origin_id=origin_id, inventory=self._inventory)
+                to_create.append(product_db)
+            else:
+                to_update.append(product_db)
+
+            if not product_db.is_modified_by_admin:
+                product_db.name = product["name"]
+            product_db.origin = self.PLATFORM
+            product_db.min_price = product["min_price"]
+            product_db.max_price = product["max_price"]
+            product_db.updated_at = now
+            stored[origin_id] = product_db
+
+        Product.objects.bulk_create(to_create)
+        Product.objects.bulk_update(
+            to_update, ["name", "origin", "min_price", "max_price", "updated_at"]
+        )
+        return stored
+
+    def store_variants(self, products, stored_products: dict) -> dict:
+        """
+        Upsert the variants of a page of mapped products. Returns the stored
+        variants grouped by their product origin_id.
+        """
+        existing = {
+            (variant.product_id, variant.origin_id): variant
+            for variant in Variant.objects.filter(
+                product__in=list(stored_products.values()),
+                origin_id__in=[
+                    variant["origin_id"]
+                    for product in products
+                    for variant in product.get("variants", [])
+                ],
             )
+        }
+        now = timezone.now()
+        stored, to_create, to_update, seen = {}, [], [], set()
 
-            for variant in product.get("variants"):
-                variant_db: Variant = Variant.objects.filter(
-                    origin_id=variant["origin_id"]
-                ).first()
-                if variant_db is not None:
-                    if variant_db.is_modified_by_admin:
-                        variant["name"] = variant_db.name
-                        variant["description"] = variant_db.description
+        for product in products:
+            product_db = stored_products[product["origin_id"]]
+            page_variants = stored.setdefault(product["origin_id"], [])
+
+            for variant in product.get("variants", []):
+                key = (product_db.pk, variant["origin_id"])
+                variant_db = existing.get(key)
+                if variant_db is None:
+                    variant_db = Variant(
+                        origin_id=variant["origin_id"], product=product_db
+                    )
+                    existing[key] = variant_db
+                    to_create.append(variant_db)
+                elif key not in seen:
+                    to_update.append(variant_db)
+                seen.add(key)
+
+                if not variant_db.is_modified_by_admin:
+                    variant_db.name = variant["name"]
+                variant_db.origin_parent_id = variant["origin_parent_id"]
+                variant_db.sku = variant["sku"]
+                variant_db.upc = variant["upc"]
+                variant_db.stock = variant["stock"]
+                variant_db.price = variant["price"]
+                variant_db.currency = variant["currency"]
+                variant_db.updated_at = now
+                page_variants.append(variant_db)
+
+        Variant.objects.bulk_create(to_create)
+        Variant.objects.bulk_update(
+            to_update,
+            [
+                "name",
+                "origin_parent_id",
+                "sku",
+                "upc",
+                "stock",
+                "price",
+                "currency",
+                "updated_at",
+            ],
+        )
+        return stored
 
-                new_variant = self.update_or_create_variant(
-                    {
-                        "origin_id": variant["origin_id"],
-                        "origin_parent_id": variant["origin_parent_id"],
-                        "name": variant["name"],
-                        "sku": variant["sku"],
-                        "upc": variant["upc"],
-                        "stock": variant["stock"],
-                        "price": variant["price"],
-                        "currency": variant["currency"],
-                        "product": created_product,
-                    },
-                    created_product,
+    def store_variant_categories(self, products, stored_variants: dict):
+        """
+        Upsert the categories referenced by a page of products and replace the
+        category links of its variants with a single through-table write.
+        """
+        categories = {
+            category["id"]: category
+            for product in products
+            for category in product.get("categories", [])
+        }
+        existing = {
+            category.origin_id: category
+            for category in Category.objects.filter(origin_id__in=list(categories))
+        }
+        to_create, to_update = [], []
+        for origin_id, category in categories.items():
+            category_db = existing.get(origin_id)
+            if category_db is None:
+                category_db = Category(
+                    origin_id=origin_id,
+                    retailer=self._retailer,
+                    name=category["name"],
                 )
-                categories = product.get("categories", [])
-
-                new_variant.categories.clear()
-                for category in categories:
-                    new_category, created = Category.objects.update_or_create(
-                        origin_id=category["id"],
-                        retailer=self._retailer,
-                        defaults={"name": category["name"]},
+                existing[origin_id] = category_db
+                to_create.append(category_db)
+            elif category_db.name != category["name"]:
+                category_db.name = category["name"]
+                category_db.updated_at = timezone.now()
+                to_update.append(category_db)
+
+        Category.objects.bulk_create(to_create)
+        Category.objects.bulk_update(to_update, ["name", "updated_at"])
+
+        through = Category.variants.through
+        links = {}
+        for product in products:
+            for variant_db in stored_variants.get(product["origin_id"], []):
+                for category in product.get("categories", []):
+                    if category["deleted"]:
+                        continue
+                    category_id = existing[category["id"]].pk
+                    links[(category_id, variant_db.pk)] = through(
+                        category_id=category_id, variant_id=variant_db.pk
                     )
-                    if category['deleted']:
-                        new_variant.categories.remove(new_category)
-                    else:
-                        new_variant.categories.add(new_category)
-                new_variant.save()
-
-            variants = Variant.objects.filter(
-                product__origin_id=created_product.origin_id
-            )
-            created_product.total_stock = sum(variant.stock for variant in variants)
-            if len(variants) > 1:
-                created_product.min_price = min(variant.price for variant in variants)
-                created_product.max_price = max(variant.price for variant in variants)
-            created_product.save()
+
+        through.objects.filter(
+            variant_id__in=[
+                variant_db.pk
+                for variants in stored_variants.values()
+                for variant_db in variants
+            ]
+        ).delete()
+        through.objects.bulk_create(list(links.values()), ignore_conflicts=True)
 
     def process(self, products):
         mapped_data = self._mapper.map(products)
@@ -177,6 +295,19 @@ class CloverInventory(Inventory):
                 "fetch_next": False,
             }
 
+    def run_items(self, item_ids: list):
+        """
+        Fetch and store the given items, one Clover request per
+        ITEM_BATCH_SIZE ids. Errors are raised to the caller.
+        """
+        self._inventory = self.get_or_create_inventories()
+        for start in range(0, len(item_ids), self.ITEM_BATCH_SIZE):
+            products = self._request_client.get_items_by_ids(
+                item_ids[start:start + self.ITEM_BATCH_SIZE]
+            )
+            if products.get("elements"):
+                self.process(products)
+
     def fetch_all_categories(self):
         inventories = self._request_client.get_categories()
         print(json.dumps(inventories, indent=4))
@@ -207,65 +338,8 @@ class CloverInventory(Inventory):
     def delete_category(self, category_id: str):
         return Category.objects.filter(origin_id=category_id).delete()
 
-    @transaction.atomic
     def map_go_upc(self) -> None:
-        variants = (
-            Variant.objects.order_by("created_at")
-            .filter(product__inventory__location__retailer=self._retailer)
-            .exclude(variantimage__image_id__isnull=False)
-            .all()
-        )
-        paginator = Paginator(variants, 10)
-        for page_number in paginator.page_range:
-            page = paginator.page(page_number)
-
-            for variant in page.object_list:
-                upc = None
-                if variant.upc:
-                    upc = variant.upc
-                elif variant.sku:
-                    upc = variant.sku
-
-                if upc is None or variant.is_modified_by_admin:
-                    continue
-
-                go_upc_information = {}
-                try:
-                    go_upc_information = self._go_upc_client.get_product_information(
-                        upc
-                    )
-                    if len(go_upc_information) == 0:
-                        logging.info(f"No information found for {variant.pk}")
-                        continue
-                except Exception as e:
-                    logging.error(f"Error fetching Go UPC Information with upc {upc}")
-                    logging.error(e)
-
-                go_upc_description = go_upc_information.get("description")
-
-                if go_upc_description and go_upc_description != "No description found.":
-                    variant.description = go_upc_description
-
-                variant.save()
-
-                try:
-                    image_name, image = self._go_upc_client.get_product_image_from_url(
-                        go_upc_information.get("imageUrl"), upc
-                    )
-                    if image is None:
-                        logging.info(f"No image found for {variant.pk}")
-                        continue
-
-                    self.update_or_create_variant_image(
-                        {
-                            "variant": variant,
-                            "image": image,
-                            "image_id": f"{image_name}_{variant.id}",
-                        }
-                    )
-                except Exception as e:
-                    logging.error(f"Error fetching Go UPC Image with upc {upc}")
-                    logging.error(e)
+        GoUpcEnrichment(self._retailer.id).run()
 
     @transaction.atomic
     def delete(self, item_id: str):
@@ -388,6 +462,7 @@ class CloverInventory(Inventory):
         # First PUT group_items
         if form.changed_data and 'name' in form.changed_data:
             self._request_client.update_group_item(product)
+            self._mapper.forget_item_group(product.origin_id)
 
         if len(formset.deleted_objects) > 0:
             item_ids = ','.join([x.origin_id for x in formset.deleted_objects if x.origin_id])
@@ -502,6 +577,7 @@ class CloverInventory(Inventory):
             path=path,
             method="DELETE"
         )
+        self._mapper.forget_item_group(product.origin_id)
 
         variants = product.variants.all()
         variants_ids = ','.join([x.origin_id for x in variants if x.origin_id])
@@ -514,12 +590,49 @@ class CloverInventory(Inventory):
 
 
 class CloverProductMapper:
-    def __init__(self, clover_client):
+    def __init__(self, clover_client, merchant_id):
         self._clover_client = clover_client
+        self._merchant_id = merchant_id
+
+    def _item_group_cache_key(self, group_id):
+        return f"clover_item_group:{self._merchant_id}:{group_id}"
 
     def get_item_group(self, group_id):
         return self._clover_client.get_item_group(group_id)
 
+    def get_item_groups(self, group_ids) -> dict:
+        """
+        Resolve the item groups of a page from the cache and fetch the rest
+        concurrently. Requests still go through the merchant's rate limiter.
+        """
+        keys = {self._item_group_cache_key(group_id): group_id for group_id in group_ids}
+        groups = {keys[key]: group for key, group in cache.get_many(keys).items()}
+
+        missing = [group_id for group_id in group_ids if group_id not in groups]
+        if not missing:
+            return groups
+
+        workers = min(len(missing), CLOVER_HTTP_POOL_SIZE)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            fetched = executor.map(self.get_item_group, missing)
+            fetched_groups = {
+                group_id: {"id": group["id"], "name": group["name"]}
+                for group_id, group in zip(missing, fetched)
+            }
+
+        cache.set_many(
+            {
+                self._item_group_cache_key(group_id): group
+                for group_id, group in fetched_groups.items()
+            },
+            CLOVER_ITEM_GROUP_CACHE_TTL,
+        )
+        groups.update(fetched_groups)
+        return groups
+
+    def forget_item_group(self, group_id):
+        cache.delete(self._item_group_cache_key(group_id))
+
     def map(self, products):
         result_product = []
         if not products:
@@ -535,13 +648,20 @@ class CloverProductMapper:
     def map_groups(self, products):
         result = []
         grouped_items = {}
+        item_groups = self.get_item_groups(
+            list({
+                item["itemGroup"]["id"]
+                for item in products["elements"]
+                if "itemGroup" in item
+            })
+        )
 
         for item in products["elements"]:
             if "itemGroup" in item:
                 group_id = item["itemGroup"]["id"]
 
                 if group_id not in grouped_items:
-                    itemGroup = self.get_item_group(group_id)
+                    itemGroup = item_groups[group_id]
                     group = {
                         "id": itemGroup["id"],
                         "name": itemGroup["name"],
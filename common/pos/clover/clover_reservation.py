@@ -1,22 +1,26 @@
 from logging import error as error_log
-from datetime import datetime
+from datetime import datetime, timezone as dt_timezone
 from django.db import transaction
+from django.utils import timezone
 
-from common.pos.clover import CloverInventory
 from common.pos.clover.clover_client import CloverRequestClient
+from common.pos.repositories import OrderRepository, VariantRepository
 from common.pos.reservation import Reservation
 from common.pos.utils import format_price
-from inventories.models import Order as OrderModel, Variant, OrderItem
+from inventories.models import OrderItem
 
 
 class CloverReservation(Reservation):
     PLATFORM = "CLOVER"
+    ORDERS_PAGE_SIZE = 100
 
     def __init__(self, retailer):
         super().__init__(retailer)
         self._request_client = CloverRequestClient(
             retailer.access_token, retailer.merchant_id
         )
+        self.order_repository = OrderRepository()
+        self.variant_repository = VariantRepository()
 
     def post(self, payload):
         print("post")
@@ -42,52 +46,123 @@ class CloverReservation(Reservation):
             payload.get("reservation_params").get("origin_id")
         )
 
-    def sync_from_clover(self, order_id, order=None):
+    def sync_from_clover(self, order_id, order=None, fetch_missing_items=True):
         order = self._request_client.get_order(order_id) if not order else order
-        new_order, _created = OrderModel.objects.get_or_create(
-            origin_id=order.get("id"),
+        self.store_orders([order], fetch_missing_items=fetch_missing_items)
+
+    def fetch_all_orders(self):
+        """
+        Page through the orders modified since the last successful order
+        sync, or the whole history on the first run, storing one page at a
+        time.
+        """
+        started_at = timezone.now()
+        synced_at = self._retailer.orders_synced_at
+        modified_since = int(synced_at.timestamp() * 1000) if synced_at else None
+
+        offset = 0
+        while True:
+            orders = self._request_client.get_orders(
+                limit=self.ORDERS_PAGE_SIZE, offset=offset, modified_since=modified_since
+            ).get("elements", [])
+            self.store_orders(orders)
+
+            if len(orders) < self.ORDERS_PAGE_SIZE:
+                break
+            offset += self.ORDERS_PAGE_SIZE
+
+        self._retailer.update_orders_synced_at(started_at)
+
+    @transaction.atomic
+    def store_orders(self, orders: list, fetch_missing_items=True):
+        """
+        Store a page of Clover orders. Line items for items that are not in
+        the inventory yet are left out and the items are loaded in the
+        background, after which those orders are stored again from the
+        payloads already fetched.
+        """
+        variants = self.variant_repository.get_by_origin_ids(
+            {
+                line_item["item"]["id"]
+                for order in orders
+                for line_item in order.get("lineItems", {}).get("elements", [])
+                if "item" in line_item
+            },
+            self._retailer.id,
         )
-        new_order.subtotal = format_price(order["total"])
-        new_order.total = format_price(order["total"])
-        new_order.status = order["state"]
-        new_order.retailer = self._retailer
-        new_order.origin = self.PLATFORM
-        new_order.order_time = datetime.fromtimestamp(int(order.get("createdTime") / 1000))
-        new_order.quantity = len(order.get("lineItems").get("elements", []))
-
-        # TODO: save customer info
-        new_order.order_code = "#{:06d}".format(new_order.id)
-        new_order.save()
-
-        new_order.order_items.all().delete()
-        line_items = order["lineItems"]["elements"]
-        for line_item in line_items:
+
+        mapped_orders, line_items = [], {}
+        missing_items, incomplete_orders = set(), []
+        for order in orders:
+            try:
+                mapped_order = self.map_order(order)
+                order_items, order_missing_items = self.map_line_items(order, variants)
+            except Exception as e:
+                error_log("CLOVER ORDER: %s" % e)
+                continue
+            mapped_orders.append(mapped_order)
+            line_items[order["id"]] = order_items
+            if order_missing_items:
+                missing_items.update(order_missing_items)
+                incomplete_orders.append(order)
+
+        stored_orders = self.order_repository.bulk_upsert(mapped_orders)
+
+        items = []
+        for origin_id, order_items in line_items.items():
+            for item in order_items:
+                item.order = stored_orders[origin_id]
+                items.append(item)
+        self.order_repository.replace_items(list(stored_orders.values()), items)
+
+        if missing_items and fetch_missing_items:
+            from inventories.tasks import fetch_clover_order_items
+
+            transaction.on_commit(
+                lambda: fetch_clover_order_items.delay(
+                    retailer_id=self._retailer.pk,
+                    item_ids=sorted(missing_items),
+                    orders=incomplete_orders,
+                )
+            )
+
+    def map_order(self, order) -> dict:
+        return {
+            "origin_id": order["id"],
+            "subtotal": format_price(order["total"]),
+            "total": format_price(order["total"]),
+            "status": order["state"],
+            "retailer": self._retailer,
+            "origin": self.PLATFORM,
+            "order_time": datetime.fromtimestamp(order["createdTime"] / 1000, tz=dt_timezone.utc),
+            "quantity": len(order.get("lineItems", {}).get("elements", [])),
+            # TODO: save customer info
+        }
+
+    def map_line_items(self, order, variants: dict):
+        """
+        Clover returns one line item per unit sold. They are aggregated into
+        one OrderItem per variant. Returns the items and the ids of the
+        Clover items that have no variant yet.
+        """
+        items, missing_items = {}, set()
+        for line_item in order.get("lineItems", {}).get("elements", []):
             if "item" not in line_item:
                 continue
             item_id = line_item["item"]["id"]
-            variant = Variant.objects.filter(origin_id=item_id).first()
+            variant = variants.get(item_id)
             if not variant:
-                clover_inventory = CloverInventory(self._retailer, limit=100, offset=0)
-                clover_inventory.run(item_id=item_id)
-                variant = Variant.objects.filter(origin_id=item_id).first()
-            if variant:
-                item, created = OrderItem.objects.get_or_create(
-                    order=new_order,
-                    variant=variant,
-                    quantity=1,
-                )
-                if not created:
-                    item.quantity = item.quantity + 1
-
-                item.unit_price = format_price(line_item["price"])
-                item.variation_total = format_price(line_item["price"] * item.quantity)
-                item.save()
+                missing_items.add(item_id)
+                continue
 
-    def fetch_all_orders(self):
-        all_orders = self._request_client.get_orders()
-        for order in all_orders.get("elements", []):
-            self.sync_from_clover(order.get("id"), order)
+            item = items.get(variant.pk)
+            if item is None:
+                item = items[variant.pk] = OrderItem(variant=variant, quantity=0)
+            item.quantity += 1
+            item.unit_price = format_price(line_item["price"])
+            item.variation_total = format_price(line_item["price"] * item.quantity)
 
+        return list(items.values()), missing_items
 
     @transaction.atomic
     def store(self, reservation):
@@ -1,3 +1,5 @@
+import hashlib
+import json
 import logging
 
 from django.core.mail import EmailMessage
@@ -7,6 +9,7 @@ from common.pos.clover import CloverInventory
 from common.pos.clover.clover_customer import CloverCustomer
 from common.pos.clover.clover_location import CloverLocation
 from common.pos.clover.clover_reservation import CloverReservation
+from inventories.models import WebhookEvent
 from inventories.tasks import run_go_upc_integration
 from retailer.models import Retailer
 
@@ -28,56 +31,127 @@ class CloverWebhook:
         "P": "Payments",
     }
 
+    __EVENT_FAMILIES = {
+        "C": "customer",
+        "I": "catalog",
+        "IC": "catalog",
+        "IG": "catalog",
+        "IM": "catalog",
+        "M": "location",
+        "O": "order",
+    }
+
     __TYPE_CREATE = "CREATE"
     __TYPE_UPDATE = "UPDATE"
     __TYPE_DELETE = "DELETE"
 
-    def process_events(self, body: dict) -> None:
+    @staticmethod
+    def build_events(body: dict) -> list:
+        """
+        One event row per object notified in a Clover request. Clover sends
+        no event id, so the object, action and timestamp identify it, or a
+        hash of the event when it has no timestamp. Raises KeyError or
+        ValueError when the body is malformed.
+        """
         app_id = body["appId"]
+        events = []
         for merchant_id, objects in body["merchants"].items():
-            retailer = (
-                Retailer.objects.filter(origin=Retailer.CLOVER)
-                .filter(app_id=app_id)
-                .filter(merchant_id=merchant_id)
-                .filter(status=Retailer.STATUS_APPROVED)
-                .first()
-            )
-            if not retailer:
-                return
-
-            clover_inventory = CloverInventory(retailer)
-
             for event in objects:
                 event_type, object_id = event["objectId"].split(":")
-                match self.__EVENT_TYPE_KEYS[event_type]:
-                    case "Inventory":
-                        # Inventory Type Event
-                        if event["type"] in [self.__TYPE_CREATE, self.__TYPE_UPDATE]:
-                            # Inventory Creation/Update Event
-                            clover_inventory.run(item_id=object_id)
-                            run_go_upc_integration.delay(retailer_id=retailer.pk)
-
-                        elif event["type"] == self.__TYPE_DELETE:
-                            # Inventory Creation Event
-                            clover_inventory.delete(item_id=object_id)
-                    case "Inventory Category":
-                        if event["type"] in [self.__TYPE_CREATE, self.__TYPE_UPDATE]:
-                            clover_inventory.create_or_update_category(event.get("object", {}))
-                        elif event["type"] == self.__TYPE_DELETE:
-                            clover_inventory.delete_category(category_id=object_id)
-                    case "Merchants":
-                        if event["type"] == self.__TYPE_UPDATE:
-                            # Merchant Update Event
-                            # Update location
-                            CloverLocation.fetch_locations(merchant_id=object_id)
-                    case "Customers":
-                        CloverCustomer.handle_event(event, event['type'])
-                    case "Orders":
-                        clover_reservation = CloverReservation(retailer)
-                        if event["type"] == self.__TYPE_UPDATE or event["type"] == self.__TYPE_CREATE:
-                            clover_reservation.sync_from_clover(object_id)
-                    case _:
-                        pass
+                ts = event.get("ts")
+                if ts is None:
+                    ts = hashlib.sha1(json.dumps(event, sort_keys=True).encode()).hexdigest()
+                events.append(
+                    WebhookEvent(
+                        origin=WebhookEvent.CLOVER,
+                        merchant_id=merchant_id,
+                        event_id=f"{event['objectId']}:{event['type']}:{ts}",
+                        event_type=event_type,
+                        object_id=object_id,
+                        payload={**event, "appId": app_id},
+                    )
+                )
+        return events
+
+    def family(self, event: WebhookEvent) -> str:
+        return self.__EVENT_FAMILIES.get(event.event_type)
+
+    def coalesce_key(self, event: WebhookEvent) -> tuple:
+        """
+        Events sharing a key are processed in a single run. Item events of a
+        merchant are merged so the items are fetched together, other objects
+        are merged per object.
+        """
+        if event.event_type == "I":
+            return (event.event_type,)
+        return event.event_type, event.object_id
+
+    @staticmethod
+    def _get_retailer(event: WebhookEvent):
+        retailer = (
+            Retailer.objects.filter(origin=Retailer.CLOVER)
+            .filter(app_id=event.payload.get("appId"))
+            .filter(merchant_id=event.merchant_id)
+            .filter(status=Retailer.STATUS_APPROVED)
+            .first()
+        )
+        if not retailer:
+            logger.info(f"[CLOVER WEBHOOK] No approved retailer for merchant {event.merchant_id}")
+        return retailer
+
+    def process_events(self, events: list) -> None:
+        """Process a group of events sharing a coalescing key."""
+        if events[0].event_type != "I":
+            # The last event carries the latest state of the object
+            self.process_event(events[-1])
+            return
+
+        retailer = self._get_retailer(events[0])
+        if not retailer:
+            return
+
+        # Only the last action on each item matters
+        actions = {event.object_id: event.payload["type"] for event in events}
+        item_ids = [
+            item_id
+            for item_id, action in actions.items()
+            if action in [self.__TYPE_CREATE, self.__TYPE_UPDATE]
+        ]
+        clover_inventory = CloverInventory(retailer)
+        if item_ids:
+            clover_inventory.run_items(item_ids)
+            run_go_upc_integration.delay(retailer_id=retailer.pk)
+        for item_id, action in actions.items():
+            if action == self.__TYPE_DELETE:
+                clover_inventory.delete(item_id=item_id)
+
+    def process_event(self, event: WebhookEvent) -> None:
+        body = event.payload
+        retailer = self._get_retailer(event)
+        if not retailer:
+            return
+
+        clover_inventory = CloverInventory(retailer)
+        object_id = event.object_id
+        match self.__EVENT_TYPE_KEYS.get(event.event_type):
+            case "Inventory Category":
+                if body["type"] in [self.__TYPE_CREATE, self.__TYPE_UPDATE]:
+                    clover_inventory.create_or_update_category(body.get("object", {}))
+                elif body["type"] == self.__TYPE_DELETE:
+                    clover_inventory.delete_category(category_id=object_id)
+            case "Merchants":
+                if body["type"] == self.__TYPE_UPDATE:
+                    # Merchant Update Event
+                    # Update location
+                    CloverLocation.fetch_locations(merchant_id=object_id)
+            case "Customers":
+                CloverCustomer.handle_event(body, body['type'])
+            case "Orders":
+                clover_reservation = CloverReservation(retailer)
+                if body["type"] == self.__TYPE_UPDATE or body["type"] == self.__TYPE_CREATE:
+                    clover_reservation.sync_from_clover(object_id)
+            case _:
+                pass
 
     @staticmethod
     def send_verification_email(verification_code) -> bool:
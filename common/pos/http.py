@@ -0,0 +1,70 @@
+import os
+import random
+import threading
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class BackoffRetry(Retry):
+    """
+    Retry policy with full-jitter exponential backoff. Rate limited (429)
+    responses are retried for every method since the POS rejected the call
+    before processing it, server errors only for idempotent methods. The
+    Retry-After header takes precedence over the computed backoff.
+    """
+
+    TOO_MANY_REQUESTS = 429
+
+    def get_backoff_time(self):
+        backoff = super().get_backoff_time()
+        return random.uniform(0, backoff) if backoff else 0
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if status_code == self.TOO_MANY_REQUESTS:
+            return bool(self.total)
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+def build_session(pool_size: int, max_retries: int, backoff_factor: float) -> Session:
+    retry = BackoffRetry(
+        total=max_retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=(500, 502, 503, 504),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+    )
+    session = Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class SessionPool:
+    """
+    Lazily builds one keep-alive session per process. Celery prefork workers
+    fork after import, so the session is rebuilt when the pid changes instead
+    of sharing sockets with the parent process.
+    """
+
+    def __init__(self, pool_size: int, max_retries: int, backoff_factor: float):
+        self._pool_size = pool_size
+        self._max_retries = max_retries
+        self._backoff_factor = backoff_factor
+        self._lock = threading.Lock()
+        self._session = None
+        self._pid = None
+
+    def get(self) -> Session:
+        if self._session is None or self._pid != os.getpid():
+            with self._lock:
+                if self._session is None or self._pid != os.getpid():
+                    self._session = build_session(
+                        self._pool_size, self._max_retries, self._backoff_factor
+                    )
+                    self._pid = os.getpid()
+        return self._session
@@ -0,0 +1,114 @@
+import logging
+import time
+
+from django.core.cache import cache
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+# Refills the bucket for the time elapsed since the last call and takes one
+# token when available. Returns 0 when the token was taken, otherwise the
+# milliseconds to wait for the next token. Runs atomically in Redis so every
+# worker sees the same bucket.
+TAKE_TOKEN_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "timestamp")
+local tokens = tonumber(bucket[1]) or capacity
+local timestamp = tonumber(bucket[2]) or now
+
+tokens = math.min(capacity, tokens + math.max(0, now - timestamp) * rate)
+
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = math.ceil((1 - tokens) / rate * 1000)
+end
+
+redis.call("HSET", KEYS[1], "tokens", tostring(tokens), "timestamp", tostring(now))
+redis.call("EXPIRE", KEYS[1], math.ceil(capacity / rate) + 1)
+return wait
+"""
+
+METRICS_TTL = 60 * 60 * 24
+
+
+class RateLimiter:
+    """
+    Token bucket shared by every worker calling a POS on behalf of the same
+    merchant. `acquire` blocks until a token is available and records how
+    long it waited so worker concurrency can be tuned against the POS limits.
+    """
+
+    def __init__(self, platform: str, rate: float, capacity: int = None):
+        self.platform = platform
+        self.rate = rate
+        self.capacity = capacity or max(1, int(rate))
+        self._script = None
+
+    def _key(self, merchant_id, name):
+        return cache.make_key(f"rate_limit:{self.platform}:{merchant_id}:{name}")
+
+    def _take_token(self, connection, merchant_id) -> float:
+        if self._script is None:
+            self._script = connection.register_script(TAKE_TOKEN_SCRIPT)
+        wait_ms = self._script(
+            keys=[self._key(merchant_id, "bucket")],
+            args=[self.rate, self.capacity, time.time()],
+            client=connection,
+        )
+        return int(wait_ms) / 1000
+
+    def _record(self, connection, merchant_id, waited: float):
+        key = self._key(merchant_id, "metrics")
+        pipeline = connection.pipeline()
+        pipeline.hincrby(key, "requests", 1)
+        if waited:
+            pipeline.hincrby(key, "throttled", 1)
+            pipeline.hincrbyfloat(key, "wait_seconds", waited)
+        pipeline.expire(key, METRICS_TTL)
+        pipeline.execute()
+
+    def acquire(self, merchant_id) -> float:
+        try:
+            connection = get_redis_connection("default")
+            waited = 0
+            wait = self._take_token(connection, merchant_id)
+            while wait:
+                time.sleep(wait)
+                waited += wait
+                wait = self._take_token(connection, merchant_id)
+            self._record(connection, merchant_id, waited)
+        except (RedisError, NotImplementedError) as e:
+            # Never block POS calls because the limiter is unavailable
+            logger.warning(f"[{self.platform.upper()} RATE LIMIT] {e}")
+            return 0
+
+        if waited:
+            logger.debug(
+                f"[{self.platform.upper()} RATE LIMIT] merchant {merchant_id} "
+                f"waited {waited:.3f}s"
+            )
+        return waited
+
+    def metrics(self, merchant_id) -> dict:
+        """
+        Requests, throttled requests and total seconds spent waiting for
+        the merchant over the last day.
+        """
+        try:
+            connection = get_redis_connection("default")
+            values = connection.hgetall(self._key(merchant_id, "metrics"))
+        except (RedisError, NotImplementedError):
+            values = {}
+
+        values = {key.decode(): value.decode() for key, value in values.items()}
+        return {
+            "requests": int(values.get("requests", 0)),
+            "throttled": int(values.get("throttled", 0)),
+            "wait_seconds": float(values.get("wait_seconds", 0)),
+        }
@@ -1,67 +1,157 @@
-from django.db.models import Min, Max, F, Sum
+import re
+from collections import defaultdict
+from typing import TYPE_CHECKING
 
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+from django.db import connection, transaction
+from django.db.models import (
+    Case,
+    Count,
+    Exists,
+    F,
+    Min,
+    OuterRef,
+    Q,
+    Subquery,
+    Sum,
+    Value,
+    When,
+)
+from django.db.models.functions import Coalesce, NullIf
+from django.utils import timezone
+
+from common.catalog_cache import CatalogCache
+from inventories.models import Customer as CustomerModel
 from inventories.models import Inventory as InventoryModel
+from inventories.models import Order as OrderModel
+from inventories.models import OrderItem as OrderItemModel
+from inventories.models import OrderPickup as OrderPickupModel
 from inventories.models import Product as ProductModel
+from inventories.models import ProductCard as ProductCardModel
+from inventories.models import Reservation as ReservationModel
+from inventories.models import UpcIndex as UpcIndexModel
+from inventories.models import UpcLookup as UpcLookupModel
 from inventories.models import Variant as VariantModel
 from inventories.models import VariantImage as VariantImageModel
+from inventories.models import WebhookEvent as WebhookEventModel
 from retailer.models import Location as LocationModel
 
+if TYPE_CHECKING:
+    from common.pos.square.square_mapper import Item, ItemVariation
+
 
 class ProductRepository:
+    BATCH_SIZE = 1000
+
     def __init__(self) -> None:
         self.model = ProductModel
 
-    def update_min_max_price(self, retailer_id, product_id):
-        queryset = (
-            self.model.objects.values(
-                _min_price=Min("variants__price"), _max_price=Max("variants__price")
-            )
-            .filter(inventory__location__retailer_id=retailer_id, origin_id=product_id)
-            .annotate(product_id=F("id"))
-        )
+    def update_totals(self, retailer_id, product_ids=None) -> set:
+        """
+        Recompute total stock and, for products with more than one variant,
+        the price range of a retailer's products with a single UPDATE ...
+        FROM over the variants grouped per product. Only rows whose totals
+        change are written. Pass `product_ids` to limit the recompute to the
+        products of a sync batch. Returns the ids of the products that changed.
+        """
+        params = [retailer_id]
+        product_filter = ""
+        if product_ids is not None:
+            product_ids = list(product_ids)
+            if not product_ids:
+                return set()
+            product_filter = f"AND product.id IN ({', '.join(['%s'] * len(product_ids))})"
+            params.extend(product_ids)
 
-        for product in queryset:
-            self.model.objects.filter(id=product["product_id"]).update(
-                min_price=product["_min_price"], max_price=product["_max_price"]
-            )
+        sql = f"""
+            UPDATE {self.model._meta.db_table} AS target
+            SET total_stock = totals.total_stock,
+                min_price = CASE
+                    WHEN totals.variant_count > 1 THEN totals.min_price ELSE target.min_price
+                END,
+                max_price = CASE
+                    WHEN totals.variant_count > 1 THEN totals.max_price ELSE target.max_price
+                END
+            FROM (
+                SELECT
+                    product.id AS product_id,
+                    CASE WHEN SUM(variant.stock) > 0 THEN SUM(variant.stock) ELSE 0 END
+                        AS total_stock,
+                    COUNT(variant.id) AS variant_count,
+                    MIN(variant.price) AS min_price,
+                    MAX(variant.price) AS max_price
+                FROM {self.model._meta.db_table} AS product
+                INNER JOIN {InventoryModel._meta.db_table} AS inventory
+                    ON inventory.id = product.inventory_id
+                INNER JOIN {LocationModel._meta.db_table} AS location
+                    ON location.id = inventory.location_id
+                LEFT JOIN {VariantModel._meta.db_table} AS variant
+                    ON variant.product_id = product.id
+                WHERE location.retailer_id = %s {product_filter}
+                GROUP BY product.id
+            ) AS totals
+            WHERE target.id = totals.product_id
+                AND (
+                    target.total_stock IS DISTINCT FROM totals.total_stock
+                    OR (
+                        totals.variant_count > 1
+                        AND (
+                            target.min_price IS DISTINCT FROM totals.min_price
+                            OR target.max_price IS DISTINCT FROM totals.max_price
+                        )
+                    )
+                )
+            RETURNING id
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return {row[0] for row in cursor.fetchall()}
 
     def get_by_origin_id(self, origin_id: str):
         return self.model.objects.filter(origin_id=origin_id)
 
-    def update_or_create(self, product: ProductModel):
-        exists = self.model.objects.filter(
-            origin_id=product.origin_id, inventory=product.inventory
-        ).exists()
+    def bulk_upsert(self, products: list["Item"], inventories: dict) -> dict:
+        """
+        Insert or update the products of a catalog page at every location they
+        are present at with a single statement. `inventories` maps location
+        pos_ids to inventories. Returns the stored products keyed by
+        (origin_id, pos_id).
+        """
+        pos_ids = {inventory.pk: pos_id for pos_id, inventory in inventories.items()}
+        rows = {}
+        for product in products:
+            for location_id in product.locations or []:
+                inventory = inventories.get(location_id)
+                if inventory is None:
+                    continue
+                rows[(product.origin_id, inventory.pk)] = self.model(
+                    origin=self.model.SQUARE,
+                    origin_id=product.origin_id,
+                    name=product.name,
+                    inventory=inventory,
+                )
 
-        if not exists:
-            product.save()
-        else:
-            self.get_by_origin_id(product.origin_id).update(
-                name=product.name,
-                min_price=product.min_price,
-                max_price=product.max_price,
-            )
-        return product
+        if not rows:
+            return {}
 
-    def check_product_exists(self, origin_id: str, location_id: str) -> ProductModel:
-        return self.model.objects.get(
-            origin_id=origin_id, inventory__location__pos_id=location_id
+        self.model.objects.bulk_create(
+            rows.values(),
+            update_conflicts=True,
+            unique_fields=["origin_id", "inventory"],
+            update_fields=["name", "updated_at"],
         )
-
-    def update_total_stock(self, retailer_id: str):
-        queryset = self.model.objects.filter(
-            inventory__location__retailer_id=retailer_id,
+        stored = self.model.objects.filter(
+            origin_id__in={origin_id for origin_id, _ in rows},
+            inventory__in=list(inventories.values()),
         )
+        return {
+            (product.origin_id, pos_ids[product.inventory_id]): product
+            for product in stored
+            if (product.origin_id, product.inventory_id) in rows
+        }
 
-        for product in queryset:
-            total_stock = product.variants.aggregate(Sum("stock")).get("stock__sum")
-
-            if not total_stock or total_stock < 0:
-                total_stock = 0
-
-            self.model.objects.filter(id=product.id).update(total_stock=total_stock)
-
-    def delete_products(self, deleted_products: list):
+    def delete_products(self, deleted_products: list) -> int:
+        deleted = 0
         for product in deleted_products:
             for location_id in product.locations:
                 product = self.model.objects.filter(
@@ -70,30 +160,431 @@ class ProductRepository:
                 if product is not None:
                     # TODO: Delete products and variants logically
                     product.delete()
+                    deleted += 1
+        return deleted
+
+
+class ProductCardRepository:
+    BATCH_SIZE = 1000
+    FIELDS = [
+        "retailer",
+        "retailer_name",
+        "name",
+        "image",
+        "price",
+        "min_price",
+        "max_price",
+        "variant_count",
+        "total_stock",
+        "available_stock",
+        "address",
+        "is_active",
+        "product_created_at",
+        "search_keywords",
+        "search_description",
+        "updated_at",
+    ]
+    COMPARED_FIELDS = [field for field in FIELDS if field != "updated_at"]
+    # Unstemmed so partial words typed in the search box match as prefixes
+    SEARCH_CONFIG = "simple"
+
+    def __init__(self) -> None:
+        self.model = ProductCardModel
+
+    def refresh(self, retailer_id=None, product_ids=None):
+        """
+        Rebuild the listing cards of the given products, or of every product
+        of the retailer, from the catalog tables in batches. Invalidates the
+        cached catalog sections once the transaction commits when any card
+        changed. Returns the number of cards that changed.
+        """
+        products = ProductModel.objects.all()
+        if retailer_id is not None:
+            products = products.filter(inventory__location__retailer_id=retailer_id)
+        if product_ids is not None:
+            products = products.filter(id__in=list(product_ids))
+
+        variants = VariantModel.objects.filter(product=OuterRef("pk")).order_by("id")
+        reserved = (
+            ReservationModel.objects.filter(
+                variant__product=OuterRef("pk"), status="RESERVED"
+            )
+            .order_by()
+            .values("variant__product")
+            .annotate(total=Sum("quantity"))
+            .values("total")
+        )
+        rows = products.annotate(
+            first_variant_id=Subquery(variants.values("id")[:1]),
+            price=Subquery(variants.values("price")[:1]),
+            variant_count=Coalesce(
+                Subquery(
+                    variants.order_by().values("product").annotate(count=Count("id")).values("count")
+                ),
+                0,
+            ),
+            reserved=Coalesce(Subquery(reserved), 0),
+        ).annotate(
+            image=Subquery(
+                VariantImageModel.objects.filter(variant=OuterRef("first_variant_id"))
+                .order_by("id")
+                .values("image")[:1]
+            ),
+        ).values(
+            "id",
+            "name",
+            "image",
+            "price",
+            "min_price",
+            "max_price",
+            "variant_count",
+            "total_stock",
+            "reserved",
+            "is_active",
+            "created_at",
+            "inventory__location__retailer_id",
+            "inventory__location__retailer__name",
+            "inventory__location__address1",
+            "inventory__location__address2",
+            "inventory__location__city",
+            "inventory__location__zip_code",
+        )
+
+        cards = []
+        refreshed = 0
+        for row in rows.iterator(chunk_size=self.BATCH_SIZE):
+            cards.append(self.build(row))
+            if len(cards) == self.BATCH_SIZE:
+                refreshed += self.bulk_upsert(cards)
+                cards = []
+        refreshed += self.bulk_upsert(cards)
+        if refreshed:
+            transaction.on_commit(CatalogCache.bump)
+        return refreshed
+
+    def refresh_listings(self, retailer_id, product_ids):
+        """
+        Rebuild the listing cards and UPC index entries of the retailer's
+        `product_ids` after a sync changed them.
+        """
+        if not product_ids:
+            return
+        product_ids = list(product_ids)
+        self.refresh(retailer_id=retailer_id, product_ids=product_ids)
+        UpcIndexRepository().refresh(retailer_id=retailer_id, product_ids=product_ids)
+
+    def refresh_related_items(self, upcs, retailer_id=None, product_ids=None) -> int:
+        """
+        Flag the cards listed as related items: products without UPC and
+        single variant products priced at the lowest price of their UPC
+        across retailers. Only the cards of the given retailer or products
+        and of products selling one of `upcs` are recomputed.
+        """
+        if product_ids is not None:
+            scopes = [Q(product_id__in=product_ids)]
+        elif retailer_id is not None:
+            scopes = [Q(retailer_id=retailer_id)]
+        else:
+            return self._update_related_items(Q())
+
+        # Chunked so the UPC list stays bounded on large syncs
+        upcs = list(upcs)
+        for start in range(0, len(upcs), self.BATCH_SIZE):
+            scopes.append(Q(product__variants__upc__in=upcs[start : start + self.BATCH_SIZE]))
+        return sum(self._update_related_items(scope) for scope in scopes)
+
+    def _update_related_items(self, scope) -> int:
+        lowest_price = (
+            VariantModel.objects.filter(upc=OuterRef("upc"))
+            .order_by()
+            .values("upc")
+            .annotate(lowest_price=Min("price"))
+            .values("lowest_price")
+        )
+        variants = VariantModel.objects.filter(product=OuterRef("product_id"))
+        without_upc = variants.filter(Q(upc__isnull=True) | Q(upc=""))
+        cheapest = variants.annotate(lowest_price=Subquery(lowest_price)).filter(
+            price=F("lowest_price")
+        )
+
+        card_ids = self.model.objects.filter(scope).values("product_id").distinct()
+        return self.model.objects.filter(product_id__in=card_ids).update(
+            is_related_item=Case(
+                When(Exists(without_upc), then=Value(True)),
+                When(Q(variant_count=1) & Exists(cheapest), then=Value(True)),
+                default=Value(False),
+            )
+        )
+
+    def refresh_for_variants(self, variant_ids):
+        product_ids = VariantModel.objects.filter(
+            id__in=[variant_id for variant_id in variant_ids if variant_id]
+        ).values_list("product_id", flat=True)
+        self.refresh(product_ids=set(product_ids))
+
+    def build(self, row) -> ProductCardModel:
+        address = ", ".join(
+            part
+            for part in (
+                row["inventory__location__address1"],
+                row["inventory__location__address2"],
+                row["inventory__location__city"],
+                row["inventory__location__zip_code"],
+            )
+            if part
+        )
+        return self.model(
+            product_id=row["id"],
+            retailer_id=row["inventory__location__retailer_id"],
+            retailer_name=row["inventory__location__retailer__name"],
+            name=row["name"],
+            image=row["image"] or None,
+            price=row["price"] or 0,
+            min_price=row["min_price"],
+            max_price=row["max_price"],
+            variant_count=row["variant_count"],
+            total_stock=row["total_stock"],
+            available_stock=row["total_stock"] - row["reserved"],
+            address=address,
+            is_active=row["is_active"],
+            product_created_at=row["created_at"],
+        )
+
+    def bulk_upsert(self, cards: list) -> int:
+        """Write the cards that differ from the stored ones. Returns how many did."""
+        if not cards:
+            return 0
+        self.add_search_text(cards)
+        cards = self.changed(cards)
+        if not cards:
+            return 0
+        self.model.objects.bulk_create(
+            cards,
+            update_conflicts=True,
+            unique_fields=["product"],
+            update_fields=self.FIELDS,
+        )
+        self.model.objects.filter(
+            product_id__in=[card.product_id for card in cards]
+        ).update(
+            search_vector=(
+                SearchVector("name", weight="A", config=self.SEARCH_CONFIG)
+                + SearchVector("search_keywords", weight="B", config=self.SEARCH_CONFIG)
+                + SearchVector("search_description", weight="C", config=self.SEARCH_CONFIG)
+            )
+        )
+        return len(cards)
+
+    def changed(self, cards: list) -> list:
+        """The cards that are new or whose values differ from the stored ones."""
+        stored = self.model.objects.filter(
+            product_id__in=[card.product_id for card in cards]
+        ).only(*self.COMPARED_FIELDS, "search_vector")
+        stored = {card.product_id: card for card in stored}
+        return [
+            card
+            for card in cards
+            if card.product_id not in stored
+            or stored[card.product_id].search_vector is None
+            or any(
+                self._value(card, field) != self._value(stored[card.product_id], field)
+                for field in self.COMPARED_FIELDS
+            )
+        ]
+
+    @staticmethod
+    def _value(card, field):
+        if field == "retailer":
+            return card.retailer_id
+        if field == "image":
+            return card.image.name or None
+        return getattr(card, field)
+
+    def add_search_text(self, cards: list):
+        """
+        Collect the variant names, SKUs, UPCs, categories and descriptions
+        of a batch of cards with one query.
+        """
+        keywords, descriptions = defaultdict(set), defaultdict(set)
+        variants = VariantModel.objects.filter(
+            product_id__in=[card.product_id for card in cards]
+        ).values("product_id", "name", "sku", "upc", "description", "categories__name")
+        for variant in variants:
+            keywords[variant["product_id"]].update(
+                value
+                for value in (
+                    variant["name"],
+                    variant["sku"],
+                    variant["upc"],
+                    variant["categories__name"],
+                )
+                if value
+            )
+            if variant["description"]:
+                descriptions[variant["product_id"]].add(variant["description"])
+
+        for card in cards:
+            card.search_keywords = " ".join(sorted(keywords[card.product_id]))
+            card.search_description = " ".join(sorted(descriptions[card.product_id]))
+
+    def search(self, text: str):
+        """
+        Cards matching every word of `text` as a prefix of their name,
+        variant names, SKUs, UPCs, categories or descriptions, best ranked
+        first.
+        """
+        terms = re.findall(r"\w+", text.lower())
+        if not terms:
+            return self.model.objects.defer(
+                "search_keywords", "search_description", "search_vector"
+            ).order_by("name", "product_id")
+
+        query = SearchQuery(
+            " & ".join(f"{term}:*" for term in terms),
+            search_type="raw",
+            config=self.SEARCH_CONFIG,
+        )
+        return (
+            self.model.objects.filter(search_vector=query)
+            .annotate(rank=SearchRank(F("search_vector"), query))
+            .defer("search_keywords", "search_description", "search_vector")
+            .order_by("-rank", "product_id")
+        )
+
+
+class UpcIndexRepository:
+    BATCH_SIZE = 1000
+
+    def __init__(self) -> None:
+        self.model = UpcIndexModel
+
+    def refresh(self, retailer_id=None, product_ids=None) -> set:
+        """
+        Rebuild the index entries of the given products, or of every product
+        of the retailer, then recompute the related items flag of every card
+        sharing one of their UPCs. Returns the UPCs and SKUs touched.
+        """
+        entries = self.model.objects.all()
+        variants = VariantModel.objects.filter(product__isnull=False)
+        if retailer_id is not None:
+            entries = entries.filter(retailer_id=retailer_id)
+            variants = variants.filter(product__inventory__location__retailer_id=retailer_id)
+        if product_ids is not None:
+            product_ids = list(product_ids)
+            entries = entries.filter(product_id__in=product_ids)
+            variants = variants.filter(product_id__in=product_ids)
+
+        codes = set(entries.values_list("code", flat=True))
+        entries.delete()
+
+        rows = []
+        for variant in variants.values(
+            "id",
+            "upc",
+            "sku",
+            "price",
+            "stock",
+            "product_id",
+            "product__total_stock",
+            "product__is_active",
+            "product__inventory__location__retailer_id",
+        ).iterator(chunk_size=self.BATCH_SIZE):
+            for code in {variant["upc"], variant["sku"]} - {None, ""}:
+                codes.add(code)
+                rows.append(
+                    self.model(
+                        code=code,
+                        variant_id=variant["id"],
+                        product_id=variant["product_id"],
+                        retailer_id=variant["product__inventory__location__retailer_id"],
+                        price=variant["price"],
+                        stock=variant["stock"] or 0,
+                        total_stock=variant["product__total_stock"],
+                        is_active=variant["product__is_active"],
+                    )
+                )
+        self.model.objects.bulk_create(rows, batch_size=self.BATCH_SIZE)
+
+        ProductCardRepository().refresh_related_items(
+            codes, retailer_id=retailer_id, product_ids=product_ids
+        )
+        return codes
+
+    def get_offers(self, code: str, exclude_retailer_id=None, limit: int = 8) -> list:
+        """
+        Active priced offers of a UPC or SKU, cheapest first, one per product.
+        """
+        entries = self.model.objects.filter(code=code, is_active=True, price__gt=0)
+        if exclude_retailer_id is not None:
+            entries = entries.exclude(retailer_id=exclude_retailer_id)
+
+        offers = {}
+        for entry in entries.order_by("price", "-total_stock")[: limit * 2]:
+            offers.setdefault(entry.product_id, entry)
+        return list(offers.values())[:limit]
 
 
 class VariantRepository:
     def __init__(self) -> None:
         self.model = VariantModel
 
-    def update_or_create(self, variant: VariantModel) -> None:
-        exists = self.model.objects.filter(
-            origin_id=variant.origin_id,
-            product__inventory__id=variant.product.inventory.id,
-        ).exists()
+    def bulk_upsert(self, variants: list["ItemVariation"], products: dict) -> dict:
+        """
+        Insert or update the variations of a catalog page at every location
+        they are present at. `products` is the result of
+        `ProductRepository.bulk_upsert`. Returns the stored variants keyed by
+        (origin_id, pos_id).
+        """
+        rows = {}
+        for variant in variants:
+            for location_id in variant.locations or []:
+                product = products.get((variant.origin_parent_id, location_id))
+                if product is not None:
+                    rows[(variant.origin_id, location_id)] = (variant, product)
+
+        if not rows:
+            return {}
 
-        if not exists:
-            return variant.save()
-        else:
-            return self.model.objects.filter(origin_id=variant.origin_id).update(
-                origin_id=variant.origin_id,
-                origin_parent_id=variant.origin_parent_id,
-                name=variant.name,
-                sku=variant.sku,
-                price=variant.price,
-                currency=variant.currency,
-                stock=variant.stock,
+        existing = {
+            (variant.origin_id, variant.product_id): variant
+            for variant in self.model.objects.filter(
+                origin_id__in={origin_id for origin_id, _ in rows},
+                product__in={product.pk for _, product in rows.values()},
             )
+        }
+        now = timezone.now()
+        stored, to_create, to_update = {}, [], []
+        for (origin_id, location_id), (variant, product) in rows.items():
+            variant_db = existing.get((origin_id, product.pk))
+            if variant_db is None:
+                variant_db = self.model(origin_id=origin_id, product=product)
+                to_create.append(variant_db)
+            else:
+                to_update.append(variant_db)
+
+            variant_db.origin_parent_id = variant.origin_parent_id
+            variant_db.name = variant.name
+            variant_db.sku = variant.sku
+            variant_db.upc = variant.upc
+            variant_db.price = variant.price_at(location_id)
+            variant_db.currency = variant.currency
+            variant_db.updated_at = now
+            stored[(origin_id, location_id)] = variant_db
+
+        self.model.objects.bulk_create(to_create)
+        self.model.objects.bulk_update(
+            to_update,
+            [
+                "origin_parent_id",
+                "name",
+                "sku",
+                "upc",
+                "price",
+                "currency",
+                "updated_at",
+            ],
+        )
+        return stored
 
     def get_by_retailer_id(self, retailer_id: str):
         return self.model.objects.values(
@@ -104,6 +595,21 @@ class VariantRepository:
             product__inventory__location__retailer__id=retailer_id,
         )
 
+    def get_by_origin_ids(self, origin_ids, retailer_id) -> dict:
+        """
+        Variants of the retailer with the given origin ids, keyed both by
+        (origin_id, pos_id) and by origin_id alone for callers that do not
+        know the location.
+        """
+        variants = {}
+        for variant in self.model.objects.filter(
+            origin_id__in=list(origin_ids),
+            product__inventory__location__retailer__id=retailer_id,
+        ).annotate(pos_id=F("product__inventory__location__pos_id")):
+            variants[(variant.origin_id, variant.pos_id)] = variant
+            variants.setdefault(variant.origin_id, variant)
+        return variants
+
     def get_by_location_id(self, location_id, origin_id):
         return self.model.objects.filter(
             origin_id=origin_id,
@@ -125,18 +631,98 @@ class VariantRepository:
                 product__inventory__location__pos_id=location_id,
             ).update(stock=stock)
 
-    def delete_missing_variants(self, product, variant_ids: list):
-        variants_missing_pos = self.model.objects.filter(
-            product__origin_id=product.origin_id,
-            product__inventory__location__pos_id__in=product.locations,
-        ).exclude(origin_id__in=variant_ids)
-        variants_missing_pos.delete()
+    def bulk_update_stock(self, stocks: dict):
+        """
+        Write the stock of many variants at once. `stocks` maps variant ids to
+        their new (stock, calculated_at), so later webhook counts are compared
+        against the time of this count.
+        """
+        self.model.objects.bulk_update(
+            [
+                self.model(id=variant_id, stock=stock, stock_calculated_at=calculated_at)
+                for variant_id, (stock, calculated_at) in stocks.items()
+            ],
+            ["stock", "stock_calculated_at"],
+            batch_size=1000,
+        )
+
+    def apply_stock_counts(self, counts: dict, retailer_id) -> set:
+        """
+        Write POS stock counts of a retailer with a single bulk update.
+        `counts` maps (origin_id, pos_id) to (stock, calculated_at); counts
+        not newer than the one already applied to the variant are skipped.
+        Returns the ids of the products whose variants changed.
+        """
+        variants = self.get_by_origin_ids({origin_id for origin_id, _ in counts}, retailer_id)
+        updated = []
+        for key, (stock, calculated_at) in counts.items():
+            variant = variants.get(key)
+            if variant is None:
+                continue
+            applied_at = variant.stock_calculated_at
+            if calculated_at and applied_at and calculated_at <= applied_at:
+                continue
+            variant.stock = stock
+            variant.stock_calculated_at = calculated_at or applied_at
+            updated.append(variant)
+
+        self.model.objects.bulk_update(
+            updated, ["stock", "stock_calculated_at"], batch_size=1000
+        )
+        return {variant.product_id for variant in updated}
+
+    def pending_go_upc(self, retailer_id, after_id: int = 0, limit: int = 100) -> list:
+        """
+        Next variants of the retailer, by id, to enrich with Go UPC: the ones
+        without an image whose UPC or SKU changed since the last enrichment,
+        or whose code Go UPC didn't know and is due for a retry. The code is
+        set as `lookup_code`.
+        """
+        code = Coalesce(NullIf("upc", Value("")), NullIf("sku", Value("")))
+        expired_miss = UpcLookupModel.objects.filter(
+            code=OuterRef("lookup_code"), found=False, retry_after__lte=timezone.now()
+        )
+        has_image = VariantImageModel.objects.filter(
+            variant=OuterRef("pk"), image_id__isnull=False
+        )
+        return list(
+            self.model.objects.filter(
+                product__inventory__location__retailer_id=retailer_id,
+                is_modified_by_admin=False,
+                id__gt=after_id,
+            )
+            .annotate(lookup_code=code)
+            .filter(lookup_code__isnull=False)
+            .filter(~Exists(has_image))
+            .filter(
+                Q(go_upc_code__isnull=True)
+                | ~Q(go_upc_code=F("lookup_code"))
+                | Exists(expired_miss)
+            )
+            .order_by("id")[:limit]
+        )
+
+    def bulk_update_go_upc(self, variants: list):
+        """Save the description and Go UPC code of enriched variants."""
+        self.model.objects.bulk_update(variants, ["description", "go_upc_code"], batch_size=1000)
+
+    def delete_missing_variants(self, products: list, variant_ids: list):
+        """
+        Delete the variants of `products` that are not in `variant_ids`, i.e.
+        variations that were removed from the item in the POS.
+        """
+        self.model.objects.filter(product__in=products).exclude(
+            id__in=variant_ids
+        ).delete()
 
 
 class VarianImageRepository:
     def __init__(self) -> None:
         self.model = VariantImageModel
 
+    def get_by_image_ids(self, image_ids):
+        return self.model.objects.filter(image_id__in=image_ids)
+
     def update_or_create(self, data):
         exist = VariantImageModel.objects.filter(image_id=data["image_id"]).exists()
         if not exist:
@@ -145,6 +731,29 @@ class VarianImageRepository:
             )
 
 
+class UpcLookupRepository:
+    def __init__(self) -> None:
+        self.model = UpcLookupModel
+
+    def get_current(self, codes) -> dict:
+        """Stored Go UPC results keyed by code, leaving out misses due for a retry."""
+        return {
+            lookup.code: lookup
+            for lookup in self.model.objects.filter(code__in=list(codes)).exclude(
+                found=False, retry_after__lte=timezone.now()
+            )
+        }
+
+    def bulk_upsert(self, lookups: list) -> dict:
+        self.model.objects.bulk_create(
+            lookups,
+            update_conflicts=True,
+            unique_fields=["code"],
+            update_fields=["found", "description", "image_url", "retry_after", "updated_at"],
+        )
+        return {lookup.code: lookup for lookup in lookups}
+
+
 class InventoryRepository:
     def __init__(self) -> None:
         self.model = InventoryModel
@@ -155,6 +764,164 @@ class InventoryRepository:
     def get_by_pos_id(self, pos_id: str):
         return self.model.objects.get(location__pos_id=pos_id)
 
+    def get_by_pos_ids(self, pos_ids) -> dict:
+        return {
+            inventory.location.pos_id: inventory
+            for inventory in self.model.objects.select_related("location").filter(
+                location__pos_id__in=pos_ids
+            )
+        }
+
     def create(self, retailer_name: str, location: LocationModel):
         name = f"{retailer_name}  #{'{:06d}'.format(location.id)}"
         return self.model.objects.create(name=name, location=location)
+
+
+class OrderRepository:
+    def __init__(self) -> None:
+        self.model = OrderModel
+
+    def bulk_upsert(self, orders: list) -> dict:
+        """
+        Insert or update a page of POS orders. Each element is a dict of Order
+        field values with at least `origin_id`; fields left out keep their
+        stored value. Returns the stored orders keyed by origin_id.
+        """
+        orders = {order["origin_id"]: order for order in orders}
+        if not orders:
+            return {}
+
+        stored = self.model.objects.in_bulk(list(orders), field_name="origin_id")
+        now = timezone.now()
+        fields, to_create, to_update = {"updated_at"}, [], []
+        for data in orders.values():
+            order = stored.get(data["origin_id"])
+            if order is None:
+                order = self.model(**data)
+                stored[data["origin_id"]] = order
+                to_create.append(order)
+                continue
+
+            for field, value in data.items():
+                setattr(order, field, value)
+            order.updated_at = now
+            fields.update(data)
+            to_update.append(order)
+
+        self.model.objects.bulk_create(to_create)
+        for order in to_create:
+            order.order_code = "#{:06d}".format(order.id)
+
+        fields.discard("origin_id")
+        self.model.objects.bulk_update(to_update, sorted(fields))
+        self.model.objects.bulk_update(to_create, ["order_code"])
+        return stored
+
+    def replace_items(self, orders: list, items: list):
+        """
+        Swap the line items of `orders` for `items`. POS line items have no
+        stable key on our side, so they are rewritten as a whole.
+        """
+        OrderItemModel.objects.filter(order__in=orders).delete()
+        OrderItemModel.objects.bulk_create(items)
+
+    def bulk_upsert_pickups(self, pickups: list):
+        """
+        Insert or update pickup details keyed by the fulfillment origin_id.
+        Each element is a dict of OrderPickup field values.
+        """
+        pickups = {pickup["origin_id"]: pickup for pickup in pickups}
+        if not pickups:
+            return
+
+        stored = OrderPickupModel.objects.in_bulk(list(pickups), field_name="origin_id")
+        now = timezone.now()
+        to_create, to_update = [], []
+        for data in pickups.values():
+            pickup = stored.get(data["origin_id"])
+            if pickup is None:
+                to_create.append(OrderPickupModel(**data))
+                continue
+
+            for field, value in data.items():
+                setattr(pickup, field, value)
+            pickup.updated_at = now
+            to_update.append(pickup)
+
+        OrderPickupModel.objects.bulk_create(to_create)
+        OrderPickupModel.objects.bulk_update(
+            to_update, ["order", "pickup_time", "recipient_name", "updated_at"]
+        )
+
+
+class CustomerRepository:
+    def __init__(self) -> None:
+        self.model = CustomerModel
+
+    def get_by_origin_ids(self, origin_ids) -> dict:
+        return self.model.objects.in_bulk(list(origin_ids), field_name="origin_id")
+
+    def bulk_upsert(self, customers: list, fields: list):
+        """
+        Insert a page of POS customers, updating `fields` of the ones that
+        already exist by origin_id, in a single statement.
+        """
+        customers = list({customer.origin_id: customer for customer in customers}.values())
+        self.model.objects.bulk_create(
+            customers,
+            update_conflicts=True,
+            unique_fields=["origin_id"],
+            update_fields=[*fields, "updated_at"],
+        )
+
+
+class WebhookEventRepository:
+    BATCH_SIZE = 100
+
+    def __init__(self) -> None:
+        self.model = WebhookEventModel
+
+    def store(self, events: list):
+        """
+        Persist received events, skipping the ones already stored so POS
+        redeliveries are processed once.
+        """
+        self.model.objects.bulk_create(events, ignore_conflicts=True)
+
+    def _unprocessed(self, origin: str, merchant_id: str):
+        return self.model.objects.filter(
+            origin=origin,
+            merchant_id=merchant_id,
+            status__in=[self.model.STATUS_PENDING, self.model.STATUS_PROCESSING],
+        )
+
+    def pending(self, origin: str, merchant_id: str) -> list:
+        """Next unprocessed events of the merchant in the order they were received."""
+        return list(self._unprocessed(origin, merchant_id).order_by("id")[: self.BATCH_SIZE])
+
+    def has_pending(self, origin: str, merchant_id: str) -> bool:
+        return self._unprocessed(origin, merchant_id).exists()
+
+    def _update(self, events: list, **values):
+        self.model.objects.filter(id__in=[event.id for event in events]).update(
+            updated_at=timezone.now(), **values
+        )
+
+    def mark_processing(self, events: list):
+        self._update(events, status=self.model.STATUS_PROCESSING, attempts=F("attempts") + 1)
+
+    def mark_success(self, events: list):
+        self._update(
+            events, status=self.model.STATUS_SUCCESS, error=None, processed_at=timezone.now()
+        )
+
+    def mark_failed(self, events: list, error: str):
+        self._update(
+            events, status=self.model.STATUS_FAILED, error=error, processed_at=timezone.now()
+        )
+
+    def requeue(self, events) -> set:
+        """Mark `events` pending again. Returns the (origin, merchant_id) pairs to process."""
+        events = list(events)
+        self._update(events, status=self.model.STATUS_PENDING, error=None)
+        return {(event.origin, event.merchant_id) for event in events}
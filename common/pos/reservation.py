@@ -1,5 +1,6 @@
 from abc import ABC, abstractmethod
 import datetime
+from common.pos.repositories import ProductCardRepository
 from inventories.models import Reservation as ReservationModel, Variant as VariantModel
 from accounts.models import User as UserModel
 
@@ -57,6 +58,7 @@ class Reservation(AbstractReservation):
             reservation.version += 1
 
         reservation.save()
+        ProductCardRepository().refresh_for_variants([reservation.variant_id])
 
         return reservation
 
@@ -67,6 +69,7 @@ class Reservation(AbstractReservation):
         reservation = ReservationModel.objects.get(origin_id=data.get("origin_id"))
         reservation.status = "CANCELLED"
         reservation.save()
+        ProductCardRepository().refresh_for_variants([reservation.variant_id])
 
     def process(self, reservation):
         self.store(reservation)
@@ -1,12 +1,47 @@
 from square.client import Client
+from square.http.http_call_back import HttpCallBack
 
+from common.pos.rate_limit import RateLimiter
 from common.pos.utils import search
-from wyndo.settings import SQUARE_ENVIRONMENT
+from wyndo.settings import SQUARE_ENVIRONMENT, SQUARE_RATE_LIMIT
+
+
+class RateLimitCallBack(HttpCallBack):
+    """
+    Takes a token from the merchant's bucket before every call made by the
+    Square SDK.
+    """
+
+    def __init__(self, rate_limiter: RateLimiter, merchant_id):
+        self._rate_limiter = rate_limiter
+        self._merchant_id = merchant_id
+
+    def on_before_request(self, request):
+        self._rate_limiter.acquire(self._merchant_id)
+
+    def on_after_response(self, http_response):
+        pass
 
 
 class SquareRequestClient:
-    def __init__(self, access_token, cursor: str = None):
-        self.client = Client(access_token=access_token, environment=SQUARE_ENVIRONMENT)
+    # Maximum number of catalog object ids accepted by a single
+    # batch_retrieve_inventory_counts request
+    INVENTORY_COUNTS_BATCH_SIZE = 1000
+    # search_orders accepts up to 10 locations and returns up to 1000 orders
+    SEARCH_ORDERS_LOCATIONS_SIZE = 10
+    SEARCH_ORDERS_LIMIT = 500
+    LIST_CUSTOMERS_LIMIT = 100
+    RATE_LIMITER = RateLimiter("square", SQUARE_RATE_LIMIT)
+
+    def __init__(self, access_token, merchant_id: str = None, cursor: str = None):
+        http_call_back = (
+            RateLimitCallBack(self.RATE_LIMITER, merchant_id) if merchant_id else None
+        )
+        self.client = Client(
+            access_token=access_token,
+            environment=SQUARE_ENVIRONMENT,
+            http_call_back=http_call_back,
+        )
         self.cursor = cursor
 
     def get_catalog(self):
@@ -48,12 +83,14 @@ class SquareRequestClient:
             return catalog.body
 
     def search_catalog_by_date(self, updated_at):
-        catalog = self.client.catalog.search_catalog_objects(
-            body={
-                "begin_time": updated_at,
-                "include_deleted_objects": True,
-            }
-        )
+        body = {
+            "begin_time": updated_at,
+            "include_deleted_objects": True,
+        }
+        if self.cursor:
+            body["cursor"] = self.cursor
+
+        catalog = self.client.catalog.search_catalog_objects(body=body)
         if catalog.is_error():
             error = search(catalog.errors, "detail")
             raise Exception("[REQUEST CLIENT] " + error)
@@ -87,16 +124,66 @@ class SquareRequestClient:
             return inventory_counts.body
         return None
 
-    def list_orders(self, locations):
-        orders = self.client.orders.search_orders(
-            body={"location_ids": locations}
-        )
-        if orders.is_error():
-            raise Exception("[REQUEST CLIENT] " + str(orders.errors))
+    def get_inventory_counts(
+        self, catalog_ids: list = None, location_ids: list = None, updated_after: str = None
+    ):
+        """
+        Yield the IN_STOCK counts of up to INVENTORY_COUNTS_BATCH_SIZE catalog
+        objects at the given locations, following the response cursor. With
+        `updated_after` (RFC 3339) only counts changed since are returned.
+        """
+        body = {"states": ["IN_STOCK"]}
+        if catalog_ids is not None:
+            body["catalog_object_ids"] = catalog_ids
+        if location_ids is not None:
+            body["location_ids"] = location_ids
+        if updated_after:
+            body["updated_after"] = updated_after
+        while True:
+            inventory_counts = self.client.inventory.batch_retrieve_inventory_counts(
+                body
+            )
+
+            if inventory_counts.is_error():
+                error = search(inventory_counts.errors, "detail")
+                raise Exception("[REQUEST CLIENT] " + error)
+
+            yield from inventory_counts.body.get("counts", [])
+
+            cursor = inventory_counts.body.get("cursor")
+            if not cursor:
+                return
+            body["cursor"] = cursor
+
+    def list_orders(self, locations: list, updated_since: str = None):
+        """
+        Yield the orders of the locations one page at a time, oldest update
+        first, optionally only those updated since an RFC 3339 timestamp.
+        """
+        for i in range(0, len(locations), self.SEARCH_ORDERS_LOCATIONS_SIZE):
+            body = {
+                "location_ids": locations[i:i + self.SEARCH_ORDERS_LOCATIONS_SIZE],
+                "limit": self.SEARCH_ORDERS_LIMIT,
+                "query": {
+                    "sort": {"sort_field": "UPDATED_AT", "sort_order": "ASC"},
+                },
+            }
+            if updated_since:
+                body["query"]["filter"] = {
+                    "date_time_filter": {"updated_at": {"start_at": updated_since}}
+                }
 
-        if orders.is_success():
-            return orders.body
-        return None
+            while True:
+                orders = self.client.orders.search_orders(body=body)
+                if orders.is_error():
+                    raise Exception("[REQUEST CLIENT] " + str(orders.errors))
+
+                yield orders.body.get("orders", [])
+
+                cursor = orders.body.get("cursor")
+                if not cursor:
+                    break
+                body["cursor"] = cursor
 
     def get_order(self, order_id):
         order = self.client.orders.retrieve_order(order_id)
@@ -131,10 +218,20 @@ class SquareRequestClient:
         return None
 
     def list_customers(self):
-        customers = self.client.customers.list_customers()
-        if customers.is_error():
-            error = search(customers.errors, "detail")
-            raise Exception("[REQUEST CLIENT] " + error)
-
-        if customers.is_success():
-            return customers.body
+        """
+        Yield the merchant's customers one page at a time.
+        """
+        cursor = None
+        while True:
+            customers = self.client.customers.list_customers(
+                cursor=cursor, limit=self.LIST_CUSTOMERS_LIMIT
+            )
+            if customers.is_error():
+                error = search(customers.errors, "detail")
+                raise Exception("[REQUEST CLIENT] " + error)
+
+            yield customers.body.get("customers", [])
+
+            cursor = customers.body.get("cursor")
+            if not cursor:
+                return
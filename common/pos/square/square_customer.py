@@ -1,5 +1,6 @@
 import logging
 
+from common.pos.repositories import CustomerRepository
 from common.pos.square.square_client import SquareRequestClient
 from inventories.models import Customer
 
@@ -12,26 +13,41 @@ class SquareCustomer:
         raw_customer = payload["customer"]
         SquareCustomer.store(raw_customer, retailer)
 
+    FIELDS = [
+        "retailer",
+        "first_name",
+        "last_name",
+        "email",
+        "phone",
+        "address1",
+        "city",
+        "zip_code",
+        "country",
+        "state",
+    ]
+
     @staticmethod
     def store(raw_customer, retailer):
-        _id = raw_customer["id"]
-        customer = Customer.objects.filter(origin_id=_id).first()
-        if not customer:
-            customer = retailer.customers.create(origin_id=_id)
-
-        customer.retailer = retailer
-        customer.first_name = raw_customer.get("given_name")
-        customer.last_name = raw_customer.get("family_name")
-        customer.origin_id = _id
-        customer.email = raw_customer.get("email_address")
-        customer.phone = raw_customer.get("phone_number")
+        CustomerRepository().bulk_upsert(
+            [SquareCustomer.map_customer(raw_customer, retailer)], SquareCustomer.FIELDS
+        )
+
+    @staticmethod
+    def map_customer(raw_customer, retailer) -> Customer:
         address = raw_customer.get("address", {})
-        customer.address1 = address.get("address_line_1", "")
-        customer.city = address.get("locality", "")
-        customer.zip_code = address.get("postal_code", "")
-        customer.country = address.get("country", "")
-        customer.state = address.get("administrative_district_level_1", "")
-        customer.save()
+        return Customer(
+            origin_id=raw_customer["id"],
+            retailer=retailer,
+            first_name=raw_customer.get("given_name") or "",
+            last_name=raw_customer.get("family_name") or "",
+            email=raw_customer.get("email_address"),
+            phone=raw_customer.get("phone_number"),
+            address1=address.get("address_line_1", ""),
+            city=address.get("locality", ""),
+            zip_code=address.get("postal_code", ""),
+            country=address.get("country", ""),
+            state=address.get("administrative_district_level_1", ""),
+        )
 
     @staticmethod
     def delete_customer(retailer, payload):
@@ -44,18 +60,18 @@ class SquareCustomer:
             logger.error(f"Access token not found for retailer: {retailer.merchant_id}")
             return
 
-        client = SquareRequestClient(retailer.access_token)
+        client = SquareRequestClient(retailer.access_token, retailer.merchant_id)
+        repository = CustomerRepository()
         try:
-            list_response = client.list_customers()
+            for page in client.list_customers():
+                customers = []
+                for customer in page:
+                    try:
+                        customers.append(SquareCustomer.map_customer(customer, retailer))
+                    except Exception as e:
+                        logger.error(f"Error parsing customer {customer.get('id')} for Square,"
+                                     f" retailer id {retailer.id}, exception {e}")
+                repository.bulk_upsert(customers, SquareCustomer.FIELDS)
         except Exception as e:
             # TODO: Send email to admin with the error
-            logger.error(f"Error Loading customer for Square, retailer id {retailer.id}, exception", e)
-            return
-
-        customers = list_response.get('customers', [])
-        for customer in customers:
-            try:
-                SquareCustomer.store(customer, retailer)
-            except Exception as e:
-                logger.error(f"Error parsing customer {customer['id']} for Square,"
-                             f" retailer id {retailer.id}, exception {e}")
+            logger.error(f"Error Loading customer for Square, retailer id {retailer.id}, exception {e}")
@@ -1,27 +1,33 @@
 import json
 import logging
 import traceback
-from datetime import datetime
+from datetime import datetime, timedelta
 
-from django.core.paginator import Paginator
 from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
+from common.catalog_cache import CatalogCache
 from common.pos.repositories import (
+    ProductCardRepository,
     ProductRepository,
     VarianImageRepository,
     VariantRepository,
     InventoryRepository,
 )
 from common.pos.square.square_client import SquareRequestClient
-from common.pos.utils import format_price
-from inventories.models import Product, Variant, Category, VariantImage
+from common.pos.utils import to_rfc3339
+from inventories.models import Category, VariantImage
 from retailer.models import Retailer as RetailerModel
 from .square_mapper import Item, ItemVariation, SquareInventoryMapper
-from ...goupc import GoUPC
+from ...goupc import GoUPC, GoUpcEnrichment
 
 
 class SquareInventory:
     PLATFORM = "SQUARE"
+    IN_STOCK = "IN_STOCK"
+    # Watermarks older than this trigger a full catalog sync instead of a delta
+    DELTA_SYNC_MAX_AGE = timedelta(days=7)
 
     def __init__(self, retailer: RetailerModel, cursor: str = None):
         self._retailer = retailer
@@ -30,13 +36,18 @@ class SquareInventory:
         self.variant_repository = VariantRepository()
         self.inventory_repository = InventoryRepository()
         self.variant_image_repository = VarianImageRepository()
-        self._request_client = SquareRequestClient(retailer.access_token)
+        self.product_card_repository = ProductCardRepository()
+        self._request_client = SquareRequestClient(
+            retailer.access_token, retailer.merchant_id
+        )
         self._go_upc_client = GoUPC()
         self._cursor: str = cursor
 
-    def fetch(self, updated_at: str = ""):
+    def fetch(self, updated_at: str = "", cursor: str = None):
         request_client = SquareRequestClient(
-            self._retailer.access_token, cursor=self._cursor
+            self._retailer.access_token,
+            self._retailer.merchant_id,
+            cursor=cursor or self._cursor,
         )
         return (
             request_client.get_catalog()
@@ -47,68 +58,98 @@ class SquareInventory:
     def get_locations(self):
         return self._retailer.location_set.all()
 
-    def create_or_update_product(self, product: Item, location_id: str):
-        inventory = self.inventory_repository.get_by_pos_id(location_id)
-        product_obj = Product(
-            origin=self.PLATFORM,
-            origin_id=product.origin_id,
-            name=product.name,
-            inventory=inventory,
-        )
-        product = self.product_repository.update_or_create(product_obj)
-        return product
-
-    def create_or_update_variant(self, variant: ItemVariation, product: Product):
-        variant_obj = Variant(
-            origin_id=variant.origin_id,
-            origin_parent_id=variant.origin_parent_id,
-            name=variant.name,
-            sku=variant.sku,
-            upc=variant.upc,
-            price=variant.price,
-            currency=variant.currency,
-            product=product,
-        )
-        return self.variant_repository.update_or_create(variant_obj)
-
-    def create_or_update_variant_images(self, variant_item: ItemVariation):
-        image_ids = variant_item.image_ids
-        variant = Variant.objects.filter(origin_id=variant_item.origin_id).first()
-        unsaved_images = []
-        for image_id in image_ids:
-            image = VariantImage.objects.filter(image_id=image_id).first()
-            if image:
-                image.variant = variant
-                image.save()
-            else:
-                unsaved_images.append(image_id)
+    def store_variant_images(
+        self, variants: list[ItemVariation], stored_variants: dict
+    ):
+        """
+        Attach the catalog images of a page of variations, downloading the
+        ones that are not stored yet with a single catalog request.
+        """
+        image_variants = {}
+        for variant in variants:
+            variant_db = next(
+                (
+                    stored_variants[(variant.origin_id, location_id)]
+                    for location_id in variant.locations or []
+                    if (variant.origin_id, location_id) in stored_variants
+                ),
+                None,
+            )
+            if variant_db is None:
+                continue
+            for image_id in variant.image_ids:
+                image_variants[image_id] = variant_db
 
-        if len(unsaved_images) == 0:
+        if not image_variants:
             return
-        catalog_response = self._request_client.batch_retrieve_catalog_objects(unsaved_images)
+
+        changed_images = []
+        images = self.variant_image_repository.get_by_image_ids(list(image_variants))
+        for image in images:
+            variant_db = image_variants.pop(image.image_id, None)
+            if variant_db is not None and image.variant_id != variant_db.pk:
+                image.variant = variant_db
+                changed_images.append(image)
+        VariantImage.objects.bulk_update(changed_images, ["variant"])
+
+        if not image_variants:
+            return
+        catalog_response = self._request_client.batch_retrieve_catalog_objects(
+            list(image_variants)
+        )
         for obj in catalog_response.get("objects", []):
             new_image = VariantImage(
-                variant=variant,
+                variant=image_variants[obj.get("id")],
                 image_id=obj.get("id"),
             )
-            # new_image.save()
             new_image.get_image_from_url(obj.get("image_data", {}).get("url"))
             new_image.save()
 
+    def store_variant_categories(self, products: list[Item], stored_variants: dict):
+        """
+        Replace the category links of a page of variations with a single
+        through-table write, fetching unknown categories in one request.
+        """
+        category_ids = {product.category_id for product in products if product.category_id}
+        categories = {
+            category.origin_id: category
+            for category in Category.objects.filter(
+                origin_id__in=category_ids, retailer=self._retailer
+            )
+        }
+        missing_ids = category_ids - categories.keys()
+        if missing_ids:
+            catalog_response = self._request_client.batch_retrieve_catalog_objects(
+                list(missing_ids)
+            )
+            for obj in catalog_response.get("objects", []):
+                categories[obj.get("id")] = self.create_or_update_category(obj)
+
+        through = Category.variants.through
+        links = []
+        for product in products:
+            category = categories.get(product.category_id)
+            if category is None:
+                continue
+            for variant in product.variants:
+                for location_id in variant.locations or []:
+                    variant_db = stored_variants.get((variant.origin_id, location_id))
+                    if variant_db is not None:
+                        links.append(
+                            through(category_id=category.pk, variant_id=variant_db.pk)
+                        )
+
+        through.objects.filter(
+            variant_id__in=[variant_db.pk for variant_db in stored_variants.values()]
+        ).delete()
+        through.objects.bulk_create(links, ignore_conflicts=True)
+
     def update_variant_stock(
         self, retailer_id: str = "", origin_id: str = "", location_id: str = ""
     ):
         if retailer_id:
             variants = self.variant_repository.get_by_retailer_id(retailer_id)
-            for variant in variants:
-                stock = self._request_client.get_stock(
-                    variant["origin_id"], variant["pos_id"]
-                )
-                if stock:
-                    variant_stock = int(stock.get("counts", [])[0].get("quantity", 0))
-                    self.variant_repository.update_stock(
-                        variant_id=variant["id"], stock=variant_stock
-                    )
+            self.refresh_variant_stock(variants)
         elif origin_id and location_id:
             stock = self._request_client.get_stock(origin_id, location_id)
             if stock:
@@ -119,6 +160,35 @@ class SquareInventory:
                     location_id=location_id,
                 )
 
+    def refresh_variant_stock(self, variants):
+        """
+        Refresh the stock of `variants` (dicts with id, origin_id and pos_id)
+        with batched inventory count requests and a single bulk update.
+        """
+        variant_ids = {}
+        for variant in variants:
+            key = (variant["origin_id"], variant["pos_id"])
+            variant_ids.setdefault(key, []).append(variant["id"])
+
+        origin_ids = sorted({origin_id for origin_id, _ in variant_ids})
+        location_ids = sorted({location_id for _, location_id in variant_ids})
+        batch_size = self._request_client.INVENTORY_COUNTS_BATCH_SIZE
+
+        stocks = {}
+        for start in range(0, len(origin_ids), batch_size):
+            counts = self._request_client.get_inventory_counts(
+                origin_ids[start:start + batch_size], location_ids
+            )
+            for count in counts:
+                key = (count.get("catalog_object_id"), count.get("location_id"))
+                stock = int(float(count.get("quantity", 0)))
+                calculated_at = parse_datetime(count.get("calculated_at") or "")
+                for variant_id in variant_ids.get(key, []):
+                    stocks[variant_id] = (stock, calculated_at)
+
+        self.variant_repository.bulk_update_stock(stocks)
+        return stocks
+
     def create_or_update_images(self, image, image_id, variant=None):
         self.variant_image_repository.update_or_create(
             {
@@ -159,99 +229,83 @@ class SquareInventory:
             category = self.create_or_update_category(category_data)
         return category
 
+    @transaction.atomic
+    def store_page(self, products: list[Item]):
+        """
+        Persist a page of catalog items with a constant number of queries.
+        Returns the stored products and variants keyed by (origin_id, pos_id).
+        """
+        location_ids = {
+            location_id for product in products for location_id in product.locations or []
+        }
+        inventories = self.inventory_repository.get_by_pos_ids(location_ids)
+        variants = [variant for product in products for variant in product.variants]
+
+        stored_products = self.product_repository.bulk_upsert(products, inventories)
+        stored_variants = self.variant_repository.bulk_upsert(variants, stored_products)
+        self.store_variant_images(variants, stored_variants)
+        self.store_variant_categories(products, stored_variants)
+        return stored_products, stored_variants
+
     def store(self, products: list[Item]):
         self.create_inventories()
-        for product in products:
-            logging.info(f"Processing for product: {product.name},"
-                         f" id: {product.origin_id}, "
-                         f"variants: {len(product.variants)}")
-            for location_id in product.locations:
-                self.create_or_update_product(product, location_id)
+        logging.info(f"Processing {len(products)} products")
+        stored_products, _ = self.store_page(products)
+        product_ids = [product.pk for product in stored_products.values()]
+        self.product_repository.update_totals(self._retailer.id, product_ids=product_ids)
+        self.product_card_repository.refresh_listings(self._retailer.id, product_ids)
+        logging.info("Products stored successfully")
 
-            for variant in product.variants:
-                for location_id in variant.locations:
-                    product_exists = self.product_repository.check_product_exists(
-                        variant.origin_parent_id, location_id
-                    )
-
-                    for location in variant.location_overrides:
-                        if location.get(
-                            "location_id"
-                        ) == location_id and location.get("price_money"):
-                            variant.price = format_price(
-                                location.get("price_money").get("amount")
-                            )
-
-                    self.create_or_update_variant(variant, product_exists)
-                    self.create_or_update_variant_images(variant)
-
-                self._process_variant_category(variant, product)
-
-            if len(product.variants) > 1:
-                self.product_repository.update_min_max_price(
-                    self._retailer.id, product.origin_id
+    def finish_sync(self, updated_since: datetime = None):
+        """
+        Refresh stock levels and product totals once the last catalog page of
+        a sync has been stored. Catalog deltas don't include stock
+        adjustments, so a delta sync applies the counts Square changed since
+        `updated_since`.
+        """
+        if updated_since is not None:
+            self.apply_stock_counts(
+                self._request_client.get_inventory_counts(
+                    updated_after=to_rfc3339(updated_since)
                 )
+            )
+            return
 
         self.update_variant_stock(retailer_id=self._retailer.id)
-
-        self.product_repository.update_total_stock(self._retailer.id)
-        logging.info("Products stored successfully")
+        product_ids = self.product_repository.update_totals(self._retailer.id)
+        self.product_card_repository.refresh_listings(self._retailer.id, product_ids)
 
     def store_update(self, products: list[Item]):
+        """
+        Store a catalog delta in one transaction, then refresh the stock and
+        totals of only the variants and products in the delta.
+        """
         self.create_inventories()
         deleted_products = [product for product in products if product.is_deleted]
 
         with transaction.atomic():
             # Delete products in `deleted_products` list
-            self.product_repository.delete_products(deleted_products)
+            if self.product_repository.delete_products(deleted_products):
+                transaction.on_commit(CatalogCache.bump)
 
             current_products = [
                 product for product in products if not product.is_deleted
             ]
-            for product in current_products:
-                for location_id in product.locations:
-                    self.create_or_update_product(product, location_id)
-                for variant in product.variants:
-                    for location_id in variant.locations:
-                        product_exists = self.product_repository.check_product_exists(
-                            variant.origin_parent_id, location_id
-                        )
-                        for location in variant.location_overrides:
-                            if location.get(
-                                "location_id"
-                            ) == location_id and location.get("price_money"):
-                                variant.price = format_price(
-                                    location.get("price_money").get("amount")
-                                )
-
-                        self.create_or_update_variant(variant, product_exists)
-                    self._process_variant_category(variant, product)
-                variant_ids = [variant.origin_id for variant in product.variants]
-                self.variant_repository.delete_missing_variants(
-                    product=product, variant_ids=variant_ids
-                )
-
-                if len(product.variants) > 1:
-                    self.product_repository.update_min_max_price(
-                        self._retailer.id, product.origin_id
-                    )
-
-            self.update_variant_stock(retailer_id=self._retailer.id)
-
-            self.product_repository.update_total_stock(self._retailer.id)
+            stored_products, stored_variants = self.store_page(current_products)
+            self.variant_repository.delete_missing_variants(
+                products=list(stored_products.values()),
+                variant_ids=[variant.pk for variant in stored_variants.values()],
+            )
 
-    def _process_variant_category(self, variant, product):
-        variant_db = Variant.objects.filter(
-            origin_id=variant.origin_id,
-        ).first()
-        variant_db.categories.clear()
-        category_id = product.category_id
-        category = None
-        if category_id:
-            category = self.retrieve_category_by_id(category_id)
-        if category:
-            category.variants.add(variant_db)
-            category.save()
+        # Square is called after the delta commits so its rows aren't locked
+        # while the counts are fetched
+        self.refresh_variant_stock(
+            {"id": variant.pk, "origin_id": origin_id, "pos_id": pos_id}
+            for (origin_id, pos_id), variant in stored_variants.items()
+        )
+        product_ids = [product.pk for product in stored_products.values()]
+        self.product_repository.update_totals(self._retailer.id, product_ids=product_ids)
+        self.product_card_repository.refresh_listings(self._retailer.id, product_ids)
 
     def map_data(self, products):
         locations = self.get_locations()
@@ -274,14 +328,35 @@ class SquareInventory:
         else:
             self.store_update(mapped_data)
 
-    def run(self):
+    def process_updates(self, data):
+        objects = data.get("objects", [])
+        categories = [o for o in objects if o.get("type") == "CATEGORY"]
+        self.handle_categories_update(categories)
+        self.process(data, update=True)
+
+    def delta_sync_since(self):
+        """
+        Return the watermark to delta sync the catalog from, or None when a
+        full sync is needed because the watermark is missing or stale.
+        """
+        synced_at = self._retailer.inventory_synced_at
+        if synced_at is None or timezone.now() - synced_at > self.DELTA_SYNC_MAX_AGE:
+            return None
+        return synced_at
+
+    def run(self, updated_since: datetime = None):
         try:
-            data = self.fetch()
-            cursor = data.get("cursor", None)
+            updated_at = to_rfc3339(updated_since) if updated_since else ""
+            data = self.fetch(updated_at=updated_at)
             if not data:
+                self.finish_sync(updated_since)
                 return {"result": True, "fetch_next": False}
 
-            self.process(data)
+            cursor = data.get("cursor", None)
+            if updated_at:
+                self.process_updates(data)
+            else:
+                self.process(data)
 
             if cursor is not None:
                 return {
@@ -290,6 +365,8 @@ class SquareInventory:
                     "retailer_id": self._retailer.pk,
                     "cursor": cursor,
                 }
+
+            self.finish_sync(updated_since)
             return {"result": True, "fetch_next": False}
 
         except Exception as e:
@@ -309,79 +386,52 @@ class SquareInventory:
                 parsed_date.replace(microsecond=0).isoformat(timespec="milliseconds")
             )
             logging.info(f"New parsed date: {parsed_date}")
-            data = self.fetch(updated_at=parsed_date)
-            logging.info(json.dumps(data, indent=4))
-            objects = data.get("objects", [])
-            categories = [o for o in objects if o.get("type") == "CATEGORY"]
-            self.handle_categories_update(categories)
-            self.process(data, update=True)
+            cursor = None
+            while True:
+                data = self.fetch(updated_at=parsed_date, cursor=cursor)
+                logging.info(f"Processing {len(data.get('objects', []))} updated catalog objects")
+                self.process_updates(data)
+                cursor = data.get("cursor")
+                if not cursor:
+                    break
         except Exception as e:
-            traceback.print_exc()
+            # Raised so the webhook event is recorded as failed and retried
             logging.error("SQUARE INVENTORY: %s" % e)
+            raise
 
     def webhook_update_variant_stock(self, body: dict):
-        for inventory_count in body.get("inventory_counts", []):
-            catalog_object_id = inventory_count.get("catalog_object_id")
-            location_id = inventory_count.get("location_id")
-            self.update_variant_stock(
-                origin_id=catalog_object_id, location_id=location_id
+        """
+        Apply the counts of inventory.count.updated events. The payload has
+        the new quantities, so Square isn't called.
+        """
+        self.apply_stock_counts(body.get("inventory_counts", []))
+
+    def apply_stock_counts(self, inventory_counts):
+        """
+        Write Square inventory counts: only the latest count of each
+        variation and location is kept and the totals of the affected
+        products recomputed.
+        """
+        counts = {}
+        for inventory_count in inventory_counts:
+            if inventory_count.get("state", self.IN_STOCK) != self.IN_STOCK:
+                continue
+            key = (
+                inventory_count.get("catalog_object_id"),
+                inventory_count.get("location_id"),
+            )
+            calculated_at = parse_datetime(inventory_count.get("calculated_at") or "")
+            latest = counts.get(key)
+            if latest and latest[1] and calculated_at and calculated_at < latest[1]:
+                continue
+            counts[key] = (int(float(inventory_count.get("quantity") or 0)), calculated_at)
+
+        product_ids = self.variant_repository.apply_stock_counts(counts, self._retailer.id)
+        if product_ids:
+            product_ids = self.product_repository.update_totals(
+                self._retailer.id, product_ids=product_ids
             )
+            self.product_card_repository.refresh_listings(self._retailer.id, product_ids)
 
-    @transaction.atomic
     def map_go_upc(self) -> None:
-        variants = (
-            Variant.objects.order_by("id")
-            .filter(product__inventory__location__retailer=self._retailer)
-            .exclude(variantimage__image_id__isnull=False)
-            .all()
-        )
-        paginator = Paginator(variants, 10)
-        for page_number in paginator.page_range:
-            page = paginator.page(page_number)
-
-            for variant in page.object_list:
-                upc = None
-                if variant.upc:
-                    upc = variant.upc
-                elif variant.sku:
-                    upc = variant.sku
-
-                if upc is None or variant.is_modified_by_admin:
-                    continue
-
-                go_upc_information = {}
-                try:
-                    go_upc_information = self._go_upc_client.get_product_information(
-                        upc
-                    )
-                    if len(go_upc_information) == 0:
-                        logging.info(f"No information found for {variant.pk}")
-                        continue
-                except Exception as e:
-                    logging.error(f"Error fetching Go UPC Information with upc {upc}")
-                    logging.error(e)
-
-                go_upc_description = go_upc_information.get("description")
-
-                if go_upc_description and go_upc_description != "No description found.":
-                    variant.description = go_upc_description
-
-                variant.save()
-
-                try:
-                    image_name, image = self._go_upc_client.get_product_image_from_url(
-                        go_upc_information.get("imageUrl"), upc
-                    )
-                    if image is None:
-                        logging.info(f"No image found for {variant.pk}")
-                        continue
-
-                    self.create_or_update_images(
-                        variant=variant,
-                        image=image,
-                        image_id=f"{image_name}_{variant.id}",
-                    )
-
-                except Exception as e:
-                    logging.error(f"Error fetching Go UPC Image with upc {upc}")
-                    logging.error(e)
+        GoUpcEnrichment(self._retailer.id).run()
@@ -1,3 +1,6 @@
+from common.pos.utils import format_price
+
+
 class Item:
     def __init__(self, data: dict):
         item_data: dict = data.get("item_data", {})
@@ -47,6 +50,14 @@ class ItemVariation:
         self.location_overrides = variation_data.location_overrides
         self.image_ids = variation_data.image_ids
 
+    def price_at(self, location_id: str):
+        for location in self.location_overrides:
+            if location.get("location_id") == location_id and location.get(
+                "price_money"
+            ):
+                return format_price(location.get("price_money").get("amount"))
+        return self.price
+
     def __str__(self):
         return f"""
         ItemVariation:
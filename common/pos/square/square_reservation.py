@@ -1,12 +1,14 @@
 from logging import error as error_log
 
 from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
+from common.pos.repositories import CustomerRepository, OrderRepository, VariantRepository
 from common.pos.reservation import Reservation
-from common.pos.square import SquareInventory
 from common.pos.square.square_client import SquareRequestClient
-from common.pos.utils import format_price
-from inventories.models import Order as OrderModel, Customer, Variant, OrderItem, OrderPickup
+from common.pos.utils import format_price, to_rfc3339
+from inventories.models import OrderItem
 from retailer.models import Location
 
 
@@ -19,6 +21,9 @@ class SquareReservation(Reservation):
         self._request_client = SquareRequestClient(
             retailer.access_token, retailer.merchant_id
         )
+        self.order_repository = OrderRepository()
+        self.customer_repository = CustomerRepository()
+        self.variant_repository = VariantRepository()
 
     def post(self, payload):
         return self._request_client.create_order(payload.get("order_params"))
@@ -79,82 +84,144 @@ class SquareReservation(Reservation):
             error_log("SQUARE ORDER: %s" % e)
 
     def fetch_all_orders(self):
+        """
+        Page through the orders updated since the last successful order sync,
+        or the whole history on the first run, storing one page at a time.
+        The sync time is held back to the earliest order that failed to map so
+        the next run retries it.
+        """
+        started_at = timezone.now()
+        synced_at = self._retailer.orders_synced_at
         locations = Location.objects.filter(retailer=self._retailer).values_list(
             'pos_id', flat=True
         )
-        rs = self._request_client.list_orders(list(locations))
-        all_orders = rs.get("orders", [])
-        for order in all_orders:
-            order_id = order.get("order_id")
-            try:
-                self.sync_from_square(order_id, order)
-            except Exception as e:
-                error_log("SQUARE ORDER: %s" % e)
+        pages = self._request_client.list_orders(
+            list(locations), updated_since=to_rfc3339(synced_at) if synced_at else None
+        )
+        synced_at = started_at
+        for orders in pages:
+            failed_at = self.store_orders(orders)
+            if failed_at is not None:
+                synced_at = min(synced_at, failed_at)
+
+        self._retailer.update_orders_synced_at(synced_at)
 
     def sync_from_square(self, order_id, order=None):
         order = self._request_client.get_order(order_id).get("order") if not order else order
         if not order:
             return
 
-        new_order, _created = OrderModel.objects.get_or_create(
-            origin_id=order.get("id"), retailer=self._retailer
+        self.store_orders([order])
+
+    @transaction.atomic
+    def store_orders(self, orders: list):
+        """
+        Store a page of Square orders. Returns the earliest `updated_at` of
+        the orders that failed to map, or None.
+        """
+        customers = self.customer_repository.get_by_origin_ids(
+            {order["customer_id"] for order in orders if order.get("customer_id")}
+        )
+        variants = self.variant_repository.get_by_origin_ids(
+            {
+                line_item["catalog_object_id"]
+                for order in orders
+                for line_item in order.get("line_items", [])
+                if line_item.get("catalog_object_id")
+            },
+            self._retailer.id,
+        )
+
+        mapped_orders, pickups, line_items = [], [], {}
+        failed_at = None
+        for order in orders:
+            try:
+                mapped_order = self.map_order(order, customers)
+                order_pickups = self.map_pickups(order)
+                order_items = self.map_line_items(order, variants)
+            except Exception as e:
+                error_log("SQUARE ORDER: %s" % e)
+                updated_at = parse_datetime(order.get("updated_at") or "")
+                if updated_at and (failed_at is None or updated_at < failed_at):
+                    failed_at = updated_at
+                continue
+            mapped_orders.append(mapped_order)
+            pickups.extend(order_pickups)
+            line_items[order["id"]] = order_items
+
+        stored_orders = self.order_repository.bulk_upsert(
+            [
+                {**order, "quantity": sum(item.quantity for item in line_items[order["origin_id"]])}
+                for order in mapped_orders
+            ]
         )
-        new_order.subtotal = format_price(order.get('total_money', {}).get('amount'))
-        new_order.tax = format_price(order.get('total_tax_money', {}).get('amount'))
+
+        items = []
+        for origin_id, order_items in line_items.items():
+            for item in order_items:
+                item.order = stored_orders[origin_id]
+                items.append(item)
+        self.order_repository.replace_items(list(stored_orders.values()), items)
+
+        for pickup in pickups:
+            pickup["order"] = stored_orders[pickup.pop("order_origin_id")]
+        self.order_repository.bulk_upsert_pickups(pickups)
+        return failed_at
+
+    def map_order(self, order, customers: dict) -> dict:
         net_amount = order.get('net_amounts', {}).get('total_money')
-        new_order.total = format_price(net_amount.get('amount'))
-        new_order.currency = net_amount.get('currency')
-        new_order.status = order["state"]
-        new_order.order_time = order.get('created_at')
-        new_order.retailer = self._retailer
-        new_order.origin = self.PLATFORM
-        new_order.version = order.get("version", 1)
-        new_order.order_code = "#{:06d}".format(new_order.id)
-        if order.get("customer_id"):
-            customer = Customer.objects.filter(origin_id=order.get("customer_id")).first()
-            if customer:
-                new_order.customer = customer
-        new_order.save()
-
-        fulfillments = order.get("fulfillments", [])
-        for fulfillment in fulfillments:
-            if fulfillment.get("pickup_details"):
-                reservation_pickup, _created = OrderPickup.objects.get_or_create(
-                    origin_id=fulfillment.get("uid"),
-                    order=new_order
+        mapped_order = {
+            "origin_id": order["id"],
+            "subtotal": format_price(order.get('total_money', {}).get('amount')),
+            "tax": format_price(order.get('total_tax_money', {}).get('amount')),
+            "total": format_price(net_amount.get('amount')),
+            "currency": net_amount.get('currency'),
+            "status": order["state"],
+            "order_time": order.get('created_at'),
+            "retailer": self._retailer,
+            "origin": self.PLATFORM,
+            "version": order.get("version", 1),
+        }
+        customer = customers.get(order.get("customer_id"))
+        if customer:
+            mapped_order["customer"] = customer
+        return mapped_order
+
+    def map_pickups(self, order) -> list:
+        pickups = []
+        for fulfillment in order.get("fulfillments", []):
+            pickup_details = fulfillment.get("pickup_details")
+            if pickup_details:
+                pickups.append(
+                    {
+                        "origin_id": fulfillment.get("uid"),
+                        "order_origin_id": order["id"],
+                        "pickup_time": pickup_details.get("pickup_at"),
+                        "recipient_name": pickup_details.get("recipient", {}).get("display_name"),
+                    }
                 )
-                pickup_details = fulfillment.get("pickup_details")
-                reservation_pickup.pickup_time = pickup_details.get("pickup_at")
-                reservation_pickup.recipient_name = pickup_details.get("recipient",{}).get("display_name")
-                reservation_pickup.save()
+        return pickups
 
-        total_quantity = 0
-        new_order.order_items.all().delete()
+    def map_line_items(self, order, variants: dict) -> list:
+        items = []
         for line_item in order.get("line_items", []):
-            item_id = line_item.get("catalog_object_id")
-            quantity = line_item.get("quantity")
-            variant = Variant.objects.filter(origin_id=item_id).first()
             item_type = line_item.get('item_type')
+            variant = variants.get(
+                (line_item.get("catalog_object_id"), order.get("location_id"))
+            ) or variants.get(line_item.get("catalog_object_id"))
             if item_type == "CUSTOM_AMOUNT":
-                item, _created = OrderItem.objects.get_or_create(
-                    order=new_order, item_type=OrderItem.TYPE_CUSTOM_AMOUNT
-                )
-                item.quantity = quantity
+                item = OrderItem(item_type=OrderItem.TYPE_CUSTOM_AMOUNT)
             elif variant and item_type == "ITEM":
-                item, _created = OrderItem.objects.get_or_create(
-                    order=new_order, variant=variant, quantity=quantity
-                )
+                item = OrderItem(variant=variant)
             else:
                 continue
+            item.quantity = int(float(line_item.get("quantity")))
             item.unit_price = format_price(line_item.get("base_price_money", {}).get("amount"))
             item.variation_total = format_price(line_item.get("variation_total_price_money", {}).get("amount"))
             item.tax = format_price(line_item.get("total_tax_money", {}).get("amount"))
             item.total_price = format_price(line_item.get("total_money", {}).get("amount"))
-            item.save()
-            total_quantity += int(quantity)
-
-        new_order.quantity = total_quantity
-        new_order.save()
+            items.append(item)
+        return items
 
 
 class SquareOrderMapper:
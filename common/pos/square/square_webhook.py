@@ -1,12 +1,9 @@
-import json
-
-from django.core.cache import cache
-
 from common.pos.square import SquareInventory
 from common.pos.square.square_customer import SquareCustomer
 from common.pos.square.square_location import SquareLocation
 from common.pos.square.square_reservation import SquareReservation
-from inventories.tasks import process_square_catalog_event
+from inventories.models import WebhookEvent
+from inventories.tasks import run_go_upc_integration
 from retailer.models import Retailer
 
 
@@ -26,27 +23,91 @@ class SquareWebhook:
         "order.fulfillment.updated": "OrderFulfillmentUpdated",
     }
 
-    def process_events(
-        self, merchant_id: str, event_id: str, event_type: str, body: dict
-    ) -> None:
-        event_trace = {
-            "event_id": event_id,
-            "event_type": event_type,
-            "status": "PROCESS",
-        }
-        cache.set(f"{merchant_id}_{event_id}", json.dumps(event_trace))
-        retailer = Retailer.objects.get(merchant_id=merchant_id)
-        match self.__EVENT_TYPE_KEYS.get(event_type):
+    __EVENT_FAMILIES = {
+        "LocationUpdated": "location",
+        "LocationCreated": "location",
+        "CatalogUpdated": "catalog",
+        "InventoryCountUpdated": "inventory",
+        "CustomerCreated": "customer",
+        "CustomerUpdated": "customer",
+        "CustomerDeleted": "customer",
+        "OrderCreated": "order",
+        "OrderUpdated": "order",
+        "OrderFulfillmentUpdated": "order",
+    }
+
+    @staticmethod
+    def build_event(body: dict) -> WebhookEvent:
+        """Event row for a Square notification. Raises KeyError when it is malformed."""
+        data = body.get("data") or {}
+        return WebhookEvent(
+            origin=WebhookEvent.SQUARE,
+            merchant_id=body["merchant_id"],
+            event_id=body["event_id"],
+            event_type=body["type"],
+            object_id=data.get("id"),
+            payload=data.get("object") or {},
+        )
+
+    def family(self, event: WebhookEvent) -> str:
+        return self.__EVENT_FAMILIES.get(self.__EVENT_TYPE_KEYS.get(event.event_type))
+
+    def coalesce_key(self, event: WebhookEvent) -> tuple:
+        """
+        Events sharing a key are processed in a single run. Catalog versions
+        and stock counts are merged for the whole merchant, orders and
+        customers per object.
+        """
+        family = self.family(event)
+        match family:
+            case "catalog" | "inventory" | "location":
+                return (family,)
+            case "order":
+                return family, self._order_id(event.payload)
+            case _:
+                return family or event.event_type, event.object_id
+
+    @staticmethod
+    def _order_id(body: dict):
+        return (list(body.values()) or [{}])[0].get("order_id")
+
+    def process_events(self, events: list) -> None:
+        """Process a group of events sharing a coalescing key."""
+        match self.family(events[0]):
+            case "catalog":
+                # The earliest version fetches every change made since
+                self.process_event(events[0])
+            case "inventory":
+                # Stale counts are dropped by calculated_at when applied
+                counts = [
+                    count
+                    for event in events
+                    for count in event.payload.get("inventory_counts", [])
+                ]
+                retailer = Retailer.objects.get(merchant_id=events[0].merchant_id)
+                SquareInventory(retailer).webhook_update_variant_stock(
+                    {"inventory_counts": counts}
+                )
+            case _:
+                # The last event carries the latest state of the object
+                self.process_event(events[-1])
+
+    def process_event(self, event: WebhookEvent) -> None:
+        retailer = Retailer.objects.get(merchant_id=event.merchant_id)
+        body = event.payload
+        match self.__EVENT_TYPE_KEYS.get(event.event_type):
             case "LocationUpdated":
                 SquareLocation.create_or_update_location(
-                    retailer=retailer, location_id=merchant_id
+                    retailer=retailer, location_id=event.merchant_id
                 )
             case "LocationCreated":
                 SquareLocation.create_or_update_location(
-                    retailer=retailer, location_id=merchant_id
+                    retailer=retailer, location_id=event.merchant_id
                 )
             case "CatalogUpdated":
-                process_square_catalog_event.delay(body=body, retailer_id=retailer.pk)
+                square_inventory = SquareInventory(retailer)
+                square_inventory.run_webhook_update(body)
+                run_go_upc_integration.delay(retailer_id=retailer.pk)
             case "InventoryCountUpdated":
                 square_inventory = SquareInventory(retailer)
                 square_inventory.webhook_update_variant_stock(body)
@@ -56,10 +117,6 @@ class SquareWebhook:
                 SquareCustomer.delete_customer(retailer, body)
             case "OrderCreated" | "OrderUpdated" | "OrderFulfillmentUpdated":
                 square_reservation = SquareReservation(retailer)
-                order_id = list(body.values())[0].get("order_id")
-                square_reservation.sync_from_square(order_id)
+                square_reservation.sync_from_square(self._order_id(body))
             case _:
                 pass
-
-        event_trace["status"] = "SUCCESS"
-        cache.set(f"{merchant_id}_{event_id}", json.dumps(event_trace))
@@ -1,4 +1,6 @@
 import json
+from datetime import timezone
+
 from django.utils.timezone import localtime
 
 
@@ -47,6 +49,16 @@ def get_product_prices(products):
         return {"min_price": 0, "max_price": 0, "price": products[0].get("price", 0)}
 
 
+def to_rfc3339(dt) -> str:
+    """
+    Format an aware datetime as an RFC 3339 UTC timestamp with milliseconds,
+    e.g. "2023-10-05T12:34:56.789Z".
+    """
+    return dt.astimezone(timezone.utc).isoformat(timespec="milliseconds").replace(
+        "+00:00", "Z"
+    )
+
+
 def date2sec(dt) -> int:
     """
     Convert a date string into seconds since the beginning of the year.
@@ -14,12 +14,14 @@ from rangefilter.filters import DateRangeFilter
 
 from common.filters import PriceRangeFilter
 from common.pos.clover import CloverInventory
+from common.pos.repositories import ProductCardRepository, UpcIndexRepository, WebhookEventRepository
 from common.retailer_utils import RetailerUtils
 from retailer.models import Retailer
 from wyndo.forms import NonEmptyInlineFormSet
 from .forms import CategoryForm, ProductForm, VariantForm
 from .models import Category, Product, Variant, Inventory, Customer, OrderItem, OrderPickup, \
-    Order, Reservation
+    Order, Reservation, WebhookEvent
+from .tasks import start_webhook_consumers
 
 
 class VariantInline(admin.TabularInline):
@@ -139,6 +141,11 @@ class ProductAdmin(admin.ModelAdmin):
             return qs.filter(inventory__in=RetailerUtils.get_retailer_inventories(request.user.email))
         return qs
 
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        ProductCardRepository().refresh(product_ids=[form.instance.pk])
+        UpcIndexRepository().refresh(product_ids=[form.instance.pk])
+
     # def save_model(self, request, obj, form, change):
     #     pass  # don't actually save the parent instance
     #
@@ -601,3 +608,45 @@ class ReservationAdmin(admin.ModelAdmin):
             "js/admin/jquery-3.3.1.min.js",
             "js/admin/reservation.js",
         )
+
+
+@admin.register(WebhookEvent)
+class WebhookEventAdmin(admin.ModelAdmin):
+    list_display = (
+        "event_id",
+        "origin",
+        "merchant_id",
+        "event_type",
+        "status",
+        "attempts",
+        "created_at",
+        "processed_at",
+    )
+    list_filter = (
+        "origin",
+        "status",
+        ("created_at", DateRangeFilter),
+    )
+    search_fields = ("event_id", "merchant_id", "object_id")
+    readonly_fields = (
+        "origin",
+        "merchant_id",
+        "event_id",
+        "event_type",
+        "object_id",
+        "payload",
+        "status",
+        "attempts",
+        "error",
+        "created_at",
+        "processed_at",
+    )
+    actions = ("reprocess",)
+
+    @admin.action(description="Reprocess selected events")
+    def reprocess(self, request, queryset):
+        start_webhook_consumers(dict.fromkeys(WebhookEventRepository().requeue(queryset), 0))
+        self.message_user(request, f"{queryset.count()} events queued for processing")
+
+    def has_add_permission(self, request):
+        return False
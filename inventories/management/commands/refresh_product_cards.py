@@ -0,0 +1,25 @@
+import logging
+
+from django.core.management.base import BaseCommand
+
+from common.pos.repositories import ProductCardRepository, UpcIndexRepository
+
+
+class Command(BaseCommand):
+    help = "Rebuild the product cards and UPC index used by the shopper pages."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--retailer',
+            type=int,
+            default=None,
+            help='Only rebuild the cards and index entries of this retailer'
+        )
+
+    def handle(self, *args, **options):
+        logging.info("Starting product cards refresh")
+
+        refreshed = ProductCardRepository().refresh(retailer_id=options["retailer"])
+        codes = UpcIndexRepository().refresh(retailer_id=options["retailer"])
+
+        self.stdout.write(f"Refreshed {refreshed} product cards and {len(codes)} UPCs")
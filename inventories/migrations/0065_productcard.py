@@ -0,0 +1,90 @@
+# Generated by Django 4.2.3 on 2026-10-18 13:45
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("retailer", "0024_retailer_orders_synced_at"),
+        ("inventories", "0064_alter_orderitem_item_type"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ProductCard",
+            fields=[
+                (
+                    "product",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="card",
+                        serialize=False,
+                        to="inventories.product",
+                    ),
+                ),
+                (
+                    "retailer_name",
+                    models.CharField(blank=True, max_length=255, null=True),
+                ),
+                ("name", models.CharField(default=None, max_length=255, null=True)),
+                (
+                    "image",
+                    models.ImageField(
+                        blank=True, max_length=511, null=True, upload_to="inventories"
+                    ),
+                ),
+                (
+                    "price",
+                    models.DecimalField(decimal_places=2, default=0, max_digits=20),
+                ),
+                (
+                    "min_price",
+                    models.DecimalField(
+                        blank=True, decimal_places=2, max_digits=20, null=True
+                    ),
+                ),
+                (
+                    "max_price",
+                    models.DecimalField(
+                        blank=True, decimal_places=2, max_digits=20, null=True
+                    ),
+                ),
+                ("variant_count", models.PositiveIntegerField(default=0)),
+                ("total_stock", models.PositiveIntegerField(default=0)),
+                ("available_stock", models.IntegerField(default=0)),
+                ("address", models.CharField(blank=True, max_length=1024, null=True)),
+                ("is_active", models.BooleanField(default=True)),
+                ("product_created_at", models.DateTimeField(null=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                (
+                    "retailer",
+                    models.ForeignKey(
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="product_cards",
+                        to="retailer.retailer",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Product Card",
+                "verbose_name_plural": "Product Cards",
+                "indexes": [
+                    models.Index(
+                        fields=["is_active", "-product_created_at"],
+                        name="inventories_is_acti_294db3_idx",
+                    ),
+                    models.Index(
+                        fields=["is_active", "-total_stock"],
+                        name="inventories_is_acti_e55ed1_idx",
+                    ),
+                    models.Index(
+                        fields=["retailer", "is_active", "name"],
+                        name="inventories_retaile_58b5bd_idx",
+                    ),
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,89 @@
+# Generated by Django 4.2.3 on 2026-10-18 13:51
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("retailer", "0024_retailer_orders_synced_at"),
+        ("inventories", "0065_productcard"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="UpcIndex",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("code", models.CharField(max_length=255)),
+                (
+                    "price",
+                    models.DecimalField(decimal_places=2, default=0, max_digits=20),
+                ),
+                ("stock", models.IntegerField(default=0)),
+                ("total_stock", models.PositiveIntegerField(default=0)),
+                ("is_active", models.BooleanField(default=True)),
+            ],
+            options={
+                "verbose_name": "UPC Index",
+                "verbose_name_plural": "UPC Index",
+            },
+        ),
+        migrations.AddField(
+            model_name="productcard",
+            name="is_related_item",
+            field=models.BooleanField(
+                default=False,
+                help_text="Listed in the related items of product pages: the cheapest offer of its UPC or a product without UPC",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="productcard",
+            index=models.Index(
+                fields=["is_related_item", "is_active", "product"],
+                name="inventories_is_rela_e9da52_idx",
+            ),
+        ),
+        migrations.AddField(
+            model_name="upcindex",
+            name="product",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="upc_index",
+                to="inventories.product",
+            ),
+        ),
+        migrations.AddField(
+            model_name="upcindex",
+            name="retailer",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="upc_index",
+                to="retailer.retailer",
+            ),
+        ),
+        migrations.AddField(
+            model_name="upcindex",
+            name="variant",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="upc_index",
+                to="inventories.variant",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="upcindex",
+            index=models.Index(
+                fields=["code", "is_active", "price"],
+                name="inventories_code_c7e734_idx",
+            ),
+        ),
+    ]
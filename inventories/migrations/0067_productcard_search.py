@@ -0,0 +1,35 @@
+# Generated by Django 4.2.3 on 2026-10-18 13:53
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("inventories", "0066_upc_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="productcard",
+            name="search_description",
+            field=models.TextField(blank=True, default=""),
+        ),
+        migrations.AddField(
+            model_name="productcard",
+            name="search_keywords",
+            field=models.TextField(blank=True, default=""),
+        ),
+        migrations.AddField(
+            model_name="productcard",
+            name="search_vector",
+            field=django.contrib.postgres.search.SearchVectorField(null=True),
+        ),
+        migrations.AddIndex(
+            model_name="productcard",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["search_vector"], name="inventories_search__be6108_gin"
+            ),
+        ),
+    ]
@@ -0,0 +1,80 @@
+# Generated by Django 4.2.3 on 2026-10-18 13:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("inventories", "0067_productcard_search"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="WebhookEvent",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "created_at",
+                    models.DateTimeField(
+                        auto_now_add=True, verbose_name="Created date"
+                    ),
+                ),
+                (
+                    "updated_at",
+                    models.DateTimeField(auto_now=True, verbose_name="Updated date"),
+                ),
+                (
+                    "origin",
+                    models.CharField(
+                        choices=[("CLOVER", "CLOVER"), ("SQUARE", "SQUARE")],
+                        max_length=10,
+                    ),
+                ),
+                ("merchant_id", models.CharField(max_length=255)),
+                ("event_id", models.CharField(max_length=255)),
+                ("event_type", models.CharField(max_length=100)),
+                ("object_id", models.CharField(blank=True, max_length=255, null=True)),
+                ("payload", models.JSONField(default=dict)),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("PENDING", "Pending"),
+                            ("PROCESSING", "Processing"),
+                            ("SUCCESS", "Success"),
+                            ("FAILED", "Failed"),
+                        ],
+                        default="PENDING",
+                        max_length=20,
+                    ),
+                ),
+                ("attempts", models.PositiveSmallIntegerField(default=0)),
+                ("error", models.TextField(blank=True, null=True)),
+                ("processed_at", models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                "verbose_name": "Webhook Event",
+                "verbose_name_plural": "Webhook Events",
+                "indexes": [
+                    models.Index(
+                        fields=["origin", "merchant_id", "status", "id"],
+                        name="inventories_origin_859506_idx",
+                    )
+                ],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="webhookevent",
+            constraint=models.UniqueConstraint(
+                fields=("origin", "event_id"), name="unique_webhook_event"
+            ),
+        ),
+    ]
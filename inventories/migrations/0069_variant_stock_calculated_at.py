@@ -0,0 +1,17 @@
+# Generated by Django 4.2.3 on 2026-10-18 14:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("inventories", "0068_webhookevent"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="variant",
+            name="stock_calculated_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 4.2.3 on 2026-10-18 14:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("inventories", "0069_variant_stock_calculated_at"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="UpcLookup",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "created_at",
+                    models.DateTimeField(
+                        auto_now_add=True, verbose_name="Created date"
+                    ),
+                ),
+                (
+                    "updated_at",
+                    models.DateTimeField(auto_now=True, verbose_name="Updated date"),
+                ),
+                ("code", models.CharField(max_length=255, unique=True)),
+                ("found", models.BooleanField(default=False)),
+                ("description", models.TextField(blank=True, null=True)),
+                ("image_url", models.CharField(blank=True, max_length=1024, null=True)),
+                ("retry_after", models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                "verbose_name": "UPC Lookup",
+                "verbose_name_plural": "UPC Lookups",
+            },
+        ),
+        migrations.AddField(
+            model_name="variant",
+            name="go_upc_code",
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.3 on 2026-10-18 14:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("inventories", "0070_upclookup"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="variant",
+            index=models.Index(
+                fields=["upc", "price"], name="inventories_upc_528220_idx"
+            ),
+        ),
+    ]
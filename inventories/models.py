@@ -3,6 +3,8 @@ import os
 from io import StringIO
 
 import requests
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from django.core.files import File
 from django.core.files.temp import NamedTemporaryFile
 from django.db import models
@@ -122,6 +124,12 @@ class Variant(BaseTimeModel):
 
     stock = models.IntegerField(null=True, blank=True, default=0)
 
+    # POS time of the last stock count applied from a webhook
+    stock_calculated_at = models.DateTimeField(null=True, blank=True)
+
+    # UPC or SKU the Go UPC result was last applied for
+    go_upc_code = models.CharField(max_length=255, null=True, blank=True)
+
     price = models.DecimalField(max_digits=20, decimal_places=2, default=0)
 
     product = models.ForeignKey(
@@ -151,6 +159,9 @@ class Variant(BaseTimeModel):
     class Meta:
         verbose_name = "Product Detail"
         verbose_name_plural = "Variations"
+        indexes = [
+            models.Index(fields=["upc", "price"]),
+        ]
 
     def __str__(self):
         return f"{self.product.name} - {self.name}"
@@ -187,6 +198,85 @@ class VariantImage(BaseTimeModel):
                 return True
 
 
+class ProductCard(models.Model):
+    """
+    Denormalized listing data of a product, rebuilt by the sync pipeline
+    whenever the product, its variants, images or reservations change so
+    listing pages render from a single query.
+    """
+
+    product = models.OneToOneField(
+        Product, on_delete=models.CASCADE, primary_key=True, related_name="card"
+    )
+    retailer = models.ForeignKey(
+        Retailer, on_delete=models.CASCADE, null=True, related_name="product_cards"
+    )
+    retailer_name = models.CharField(max_length=255, null=True, blank=True)
+    name = models.CharField(max_length=255, null=True, default=None)
+    image = models.ImageField(upload_to="inventories", null=True, blank=True, max_length=511)
+    price = models.DecimalField(max_digits=20, decimal_places=2, default=0)
+    min_price = models.DecimalField(max_digits=20, decimal_places=2, null=True, blank=True)
+    max_price = models.DecimalField(max_digits=20, decimal_places=2, null=True, blank=True)
+    variant_count = models.PositiveIntegerField(default=0)
+    total_stock = models.PositiveIntegerField(default=0)
+    available_stock = models.IntegerField(default=0)
+    address = models.CharField(max_length=1024, null=True, blank=True)
+    is_active = models.BooleanField(default=True)
+    is_related_item = models.BooleanField(
+        default=False,
+        help_text="Listed in the related items of product pages: the cheapest offer of its UPC or a product without UPC",
+    )
+    product_created_at = models.DateTimeField(null=True)
+    search_keywords = models.TextField(blank=True, default="")
+    search_description = models.TextField(blank=True, default="")
+    search_vector = SearchVectorField(null=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "Product Card"
+        verbose_name_plural = "Product Cards"
+        indexes = [
+            GinIndex(fields=["search_vector"]),
+            models.Index(fields=["is_active", "-product_created_at"]),
+            models.Index(fields=["is_active", "-total_stock"]),
+            models.Index(fields=["retailer", "is_active", "name"]),
+            models.Index(fields=["is_related_item", "is_active", "product"]),
+        ]
+
+    def __str__(self):
+        return f"{self.name}"
+
+    @property
+    def id(self):
+        return self.product_id
+
+
+class UpcIndex(models.Model):
+    """
+    Cross-retailer lookup of the variants selling a UPC or SKU, rebuilt
+    after each sync so product pages find other retailers' offers by key.
+    """
+
+    code = models.CharField(max_length=255)
+    variant = models.ForeignKey(Variant, on_delete=models.CASCADE, related_name="upc_index")
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="upc_index")
+    retailer = models.ForeignKey(Retailer, on_delete=models.CASCADE, related_name="upc_index")
+    price = models.DecimalField(max_digits=20, decimal_places=2, default=0)
+    stock = models.IntegerField(default=0)
+    total_stock = models.PositiveIntegerField(default=0)
+    is_active = models.BooleanField(default=True)
+
+    class Meta:
+        verbose_name = "UPC Index"
+        verbose_name_plural = "UPC Index"
+        indexes = [
+            models.Index(fields=["code", "is_active", "price"]),
+        ]
+
+    def __str__(self):
+        return f"{self.code}"
+
+
 class Reservation(BaseTimeModel):
     CLOVER = "CLOVER"
     SQUARE = "SQUARE"
@@ -402,3 +492,72 @@ class OrderPickup(BaseTimeModel):
 
     def __str__(self):
         return f"Pickup - {self.order} - {self.pickup_time}"
+
+
+class WebhookEvent(BaseTimeModel):
+    """
+    Raw POS webhook event stored on receipt and processed in order per
+    merchant by the webhook consumer.
+    """
+
+    CLOVER = "CLOVER"
+    SQUARE = "SQUARE"
+
+    ORIGIN_CHOICES = ((CLOVER, CLOVER), (SQUARE, SQUARE))
+
+    STATUS_PENDING = "PENDING"
+    STATUS_PROCESSING = "PROCESSING"
+    STATUS_SUCCESS = "SUCCESS"
+    STATUS_FAILED = "FAILED"
+
+    STATUS_CHOICES = (
+        (STATUS_PENDING, "Pending"),
+        (STATUS_PROCESSING, "Processing"),
+        (STATUS_SUCCESS, "Success"),
+        (STATUS_FAILED, "Failed"),
+    )
+
+    origin = models.CharField(max_length=10, choices=ORIGIN_CHOICES)
+    merchant_id = models.CharField(max_length=255)
+    event_id = models.CharField(max_length=255)
+    event_type = models.CharField(max_length=100)
+    object_id = models.CharField(max_length=255, null=True, blank=True)
+    payload = models.JSONField(default=dict)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    error = models.TextField(null=True, blank=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = "Webhook Event"
+        verbose_name_plural = "Webhook Events"
+        constraints = [
+            models.UniqueConstraint(fields=["origin", "event_id"], name="unique_webhook_event"),
+        ]
+        indexes = [
+            models.Index(fields=["origin", "merchant_id", "status", "id"]),
+        ]
+
+    def __str__(self):
+        return f"{self.origin} {self.event_type} {self.event_id}"
+
+
+class UpcLookup(BaseTimeModel):
+    """
+    Go UPC result for a code, kept so every code is looked up once. Codes
+    Go UPC doesn't know are stored too and looked up again after
+    `retry_after`.
+    """
+
+    code = models.CharField(max_length=255, unique=True)
+    found = models.BooleanField(default=False)
+    description = models.TextField(null=True, blank=True)
+    image_url = models.CharField(max_length=1024, null=True, blank=True)
+    retry_after = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = "UPC Lookup"
+        verbose_name_plural = "UPC Lookups"
+
+    def __str__(self):
+        return self.code
@@ -1,7 +1,10 @@
 import traceback
+from datetime import datetime
 
-from celery import shared_task
+from celery import chain, chord, group, shared_task
 from celery.utils.log import get_task_logger
+from django.core.cache import cache
+from django.db import transaction
 from django.db.models import Q
 from django.utils import timezone
 
@@ -9,103 +12,227 @@ from common.pos.clover import CloverInventory
 from common.pos.clover.clover_customer import CloverCustomer
 from common.pos.clover.clover_location import CloverLocation
 from common.pos.clover.clover_reservation import CloverReservation
+from common.pos.repositories import ProductCardRepository, WebhookEventRepository
 from common.pos.square import SquareInventory
 from common.pos.square.square_customer import SquareCustomer
 from common.pos.square.square_location import SquareLocation
 from common.pos.square.square_reservation import SquareReservation
 from retailer.models import Retailer
 from wyndo.celery import app
-from .models import Reservation
+from wyndo.settings import SYNC_CONCURRENCY, WEBHOOK_COALESCE_WINDOWS
+from .models import Reservation, WebhookEvent
 
 logger = get_task_logger(__name__)
 
 INVENTORY_CLASSES = {Retailer.SQUARE: SquareInventory, Retailer.CLOVER: CloverInventory}
 
+# Seconds a webhook consumer holds the merchant lock without making progress
+WEBHOOK_LOCK_TIMEOUT = 60 * 5
+
+
+def fan_out(task, retailer_ids, **kwargs):
+    """
+    Run `task` once per retailer instead of looping over every retailer in a
+    single invocation. Retailers are spread over at most SYNC_CONCURRENCY
+    lanes that run in parallel, each lane processing its retailers in turn,
+    and `retailers_synced` runs once every lane is done.
+    """
+    retailer_ids = list(retailer_ids)
+    if not retailer_ids:
+        return
+
+    lanes = [retailer_ids[i::SYNC_CONCURRENCY] for i in range(SYNC_CONCURRENCY)]
+    header = group(
+        chain(task.si(retailer_id=retailer_id, **kwargs) for retailer_id in lane)
+        for lane in lanes
+        if lane
+    )
+    chord(header)(
+        retailers_synced.si(task.name, len(retailer_ids), timezone.now().isoformat())
+    )
+    logger.info(f"[Celery] Dispatched {task.name} for {len(retailer_ids)} retailers")
+
+
+def retry_retailer(task, exc, retailer_id, **kwargs):
+    """
+    Retry the task for this retailer only, overriding its arguments with
+    `kwargs` so a sync resumes from the page it stopped at. Once the retries
+    are exhausted the failure is logged and swallowed so the rest of its
+    lane keeps running.
+    """
+    if task.request.retries < task.max_retries:
+        raise task.retry(exc=exc, kwargs={**task.request.kwargs, **kwargs})
+    logger.error(
+        f"[Celery] Giving up {task.name} for retailer {retailer_id} after {task.request.retries} retries"
+    )
+
+
+@app.task
+def retailers_synced(task_name: str, retailer_count: int, started_at: str):
+    elapsed = timezone.now() - datetime.fromisoformat(started_at)
+    logger.info(
+        f"[Celery] {task_name} finished for {retailer_count} retailers in {elapsed.total_seconds():.0f}s"
+    )
+
 
 @app.task(bind=True)
 def update_status_reservation(_, data: dict):
-    Reservation.objects.filter(id=data.get("reservation")).update(
-        status=data.get("status")
+    reservations = Reservation.objects.filter(id=data.get("reservation"))
+    reservations.update(status=data.get("status"))
+    ProductCardRepository().refresh_for_variants(
+        reservations.values_list("variant_id", flat=True)
     )
 
 
 @app.task(bind=True, max_retries=3, default_retry_delay=300)
 def load_clover_inventory(
-    self, retailer_id: int = None, limit: int = 10, offset: int = 0
+    self,
+    retailer_id: int = None,
+    limit: int = 100,
+    offset: int = 0,
+    full_sync: bool = False,
+    sync_started_at: str = None,
+    modified_since: str = None,
 ):
+    """
+    Load the Clover inventory of a retailer, every page within this task so
+    the sync concurrency and the completion callback of `fan_out` cover the
+    whole retailer. Unless `full_sync` is set, only items modified since the
+    retailer's last successful sync are fetched. `sync_started_at` and
+    `modified_since` are set when a failed sync is retried from the page it
+    stopped at and should not be passed by callers.
+    """
+    if retailer_id is None:
+        retailers = (
+            Retailer.objects.filter(origin=Retailer.CLOVER, is_sync=False, status=Retailer.STATUS_APPROVED)
+            .exclude(access_token__isnull=True)
+        )
+        fan_out(
+            load_clover_inventory,
+            [retailer.pk for retailer in retailers if not retailer.is_access_token_expired()],
+            limit=limit,
+            full_sync=full_sync,
+        )
+        return
+
     logger.info(
-        f"Starting Clover inventory loading process with parameters: retailer {retailer_id}, limit: {limit}, offset: {offset}"
+        f"Starting Clover inventory loading process with parameters: retailer {retailer_id}, limit: {limit}, offset: {offset}, full_sync: {full_sync}, modified_since: {modified_since}"
     )
+    started_at, since = None, None
     try:
-        if retailer_id is not None:
-            retailers = Retailer.objects.filter(pk=retailer_id, status=Retailer.STATUS_APPROVED)
+        retailer = Retailer.objects.filter(pk=retailer_id, status=Retailer.STATUS_APPROVED).first()
+        if retailer is None or retailer.is_access_token_expired():
+            return
+
+        if sync_started_at is None:
+            # The watermark is taken before fetching so items modified
+            # while the sync runs are picked up next time
+            started_at = timezone.now()
+            since = None if full_sync else retailer.inventory_synced_at
         else:
-            retailers = (
-                Retailer.objects.filter(origin=Retailer.CLOVER, is_sync=False, status=Retailer.STATUS_APPROVED)
-                .exclude(access_token__isnull=True)
-            )
-
-        retailers = [
-            retailer for retailer in retailers if not retailer.is_access_token_expired()
-        ]
+            started_at = datetime.fromisoformat(sync_started_at)
+            since = datetime.fromisoformat(modified_since) if modified_since else None
 
-        if retailers:
-            for retailer in retailers:
-                retailer.update_sync(True)
-                clover_inventory = CloverInventory(retailer, limit=limit, offset=offset)
+        retailer.update_sync(True)
+        try:
+            while True:
+                clover_inventory = CloverInventory(
+                    retailer, limit=limit, offset=offset, modified_since=since
+                )
                 load_result = clover_inventory.run()
-                retailer.update_sync(False)
-                if load_result["result"] and load_result["fetch_next"]:
-                    load_clover_inventory.delay(
-                        retailer_id=load_result["retailer_id"],
-                        limit=load_result["limit"],
-                        offset=load_result["offset"],
-                    )
-                elif load_result["result"] and not load_result["fetch_next"]:
-                    run_go_upc_integration.delay(retailer_id=retailer.pk)
+                if not (load_result["result"] and load_result["fetch_next"]):
+                    break
+                offset = load_result["offset"]
+        finally:
+            retailer.update_sync(False)
+
+        if load_result["result"]:
+            retailer.update_inventory_synced_at(started_at)
+            run_go_upc_integration.delay(retailer_id=retailer.pk)
     except Exception as exc:
         logger.error(f"Error loading Clover inventory: {str(exc)}")
-        raise self.retry(exc=exc)
+        retry_retailer(
+            self,
+            exc,
+            retailer_id,
+            offset=offset,
+            sync_started_at=started_at.isoformat() if started_at else None,
+            modified_since=since.isoformat() if since else None,
+        )
     finally:
         logger.info("Ended Clover inventory loading process")
 
 
 @app.task(bind=True, max_retries=3, default_retry_delay=300)
-def load_square_inventory(self, retailer_id: int = None, cursor: str = None):
+def load_square_inventory(
+    self,
+    retailer_id: int = None,
+    cursor: str = None,
+    full_sync: bool = False,
+    sync_started_at: str = None,
+    updated_since: str = None,
+):
+    """
+    Load the Square catalog of a retailer, every page within this task so
+    the sync concurrency and the completion callback of `fan_out` cover the
+    whole retailer. Unless `full_sync` is set, only objects changed since
+    the retailer's last successful sync are searched, deletions included.
+    `sync_started_at` and `updated_since` are set when a failed sync is
+    retried from the page it stopped at and should not be passed by callers.
+    """
+    if retailer_id is None:
+        retailers = (
+            Retailer.objects.filter(origin=Retailer.SQUARE, status=Retailer.STATUS_APPROVED)
+            .exclude(access_token__isnull=True)
+        )
+        fan_out(
+            load_square_inventory,
+            [retailer.pk for retailer in retailers if not retailer.is_access_token_expired()],
+            full_sync=full_sync,
+        )
+        return
+
     logger.info(
-        f"Starting Square inventory loading process with parameters: retailer {retailer_id}, cursor {cursor}"
+        f"Starting Square inventory loading process with parameters: retailer {retailer_id}, cursor {cursor}, full_sync: {full_sync}, updated_since: {updated_since}"
     )
+    started_at, since = None, None
     try:
-        if retailer_id is not None:
-            retailers = Retailer.objects.filter(pk=retailer_id, status=Retailer.STATUS_APPROVED)
-        else:
-            retailers = (
-                Retailer.objects.filter(origin=Retailer.SQUARE, status=Retailer.STATUS_APPROVED)
-                .exclude(access_token__isnull=True)
-            )
+        retailer = Retailer.objects.filter(pk=retailer_id, status=Retailer.STATUS_APPROVED).first()
+        if retailer is None or retailer.is_access_token_expired():
+            return
 
-        retailers = [
-            retailer for retailer in retailers if not retailer.is_access_token_expired()
-        ]
+        if sync_started_at is None:
+            started_at = timezone.now()
+            since = None if full_sync else SquareInventory(retailer).delta_sync_since()
+        else:
+            started_at = datetime.fromisoformat(sync_started_at)
+            since = datetime.fromisoformat(updated_since) if updated_since else None
 
-        if retailers:
-            for retailer in retailers:
-                retailer.update_sync(True)
+        retailer.update_sync(True)
+        try:
+            while True:
                 square_inventory = SquareInventory(retailer, cursor=cursor)
-                load_result = square_inventory.run()
-                retailer.update_sync(False)
-                if load_result["result"] and load_result["fetch_next"]:
-                    print(f"============Load next: =============== {load_result['cursor']}")
-                    load_square_inventory.delay(
-                        retailer_id=load_result["retailer_id"],
-                        cursor=load_result["cursor"],
-                    )
-                elif load_result["result"] and not load_result["fetch_next"]:
-                    run_go_upc_integration.delay(retailer_id=retailer.pk)
+                load_result = square_inventory.run(updated_since=since)
+                if not (load_result["result"] and load_result["fetch_next"]):
+                    break
+                cursor = load_result["cursor"]
+        finally:
+            retailer.update_sync(False)
+
+        if load_result["result"]:
+            retailer.update_inventory_synced_at(started_at)
+            run_go_upc_integration.delay(retailer_id=retailer.pk)
 
     except Exception as exc:
         logger.error(f"Error loading Square inventory: {str(exc)}")
-        raise self.retry(exc=exc)
+        retry_retailer(
+            self,
+            exc,
+            retailer_id,
+            cursor=cursor,
+            sync_started_at=started_at.isoformat() if started_at else None,
+            updated_since=since.isoformat() if since else None,
+        )
     finally:
         logger.info("Ended Square inventory loading process")
 
@@ -128,143 +255,186 @@ def process_square_catalog_event(self, body: dict, retailer_id: int = None):
 
 @app.task(bind=True, max_retries=3, default_retry_delay=300)
 def run_go_upc_integration(self, retailer_id: int = None):
+    if retailer_id is None:
+        retailers = Retailer.objects.filter(origin=Retailer.SQUARE).exclude(
+            access_token__isnull=True
+        )
+        fan_out(
+            run_go_upc_integration,
+            [retailer.pk for retailer in retailers if not retailer.is_access_token_expired()],
+        )
+        return
+
     logger.info(
         f"Starting Go UPC integration process with parameters: retailer {retailer_id}"
     )
     try:
-        if retailer_id is not None:
-            retailers = Retailer.objects.filter(pk=retailer_id)
-        else:
-            retailers = Retailer.objects.filter(origin=Retailer.SQUARE).exclude(
-                access_token__isnull=True
-            )
-
-        retailers = [
-            retailer for retailer in retailers if not retailer.is_access_token_expired()
-        ]
-
-        if retailers:
-            for retailer in retailers:
-                inventory_class = INVENTORY_CLASSES.get(retailer.origin)
-                if inventory_class:
-                    inventory = inventory_class(retailer)
-                    inventory.map_go_upc()
+        retailer = Retailer.objects.filter(pk=retailer_id).first()
+        if retailer is None or retailer.is_access_token_expired():
+            return
+
+        inventory_class = INVENTORY_CLASSES.get(retailer.origin)
+        if inventory_class:
+            inventory = inventory_class(retailer)
+            inventory.map_go_upc()
     except Exception as exc:
         logger.error(f"Error running Go UPC integration: {str(exc)}")
-        raise self.retry(exc=exc)
+        retry_retailer(self, exc, retailer_id)
     finally:
         logger.info("Ended Go UPC integration process")
 
 
 @app.task(bind=True, max_retries=3, default_retry_delay=300)
 def fetch_square_customer(self, retailer_id: int = None):
+    if retailer_id is None:
+        retailers = Retailer.objects.filter(origin=Retailer.SQUARE).exclude(access_token__isnull=True)
+        fan_out(fetch_square_customer, retailers.values_list("pk", flat=True))
+        return
+
     logger.info(f"[Celery] Fetching Square customers")
-    retailers = Retailer.objects.filter(pk=retailer_id) \
-        if retailer_id \
-        else Retailer.objects.filter(origin=Retailer.SQUARE).exclude(access_token__isnull=True)
+    retailer = Retailer.objects.filter(pk=retailer_id).first()
+    if retailer is None:
+        return
 
-    for retailer in retailers:
-        try:
-            SquareCustomer.fetch_all_customers(retailer)
-        except Exception as exc:
-            logger.error(f"Error fetching Square customers: {str(exc)}")
-            raise self.retry(exc=exc)
-        finally:
-            logger.info(f"[Celery] Ended fetching Square customers for retailer: {retailer.merchant_id}")
+    try:
+        SquareCustomer.fetch_all_customers(retailer)
+    except Exception as exc:
+        logger.error(f"Error fetching Square customers: {str(exc)}")
+        retry_retailer(self, exc, retailer_id)
+    finally:
+        logger.info(f"[Celery] Ended fetching Square customers for retailer: {retailer.merchant_id}")
 
 
 @app.task(bind=True, max_retries=3, default_retry_delay=300)
 def fetch_clover_customer(self, retailer_id: int = None):
+    if retailer_id is None:
+        retailers = Retailer.objects.filter(origin=Retailer.CLOVER).exclude(access_token__isnull=True)
+        fan_out(fetch_clover_customer, retailers.values_list("pk", flat=True))
+        return
+
     logger.info(f"[Celery] Fetching Clover customers")
-    retailers = Retailer.objects.filter(pk=retailer_id) \
-        if retailer_id \
-        else Retailer.objects.filter(origin=Retailer.CLOVER).exclude(access_token__isnull=True)
+    retailer = Retailer.objects.filter(pk=retailer_id).first()
+    if retailer is None:
+        return
 
-    for retailer in retailers:
-        try:
-            CloverCustomer.fetch_all_customers(retailer)
-        except Exception as exc:
-            logger.error(f"Error fetching Clover customers: {str(exc)}")
-            traceback.print_exc()
-            raise self.retry(exc=exc)
-        finally:
-            logger.info(f"[Celery] Ended fetching Clover customers for retailer: {retailer.merchant_id}")
+    try:
+        CloverCustomer.fetch_all_customers(retailer)
+    except Exception as exc:
+        logger.error(f"Error fetching Clover customers: {str(exc)}")
+        traceback.print_exc()
+        retry_retailer(self, exc, retailer_id)
+    finally:
+        logger.info(f"[Celery] Ended fetching Clover customers for retailer: {retailer.merchant_id}")
 
 
 @app.task(bind=True, max_retries=3, default_retry_delay=300)
 def fetch_square_orders(self, retailer_id: int = None):
+    if retailer_id is None:
+        retailers = Retailer.objects.filter(origin=Retailer.SQUARE).exclude(access_token__isnull=True)
+        fan_out(fetch_square_orders, retailers.values_list("pk", flat=True))
+        return
+
     logger.info(f"[Celery] Fetching Square orders")
-    retailers = Retailer.objects.filter(pk=retailer_id) \
-        if retailer_id \
-        else Retailer.objects.filter(origin=Retailer.SQUARE).exclude(access_token__isnull=True)
+    retailer = Retailer.objects.filter(pk=retailer_id).first()
+    if retailer is None:
+        return
 
-    for retailer in retailers:
-        try:
-            square_reservation = SquareReservation(retailer)
-            square_reservation.fetch_all_orders()
-        except Exception as exc:
-            logger.error(f"Error fetching Square orders: {str(exc)}")
-            print(traceback.format_exc())
-            raise self.retry(exc=exc)
-        finally:
-            logger.info(f"[Celery] Ended fetching Square orders for retailer: {retailer.merchant_id}")
+    try:
+        square_reservation = SquareReservation(retailer)
+        square_reservation.fetch_all_orders()
+    except Exception as exc:
+        logger.error(f"Error fetching Square orders: {str(exc)}")
+        print(traceback.format_exc())
+        retry_retailer(self, exc, retailer_id)
+    finally:
+        logger.info(f"[Celery] Ended fetching Square orders for retailer: {retailer.merchant_id}")
 
 
 @app.task(bind=True, max_retries=3, default_retry_delay=300)
 def fetch_clover_orders(self, retailer_id: int = None):
+    if retailer_id is None:
+        retailers = Retailer.objects.filter(origin=Retailer.CLOVER).exclude(access_token__isnull=True)
+        fan_out(fetch_clover_orders, retailers.values_list("pk", flat=True))
+        return
+
     logger.info(f"[Celery] Fetching Clover orders")
-    retailers = Retailer.objects.filter(pk=retailer_id) \
-        if retailer_id \
-        else Retailer.objects.filter(origin=Retailer.CLOVER).exclude(access_token__isnull=True)
+    retailer = Retailer.objects.filter(pk=retailer_id).first()
+    if retailer is None:
+        return
 
-    for retailer in retailers:
-        try:
-            clover_reservation = CloverReservation(retailer)
-            clover_reservation.fetch_all_orders()
-        except Exception as exc:
-            logger.error(f"Error fetching Clover orders: {str(exc)}")
-            print(traceback.format_exc())
-            raise self.retry(exc=exc)
-        finally:
-            logger.info(f"[Celery] Ended fetching Clover orders for retailer: {retailer.merchant_id}")
+    try:
+        clover_reservation = CloverReservation(retailer)
+        clover_reservation.fetch_all_orders()
+    except Exception as exc:
+        logger.error(f"Error fetching Clover orders: {str(exc)}")
+        print(traceback.format_exc())
+        retry_retailer(self, exc, retailer_id)
+    finally:
+        logger.info(f"[Celery] Ended fetching Clover orders for retailer: {retailer.merchant_id}")
+
+
+@app.task(bind=True, max_retries=3, default_retry_delay=300)
+def fetch_clover_order_items(self, retailer_id: int, item_ids: list, orders: list):
+    """
+    Load the Clover items referenced by orders that were synced before the
+    items were, then store those orders again so their line items resolve.
+    """
+    logger.info(f"[Celery] Fetching {len(item_ids)} Clover items for retailer: {retailer_id}")
+    try:
+        retailer = Retailer.objects.get(pk=retailer_id)
+        CloverInventory(retailer).run_items(item_ids)
+        CloverReservation(retailer).store_orders(orders, fetch_missing_items=False)
+    except Exception as exc:
+        logger.error(f"Error fetching Clover order items: {str(exc)}")
+        raise self.retry(exc=exc)
+    finally:
+        logger.info(f"[Celery] Ended fetching Clover items for retailer: {retailer_id}")
 
 
 @app.task(bind=True, max_retries=3, default_retry_delay=300)
 def fetch_square_categories(self, retailer_id: int = None):
+    if retailer_id is None:
+        retailers = Retailer.objects.filter(origin=Retailer.SQUARE).exclude(access_token__isnull=True)
+        fan_out(fetch_square_categories, retailers.values_list("pk", flat=True))
+        return
+
     logger.info(f"[Celery] Fetching Square categories")
-    retailers = Retailer.objects.filter(pk=retailer_id) \
-        if retailer_id \
-        else Retailer.objects.filter(origin=Retailer.SQUARE).exclude(access_token__isnull=True)
+    retailer = Retailer.objects.filter(pk=retailer_id).first()
+    if retailer is None:
+        return
 
-    for retailer in retailers:
-        try:
-            square_inventory = SquareInventory(retailer)
-            square_inventory.fetch_all_categories()
-        except Exception as exc:
-            logger.error(f"Error fetching Square inventories: {str(exc)}")
-            print(traceback.format_exc())
-            raise self.retry(exc=exc)
-        finally:
-            logger.info(f"[Celery] Ended fetching Square inventories for retailer: {retailer.merchant_id}")
+    try:
+        square_inventory = SquareInventory(retailer)
+        square_inventory.fetch_all_categories()
+    except Exception as exc:
+        logger.error(f"Error fetching Square inventories: {str(exc)}")
+        print(traceback.format_exc())
+        retry_retailer(self, exc, retailer_id)
+    finally:
+        logger.info(f"[Celery] Ended fetching Square inventories for retailer: {retailer.merchant_id}")
 
 
 @app.task(bind=True, max_retries=3, default_retry_delay=300)
 def fetch_clover_categories(self, retailer_id: int = None):
+    if retailer_id is None:
+        retailers = Retailer.objects.filter(origin=Retailer.CLOVER).exclude(access_token__isnull=True)
+        fan_out(fetch_clover_categories, retailers.values_list("pk", flat=True))
+        return
+
     logger.info(f"[Celery] Fetching Clover categories")
-    retailers = Retailer.objects.filter(pk=retailer_id) \
-        if retailer_id \
-        else Retailer.objects.filter(origin=Retailer.CLOVER).exclude(access_token__isnull=True)
+    retailer = Retailer.objects.filter(pk=retailer_id).first()
+    if retailer is None:
+        return
 
-    for retailer in retailers:
-        try:
-            clover_inventory = CloverInventory(retailer)
-            clover_inventory.fetch_all_categories()
-        except Exception as exc:
-            logger.error(f"Error fetching Clover inventories: {str(exc)}")
-            print(traceback.format_exc())
-            raise self.retry(exc=exc)
-        finally:
-            logger.info(f"[Celery] Ended fetching Clover inventories for retailer: {retailer.merchant_id}")
+    try:
+        clover_inventory = CloverInventory(retailer)
+        clover_inventory.fetch_all_categories()
+    except Exception as exc:
+        logger.error(f"Error fetching Clover inventories: {str(exc)}")
+        print(traceback.format_exc())
+        retry_retailer(self, exc, retailer_id)
+    finally:
+        logger.info(f"[Celery] Ended fetching Clover inventories for retailer: {retailer.merchant_id}")
 
 
 @app.task(bind=True, max_retries=3, default_retry_delay=300)
@@ -291,8 +461,94 @@ def init_retailer(self, retailer_id: int, origin: str):
 @app.task(bind=True, max_retries=1, default_retry_delay=300)
 def delete_abandoned_reservations(self):
     logger.info(f"[Celery] Deleting abandoned reservations")
-    Reservation.objects.filter(
+    reservations = Reservation.objects.filter(
         Q(time_limit__lt=timezone.now()) | Q(time_limit__isnull=True),
-    ).delete()
+    )
+    variant_ids = set(reservations.values_list("variant_id", flat=True))
+    reservations.delete()
+    ProductCardRepository().refresh_for_variants(variant_ids)
 
     logger.info(f"[Celery] Ended deleting abandoned reservations")
+
+
+def get_webhook(origin: str):
+    # Imported here, the webhook modules import this one
+    from common.pos.clover.clover_webhook import CloverWebhook
+    from common.pos.square.square_webhook import SquareWebhook
+
+    return {WebhookEvent.CLOVER: CloverWebhook, WebhookEvent.SQUARE: SquareWebhook}[origin]()
+
+
+def start_webhook_consumers(merchants: dict):
+    """
+    Wake the consumer of each (origin, merchant_id) key once the events are
+    committed, after the given number of seconds. While a delayed consumer
+    is scheduled, later events of the merchant wait for it instead of
+    scheduling another run, so a burst is processed at once.
+    """
+    for (origin, merchant_id), countdown in merchants.items():
+        scheduled = f"webhook_scheduled:{origin}:{merchant_id}"
+        if countdown and not cache.add(scheduled, True, countdown):
+            continue
+        transaction.on_commit(
+            lambda origin=origin, merchant_id=merchant_id, countdown=countdown: (
+                process_webhook_events.apply_async((origin, merchant_id), countdown=countdown)
+            )
+        )
+
+
+def queue_webhook_events(events: list):
+    """
+    Store received webhook events and schedule their consumers after the
+    longest coalescing window of their event families.
+    """
+    WebhookEventRepository().store(events)
+    merchants = {}
+    for event in events:
+        family = get_webhook(event.origin).family(event)
+        key = (event.origin, event.merchant_id)
+        merchants[key] = max(merchants.get(key, 0), WEBHOOK_COALESCE_WINDOWS.get(family, 0))
+    start_webhook_consumers(merchants)
+
+
+@app.task(bind=True)
+def process_webhook_events(self, origin: str, merchant_id: str):
+    """
+    Process the stored webhook events of a merchant in the order they were
+    received. Events sharing a coalescing key are processed in a single run.
+    A cache lock keeps a single consumer per merchant; a consumer started
+    while another one runs leaves the events to it.
+    """
+    lock = f"webhook_consumer:{origin}:{merchant_id}"
+    if not cache.add(lock, self.request.id or True, WEBHOOK_LOCK_TIMEOUT):
+        return
+
+    webhook = get_webhook(origin)
+    repository = WebhookEventRepository()
+    processed = 0
+    try:
+        while events := repository.pending(origin, merchant_id):
+            groups = {}
+            for event in events:
+                groups.setdefault(webhook.coalesce_key(event), []).append(event)
+
+            for batch in groups.values():
+                cache.touch(lock, WEBHOOK_LOCK_TIMEOUT)
+                repository.mark_processing(batch)
+                try:
+                    webhook.process_events(batch)
+                except Exception as exc:
+                    logger.error(f"[Celery] Error processing webhook events {batch[-1]}: {str(exc)}")
+                    logger.error(exc, exc_info=True)
+                    repository.mark_failed(batch, traceback.format_exc())
+                else:
+                    repository.mark_success(batch)
+                processed += len(batch)
+    finally:
+        cache.delete(lock)
+
+    logger.info(f"[Celery] Processed {processed} {origin} webhook events for merchant {merchant_id}")
+    # Events stored after the last batch was read but before the lock was
+    # released were left to this consumer
+    if repository.has_pending(origin, merchant_id):
+        process_webhook_events.delay(origin, merchant_id)
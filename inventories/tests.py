@@ -1,3 +1,922 @@
-from django.test import TestCase
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from unittest import mock, skipUnless
+from uuid import uuid4
 
-# Create your tests here.
+from django.core.cache import cache
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from django_redis import get_redis_connection
+from urllib3.util.retry import RequestHistory
+
+from common.catalog_cache import CatalogCache
+from common.goupc import GoUPC, GoUpcEnrichment
+from common.pos.clover import CloverInventory
+from common.pos.clover.clover_reservation import CloverReservation
+from common.pos.http import BackoffRetry
+from common.pos.rate_limit import RateLimiter
+from common.pos.clover.clover_webhook import CloverWebhook
+from common.pos.repositories import (
+    ProductCardRepository,
+    ProductRepository,
+    UpcIndexRepository,
+    WebhookEventRepository,
+)
+from common.pos.square import SquareInventory
+from common.pos.square.square_client import SquareRequestClient
+from common.pos.square.square_customer import SquareCustomer
+from common.pos.square.square_mapper import Item
+from common.pos.square.square_reservation import SquareReservation
+from common.pos.square.square_webhook import SquareWebhook
+from inventories.models import (
+    Customer,
+    Inventory,
+    Order,
+    OrderItem,
+    OrderPickup,
+    Product,
+    ProductCard,
+    UpcIndex,
+    UpcLookup,
+    Variant,
+    WebhookEvent,
+)
+from inventories.tasks import load_square_inventory, process_webhook_events
+from retailer.models import Location, Retailer
+
+LOCAL_CACHE = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
+
+def create_retailer(origin=Retailer.SQUARE, merchant_id="M1"):
+    retailer = Retailer.objects.create(
+        name="Retailer",
+        origin=origin,
+        merchant_id=merchant_id,
+        access_token="token",
+        app_id="app",
+        app_secret="secret",
+        status=Retailer.STATUS_APPROVED,
+    )
+    location = Location.objects.create(retailer=retailer, pos_id=f"{merchant_id}-L1")
+    inventory = Inventory.objects.create(name=merchant_id, location=location)
+    return retailer, location, inventory
+
+
+def create_product(inventory, origin_id, *variants):
+    """Product with one variant per (origin_id, stock, price, upc) tuple."""
+    product = Product.objects.create(name=origin_id, inventory=inventory, origin_id=origin_id)
+    for variant_origin_id, stock, price, upc in variants:
+        Variant.objects.create(
+            name=variant_origin_id,
+            product=product,
+            origin_id=variant_origin_id,
+            stock=stock,
+            price=price,
+            upc=upc,
+        )
+    return product
+
+
+def square_item(name, price, locations, override_location=None):
+    """Mapped Square item I1 with one variation V1, priced 1.00 at `override_location`."""
+    overrides = []
+    if override_location:
+        overrides.append(
+            {"location_id": override_location, "price_money": {"amount": 100, "currency": "USD"}}
+        )
+    return Item(
+        {
+            "id": "I1",
+            "locations": locations,
+            "item_data": {
+                "name": name,
+                "variations": [
+                    {
+                        "id": "V1",
+                        "locations": locations,
+                        "item_variation_data": {
+                            "item_id": "I1",
+                            "name": "Default",
+                            "upc": "111",
+                            "price_money": {"amount": price, "currency": "USD"},
+                            "location_overrides": overrides,
+                        },
+                    }
+                ],
+            },
+        }
+    )
+
+
+def at(hour):
+    return datetime(2024, 1, 1, hour, tzinfo=dt_timezone.utc)
+
+
+class SquareStockCountTests(TestCase):
+    def setUp(self):
+        self.retailer, self.location, inventory = create_retailer()
+        self.product = create_product(inventory, "I1", ("V1", 1, 5, "111"), ("V2", 2, 5, "222"))
+        self.square_inventory = SquareInventory(self.retailer)
+
+    def count(self, origin_id, quantity, hour, state="IN_STOCK"):
+        return {
+            "catalog_object_id": origin_id,
+            "location_id": self.location.pos_id,
+            "quantity": str(quantity),
+            "state": state,
+            "calculated_at": at(hour).isoformat(),
+        }
+
+    def apply(self, *counts):
+        self.square_inventory.webhook_update_variant_stock({"inventory_counts": list(counts)})
+
+    def stock(self, origin_id):
+        return Variant.objects.get(origin_id=origin_id).stock
+
+    def test_latest_count_wins_regardless_of_payload_order(self):
+        self.apply(self.count("V1", 9, 12), self.count("V1", 4, 10), self.count("V2", 3, 11))
+
+        self.assertEqual(self.stock("V1"), 9)
+        self.assertEqual(Variant.objects.get(origin_id="V1").stock_calculated_at, at(12))
+        self.assertEqual(self.stock("V2"), 3)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.total_stock, 12)
+
+    def test_count_older_than_applied_one_is_skipped(self):
+        self.apply(self.count("V1", 9, 12))
+        self.apply(self.count("V1", 4, 10))
+
+        self.assertEqual(self.stock("V1"), 9)
+
+    def test_counts_not_in_stock_are_ignored(self):
+        self.apply(self.count("V1", 0, 12, state="WASTE"))
+
+        self.assertEqual(self.stock("V1"), 1)
+
+
+class SquareCatalogStoreTests(TestCase):
+    def setUp(self):
+        self.retailer, self.location, _ = create_retailer()
+        self.other_location = Location.objects.create(retailer=self.retailer, pos_id="M1-L2")
+        Inventory.objects.create(name="M1-2", location=self.other_location)
+        self.square_inventory = SquareInventory(self.retailer)
+
+    def test_page_is_stored_once_per_location_and_updated_in_place(self):
+        locations = [self.location.pos_id, self.other_location.pos_id]
+        self.square_inventory.store_page(
+            [square_item("Old", 500, locations, self.other_location.pos_id)]
+        )
+        self.square_inventory.store_page(
+            [square_item("New", 700, locations, self.other_location.pos_id)]
+        )
+
+        self.assertEqual(
+            set(Product.objects.values_list("name", "inventory__location__pos_id")),
+            {("New", self.location.pos_id), ("New", self.other_location.pos_id)},
+        )
+        self.assertEqual(
+            set(Variant.objects.values_list("product__inventory__location__pos_id", "price")),
+            {(self.location.pos_id, 7), (self.other_location.pos_id, 1)},
+        )
+
+
+class SquareCatalogDeltaTests(TransactionTestCase):
+    def test_stock_is_fetched_after_the_delta_commits(self):
+        retailer, location, _ = create_retailer()
+        square_inventory = SquareInventory(retailer)
+        in_transaction = []
+
+        def get_inventory_counts(catalog_ids, location_ids):
+            in_transaction.append(connection.in_atomic_block)
+            return [
+                {"catalog_object_id": "V1", "location_id": location.pos_id, "quantity": "4"}
+            ]
+
+        with mock.patch.object(
+            square_inventory._request_client,
+            "get_inventory_counts",
+            side_effect=get_inventory_counts,
+        ), mock.patch.object(CatalogCache, "bump"):
+            square_inventory.store_update([square_item("New", 700, [location.pos_id])])
+
+        self.assertEqual(in_transaction, [False])
+        self.assertEqual(Product.objects.get().total_stock, 4)
+
+    def test_stock_is_refreshed_for_the_delta_variations_only(self):
+        retailer, location, inventory = create_retailer()
+        create_product(inventory, "I2", ("V2", 1, 5, "222"))
+        square_inventory = SquareInventory(retailer)
+        count = {"catalog_object_id": "V1", "location_id": location.pos_id, "quantity": "4"}
+
+        with mock.patch.object(
+            square_inventory._request_client, "get_inventory_counts", return_value=[count]
+        ) as get_inventory_counts, mock.patch.object(CatalogCache, "bump"):
+            square_inventory.store_update([square_item("New", 700, [location.pos_id])])
+
+        get_inventory_counts.assert_called_once_with(["V1"], [location.pos_id])
+        self.assertEqual(
+            dict(Product.objects.values_list("origin_id", "total_stock")), {"I1": 4, "I2": 0}
+        )
+
+
+class SquareDeltaSyncTests(TestCase):
+    def setUp(self):
+        self.retailer, self.location, inventory = create_retailer()
+        create_product(inventory, "I1", ("V1", 1, 5, "111"))
+
+    def test_full_sync_is_needed_without_a_recent_watermark(self):
+        square_inventory = SquareInventory(self.retailer)
+        self.assertIsNone(square_inventory.delta_sync_since())
+
+        self.retailer.inventory_synced_at = (
+            timezone.now() - SquareInventory.DELTA_SYNC_MAX_AGE - timedelta(minutes=1)
+        )
+        self.assertIsNone(square_inventory.delta_sync_since())
+
+        self.retailer.inventory_synced_at = timezone.now() - timedelta(hours=1)
+        self.assertEqual(
+            square_inventory.delta_sync_since(), self.retailer.inventory_synced_at
+        )
+
+    def test_delta_follows_the_cursor_and_applies_counts_changed_since_the_watermark(self):
+        pages = {None: {"objects": [], "cursor": "C2"}, "C2": {"objects": []}}
+        searched = []
+
+        def search_catalog_by_date(client, updated_at):
+            searched.append((client.cursor, updated_at))
+            return pages[client.cursor]
+
+        count = {
+            "catalog_object_id": "V1",
+            "location_id": self.location.pos_id,
+            "quantity": "4",
+            "state": "IN_STOCK",
+            "calculated_at": at(12).isoformat(),
+        }
+        with mock.patch.object(
+            SquareRequestClient,
+            "search_catalog_by_date",
+            autospec=True,
+            side_effect=search_catalog_by_date,
+        ), mock.patch.object(SquareRequestClient, "get_catalog") as get_catalog, mock.patch.object(
+            SquareRequestClient, "get_inventory_counts", return_value=[count]
+        ) as get_inventory_counts:
+            first_page = SquareInventory(self.retailer).run(updated_since=at(10))
+            last_page = SquareInventory(self.retailer, cursor=first_page["cursor"]).run(
+                updated_since=at(10)
+            )
+
+        self.assertEqual(first_page["cursor"], "C2")
+        self.assertTrue(first_page["fetch_next"])
+        self.assertEqual(last_page, {"result": True, "fetch_next": False})
+        self.assertEqual(
+            searched,
+            [(None, "2024-01-01T10:00:00.000Z"), ("C2", "2024-01-01T10:00:00.000Z")],
+        )
+        get_catalog.assert_not_called()
+        get_inventory_counts.assert_called_once_with(updated_after="2024-01-01T10:00:00.000Z")
+        self.assertEqual(Variant.objects.get(origin_id="V1").stock, 4)
+        self.assertEqual(Product.objects.get().total_stock, 4)
+
+
+class SquareInventoryTaskTests(TestCase):
+    def setUp(self):
+        self.retailer, _, _ = create_retailer()
+        self.retailer.expires_at = timezone.now() + timedelta(days=1)
+        self.retailer.inventory_synced_at = timezone.now() - timedelta(hours=1)
+        self.retailer.save()
+
+    def test_every_page_is_loaded_and_the_watermark_moves_to_the_sync_start(self):
+        watermark = self.retailer.inventory_synced_at
+        runs = []
+
+        def run(square_inventory, updated_since=None):
+            runs.append((square_inventory._cursor, updated_since))
+            if square_inventory._cursor is None:
+                return {"result": True, "fetch_next": True, "cursor": "C2"}
+            return {"result": True, "fetch_next": False}
+
+        started_at = timezone.now()
+        with mock.patch.object(SquareInventory, "run", autospec=True, side_effect=run), mock.patch(
+            "inventories.tasks.run_go_upc_integration.delay"
+        ):
+            load_square_inventory.run(retailer_id=self.retailer.pk)
+
+        self.assertEqual(runs, [(None, watermark), ("C2", watermark)])
+        self.retailer.refresh_from_db()
+        self.assertGreaterEqual(self.retailer.inventory_synced_at, started_at)
+        self.assertFalse(self.retailer.is_sync)
+
+    def test_full_sync_ignores_the_watermark(self):
+        with mock.patch.object(
+            SquareInventory, "run", return_value={"result": True, "fetch_next": False}
+        ) as run, mock.patch("inventories.tasks.run_go_upc_integration.delay"):
+            load_square_inventory.run(retailer_id=self.retailer.pk, full_sync=True)
+
+        run.assert_called_once_with(updated_since=None)
+
+
+class SquareOrderStoreTests(TestCase):
+    def setUp(self):
+        self.retailer, self.location, inventory = create_retailer()
+        create_product(inventory, "I1", ("V1", 5, 5, "111"))
+        Customer.objects.create(origin_id="C1", first_name="Ann", last_name="Lee")
+        self.reservation = SquareReservation(self.retailer)
+
+    def order(self, origin_id, quantity, customer_id=None, version=1):
+        def money(amount):
+            return {"amount": amount, "currency": "USD"}
+
+        def line_item(item_type, quantity, price, **fields):
+            return {
+                "item_type": item_type,
+                "quantity": quantity,
+                "base_price_money": money(price),
+                "variation_total_price_money": money(price),
+                "total_tax_money": money(0),
+                "total_money": money(price),
+                **fields,
+            }
+
+        return {
+            "id": origin_id,
+            "location_id": self.location.pos_id,
+            "state": "OPEN",
+            "version": version,
+            "created_at": "2024-01-01T10:00:00Z",
+            "customer_id": customer_id,
+            "total_money": money(1000),
+            "total_tax_money": money(100),
+            "net_amounts": {"total_money": money(900)},
+            "fulfillments": [
+                {
+                    "uid": f"{origin_id}-F1",
+                    "pickup_details": {
+                        "pickup_at": "2024-01-01T12:00:00Z",
+                        "recipient": {"display_name": "Ann"},
+                    },
+                }
+            ],
+            "line_items": [
+                line_item("ITEM", quantity, 500, catalog_object_id="V1"),
+                line_item("CUSTOM_AMOUNT", "1", 5),
+                line_item("ITEM", "1", 100, catalog_object_id="UNKNOWN"),
+            ],
+        }
+
+    def test_orders_are_upserted_and_their_items_replaced(self):
+        self.reservation.store_orders([self.order("O1", "2", "C1"), self.order("O2", "1")])
+        self.reservation.store_orders([self.order("O1", "5", "C1", version=2)])
+
+        order = Order.objects.get(origin_id="O1")
+        self.assertEqual(Order.objects.count(), 2)
+        self.assertEqual(order.order_code, "#{:06d}".format(order.id))
+        self.assertEqual((order.quantity, order.version, order.total), (6, 2, 9))
+        self.assertEqual(order.customer.origin_id, "C1")
+        self.assertIsNone(Order.objects.get(origin_id="O2").customer)
+        self.assertEqual(
+            sorted(order.order_items.values_list("item_type", "quantity", "unit_price")),
+            [
+                (OrderItem.TYPE_ITEM, 5, Decimal("5")),
+                (OrderItem.TYPE_CUSTOM_AMOUNT, 1, Decimal("0.05")),
+            ],
+        )
+        self.assertEqual(OrderItem.objects.count(), 4)
+        self.assertEqual(
+            set(OrderPickup.objects.values_list("origin_id", "order__origin_id")),
+            {("O1-F1", "O1"), ("O2-F1", "O2")},
+        )
+
+    def test_earliest_unmapped_order_is_returned_and_the_rest_stored(self):
+        failed_at = self.reservation.store_orders(
+            [
+                {"id": "BAD1", "updated_at": "2024-01-01T11:00:00Z"},
+                self.order("O1", "1"),
+                {"id": "BAD2", "updated_at": "2024-01-01T09:00:00Z"},
+            ]
+        )
+
+        self.assertEqual(failed_at, at(9))
+        self.assertEqual(list(Order.objects.values_list("origin_id", flat=True)), ["O1"])
+
+
+class CloverOrderStoreTests(TestCase):
+    def setUp(self):
+        self.retailer, _, inventory = create_retailer(Retailer.CLOVER, "CM1")
+        create_product(inventory, "P1", ("I1", 5, 2.5, "111"))
+        self.reservation = CloverReservation(self.retailer)
+
+    def order(self, origin_id, *item_ids):
+        return {
+            "id": origin_id,
+            "total": 1000,
+            "state": "locked",
+            "createdTime": int(at(10).timestamp() * 1000),
+            "lineItems": {
+                "elements": [{"item": {"id": item_id}, "price": 250} for item_id in item_ids]
+                + [{"name": "Custom", "price": 5}]
+            },
+        }
+
+    def test_orders_are_upserted_and_line_items_aggregated_per_variant(self):
+        self.reservation.store_orders([self.order("CO1", "I1", "I1"), self.order("CO2", "I1")])
+        self.reservation.store_orders([self.order("CO1", "I1", "I1", "I1")])
+
+        order = Order.objects.get(origin_id="CO1")
+        self.assertEqual(Order.objects.count(), 2)
+        self.assertEqual(order.order_code, "#{:06d}".format(order.id))
+        self.assertEqual(order.order_time, at(10))
+        self.assertEqual(
+            list(order.order_items.values_list("quantity", "unit_price", "variation_total")),
+            [(3, Decimal("2.5"), Decimal("7.5"))],
+        )
+        self.assertEqual(OrderItem.objects.count(), 2)
+
+    def test_missing_items_are_fetched_after_the_page_commits(self):
+        order = self.order("CO1", "I1", "NEW")
+        with mock.patch(
+            "inventories.tasks.fetch_clover_order_items.delay"
+        ) as delay, self.captureOnCommitCallbacks(execute=True):
+            self.reservation.store_orders([order])
+            delay.assert_not_called()
+
+        delay.assert_called_once_with(
+            retailer_id=self.retailer.pk, item_ids=["NEW"], orders=[order]
+        )
+        self.assertEqual(Order.objects.get().order_items.count(), 1)
+
+
+class SquareCustomerImportTests(TestCase):
+    def setUp(self):
+        self.retailer, _, _ = create_retailer()
+
+    @staticmethod
+    def customer(origin_id, given_name):
+        return {"id": origin_id, "given_name": given_name, "family_name": "Lee"}
+
+    def test_customers_are_upserted_one_page_at_a_time(self):
+        Customer.objects.create(origin_id="C1", first_name="Old", last_name="Lee")
+        pages = [
+            [self.customer("C1", "Ann"), self.customer("C2", "Bo"), self.customer("C2", "Bob")],
+            [self.customer("C3", "Cy")],
+        ]
+
+        with mock.patch.object(
+            SquareRequestClient, "list_customers", return_value=iter(pages)
+        ), self.assertNumQueries(2):
+            SquareCustomer.fetch_all_customers(self.retailer)
+
+        self.assertEqual(
+            set(Customer.objects.values_list("origin_id", "first_name", "retailer")),
+            {
+                ("C1", "Ann", self.retailer.pk),
+                ("C2", "Bob", self.retailer.pk),
+                ("C3", "Cy", self.retailer.pk),
+            },
+        )
+
+    def test_list_customers_follows_the_cursor(self):
+        def response(customers, cursor=None):
+            body = {"customers": customers, "cursor": cursor}
+            return mock.Mock(is_error=lambda: False, body=body)
+
+        client = SquareRequestClient("token")
+        client.client = mock.Mock()
+        client.client.customers.list_customers.side_effect = [
+            response([{"id": "C1"}], cursor="C2"),
+            response([{"id": "C2"}]),
+        ]
+
+        self.assertEqual(list(client.list_customers()), [[{"id": "C1"}], [{"id": "C2"}]])
+        self.assertEqual(
+            [
+                call.kwargs["cursor"]
+                for call in client.client.customers.list_customers.call_args_list
+            ],
+            [None, "C2"],
+        )
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class WebhookEventTests(TestCase):
+    def square_event(self, event_id, event_type, object_id=None, payload=None):
+        return SquareWebhook.build_event(
+            {
+                "merchant_id": "M1",
+                "event_id": event_id,
+                "type": event_type,
+                "data": {"id": object_id, "object": payload or {}},
+            }
+        )
+
+    def order_event(self, event_id, order_id):
+        return self.square_event(
+            event_id, "order.updated", order_id, {"order_updated": {"order_id": order_id}}
+        )
+
+    def test_square_consumer_processes_one_batch_per_coalescing_key(self):
+        WebhookEventRepository().store(
+            [
+                self.square_event("E1", "catalog.version.updated"),
+                self.order_event("E2", "O1"),
+                self.square_event("E3", "inventory.count.updated"),
+                self.square_event("E4", "catalog.version.updated"),
+                self.order_event("E5", "O2"),
+                self.order_event("E6", "O1"),
+                self.square_event("E7", "customer.updated", "C1"),
+                self.square_event("E8", "inventory.count.updated"),
+            ]
+        )
+
+        batches = []
+        with mock.patch.object(
+            SquareWebhook,
+            "process_events",
+            lambda webhook, events: batches.append([event.event_id for event in events]),
+        ):
+            process_webhook_events.run(WebhookEvent.SQUARE, "M1")
+
+        self.assertEqual(
+            batches,
+            [["E1", "E4"], ["E2", "E6"], ["E3", "E8"], ["E5"], ["E7"]],
+        )
+        self.assertFalse(
+            WebhookEvent.objects.exclude(status=WebhookEvent.STATUS_SUCCESS).exists()
+        )
+
+    def test_redelivered_events_are_stored_once(self):
+        repository = WebhookEventRepository()
+        repository.store([self.order_event("E1", "O1")])
+        repository.store([self.order_event("E1", "O1"), self.order_event("E2", "O2")])
+
+        self.assertEqual(
+            sorted(WebhookEvent.objects.values_list("event_id", "status")),
+            [("E1", WebhookEvent.STATUS_PENDING), ("E2", WebhookEvent.STATUS_PENDING)],
+        )
+
+    def test_failed_events_are_marked_failed(self):
+        WebhookEventRepository().store(
+            [self.order_event("E1", "O1"), self.order_event("E2", "O1")]
+        )
+
+        with mock.patch.object(SquareWebhook, "process_event", side_effect=ValueError("boom")):
+            process_webhook_events.run(WebhookEvent.SQUARE, "M1")
+
+        self.assertEqual(
+            set(WebhookEvent.objects.values_list("status", "attempts")),
+            {(WebhookEvent.STATUS_FAILED, 1)},
+        )
+
+    def test_failed_square_catalog_update_is_marked_failed(self):
+        create_retailer()
+        WebhookEventRepository().store(
+            [
+                self.square_event(
+                    "E1",
+                    "catalog.version.updated",
+                    payload={"catalog_version": {"updated_at": "2024-01-01T10:00:00.000Z"}},
+                )
+            ]
+        )
+
+        with mock.patch.object(SquareInventory, "fetch", side_effect=ValueError("Square down")):
+            process_webhook_events.run(WebhookEvent.SQUARE, "M1")
+
+        event = WebhookEvent.objects.get()
+        self.assertEqual(event.status, WebhookEvent.STATUS_FAILED)
+        self.assertIn("Square down", event.error)
+
+    def test_clover_item_events_are_merged_and_last_action_wins(self):
+        create_retailer(Retailer.CLOVER, "CM1")
+        events = CloverWebhook.build_events(
+            {
+                "appId": "app",
+                "merchants": {
+                    "CM1": [
+                        {"objectId": "I:1", "type": "CREATE", "ts": 1},
+                        {"objectId": "I:2", "type": "UPDATE", "ts": 2},
+                        {"objectId": "I:1", "type": "DELETE", "ts": 3},
+                        {"objectId": "I:3", "type": "UPDATE", "ts": 4},
+                    ]
+                },
+            }
+        )
+        webhook = CloverWebhook()
+        self.assertEqual({webhook.coalesce_key(event) for event in events}, {("I",)})
+
+        with mock.patch.object(CloverInventory, "run_items") as run_items, mock.patch.object(
+            CloverInventory, "delete"
+        ) as delete, mock.patch("common.pos.clover.clover_webhook.run_go_upc_integration"):
+            webhook.process_events(events)
+
+        run_items.assert_called_once_with(["2", "3"])
+        delete.assert_called_once_with(item_id="1")
+
+    def test_clover_events_without_timestamp_are_not_deduplicated(self):
+        events = CloverWebhook.build_events(
+            {
+                "appId": "app",
+                "merchants": {
+                    "CM1": [
+                        {"objectId": "O:1", "type": "UPDATE", "object": {"state": "open"}},
+                        {"objectId": "O:1", "type": "UPDATE", "object": {"state": "locked"}},
+                    ]
+                },
+            }
+        )
+
+        self.assertEqual(len({event.event_id for event in events}), 2)
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class ProductCardRefreshTests(TestCase):
+    def setUp(self):
+        self.retailer, _, inventory = create_retailer()
+        self.product = create_product(inventory, "I1", ("V1", 2, 7, "111"), ("V2", 3, 4, "222"))
+        self.other_product = create_product(inventory, "I2", ("V3", 1, 5, "333"))
+        self.repository = ProductCardRepository()
+
+    def test_refresh_builds_one_card_per_product(self):
+        self.assertEqual(self.repository.refresh(self.retailer.id), 2)
+
+        card = ProductCard.objects.get(product=self.product)
+        self.assertEqual(card.retailer_id, self.retailer.id)
+        self.assertEqual(card.retailer_name, self.retailer.name)
+        self.assertEqual(card.price, 7)
+        self.assertEqual(card.variant_count, 2)
+
+    def test_unchanged_cards_are_not_rewritten(self):
+        self.repository.refresh(self.retailer.id)
+
+        with mock.patch.object(CatalogCache, "bump") as bump, self.captureOnCommitCallbacks(
+            execute=True
+        ):
+            self.assertEqual(self.repository.refresh(self.retailer.id), 0)
+        bump.assert_not_called()
+
+    def test_changed_card_is_rewritten_and_bumps_the_catalog(self):
+        self.repository.refresh(self.retailer.id)
+        Product.objects.filter(pk=self.product.pk).update(name="Renamed")
+
+        with mock.patch.object(CatalogCache, "bump") as bump, self.captureOnCommitCallbacks(
+            execute=True
+        ):
+            self.assertEqual(self.repository.refresh(self.retailer.id), 1)
+            bump.assert_not_called()
+        bump.assert_called_once()
+        self.assertEqual(ProductCard.objects.get(product=self.product).name, "Renamed")
+
+    def test_refresh_listings_builds_cards_and_upc_index_of_products(self):
+        self.repository.refresh_listings(self.retailer.id, [self.product.pk])
+
+        self.assertEqual(
+            list(ProductCard.objects.values_list("product_id", flat=True)), [self.product.pk]
+        )
+        self.assertEqual(
+            set(UpcIndex.objects.values_list("product_id", "code")),
+            {(self.product.pk, "111"), (self.product.pk, "222")},
+        )
+
+    def test_refresh_limited_to_product_ids(self):
+        self.repository.refresh(self.retailer.id)
+        Product.objects.update(name="Renamed")
+
+        self.repository.refresh(product_ids=[self.product.pk])
+
+        self.assertEqual(
+            dict(ProductCard.objects.values_list("product_id", "name")),
+            {self.product.pk: "Renamed", self.other_product.pk: "I2"},
+        )
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class ProductCardSearchTests(TestCase):
+    def setUp(self):
+        _, _, inventory = create_retailer()
+        self.pie = create_product(inventory, "Apple pie", ("V1", 1, 5, "111"))
+        self.dish = create_product(inventory, "Pie dish", ("V2", 1, 5, "222"))
+        self.dish.description = "Bakes an apple pie"
+        self.dish.save()
+        create_product(inventory, "Banana", ("V3", 1, 5, "333"))
+        self.repository = ProductCardRepository()
+        self.repository.refresh()
+
+    def product_names(self, text):
+        return [card.name for card in self.repository.search(text)]
+
+    def test_empty_text_lists_every_card_by_name(self):
+        self.assertEqual(self.product_names(" "), ["Apple pie", "Banana", "Pie dish"])
+
+    @skipUnless(connection.vendor == "postgresql", "Full-text search needs PostgreSQL")
+    def test_every_word_matches_as_a_prefix(self):
+        self.assertEqual(self.product_names("ban"), ["Banana"])
+        self.assertEqual(self.product_names("pie ban"), [])
+
+    @skipUnless(connection.vendor == "postgresql", "Full-text search needs PostgreSQL")
+    def test_name_matches_rank_above_description_matches(self):
+        self.assertEqual(self.product_names("app pie"), ["Apple pie", "Pie dish"])
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class CatalogCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_entries_are_rebuilt_after_a_bump(self):
+        builder = mock.Mock(side_effect=["first", "second"])
+
+        self.assertEqual(CatalogCache.get_or_set("home", builder), "first")
+        self.assertEqual(CatalogCache.get_or_set("home", builder), "first")
+        CatalogCache.bump()
+        self.assertEqual(CatalogCache.get_or_set("home", builder), "second")
+        self.assertEqual(builder.call_count, 2)
+
+    def test_bump_before_any_read_starts_the_version(self):
+        CatalogCache.bump()
+
+        self.assertEqual(CatalogCache.version(), 1)
+        CatalogCache.bump()
+        self.assertEqual(CatalogCache.version(), 2)
+
+
+class ProductTotalsTests(TestCase):
+    def setUp(self):
+        self.retailer, _, inventory = create_retailer()
+        self.product = create_product(inventory, "I1", ("V1", 2, 9, "111"), ("V2", -5, 2, "222"))
+        self.single = create_product(inventory, "I2", ("V3", 4, 5, "333"))
+        Product.objects.filter(pk=self.single.pk).update(min_price=4, max_price=4)
+        self.repository = ProductRepository()
+
+    def test_totals_are_recomputed_for_changed_products(self):
+        with self.assertNumQueries(1):
+            changed = self.repository.update_totals(self.retailer.id)
+
+        self.assertEqual(changed, {self.product.pk, self.single.pk})
+
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.total_stock, 0)
+        self.assertEqual((self.product.min_price, self.product.max_price), (2, 9))
+        self.single.refresh_from_db()
+        self.assertEqual(self.single.total_stock, 4)
+        self.assertEqual((self.single.min_price, self.single.max_price), (4, 4))
+
+    def test_unchanged_products_are_not_saved(self):
+        self.repository.update_totals(self.retailer.id)
+
+        self.assertEqual(self.repository.update_totals(self.retailer.id), set())
+
+    def test_update_limited_to_product_ids(self):
+        self.assertEqual(
+            self.repository.update_totals(self.retailer.id, product_ids=[self.single.pk]),
+            {self.single.pk},
+        )
+        self.product.refresh_from_db()
+        self.assertIsNone(self.product.max_price)
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class RelatedItemsTests(TestCase):
+    def setUp(self):
+        self.retailer, _, inventory = create_retailer()
+        self.other_retailer, _, other_inventory = create_retailer(Retailer.CLOVER, "CM1")
+        self.expensive = create_product(inventory, "A", ("A1", 1, 5, "111"))
+        self.cheapest = create_product(other_inventory, "B", ("B1", 1, 3, "111"))
+        self.without_upc = create_product(inventory, "C", ("C1", 1, 9, None))
+        ProductCardRepository().refresh()
+        UpcIndexRepository().refresh()
+
+    def related_items(self):
+        return dict(ProductCard.objects.values_list("product_id", "is_related_item"))
+
+    def test_cheapest_offer_of_a_upc_and_products_without_upc_are_related(self):
+        self.assertEqual(
+            self.related_items(),
+            {self.expensive.pk: False, self.cheapest.pk: True, self.without_upc.pk: True},
+        )
+
+    @mock.patch.object(ProductCardRepository, "BATCH_SIZE", 1)
+    def test_other_retailers_selling_the_upcs_are_refreshed(self):
+        Variant.objects.filter(origin_id="B1").update(price=7)
+
+        ProductCardRepository().refresh_related_items(
+            {"111", "222"}, retailer_id=self.other_retailer.id
+        )
+
+        self.assertTrue(self.related_items()[self.expensive.pk])
+        self.assertFalse(self.related_items()[self.cheapest.pk])
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class GoUpcEnrichmentTests(TestCase):
+    def setUp(self):
+        self.retailer, _, inventory = create_retailer()
+        create_product(
+            inventory,
+            "I1",
+            ("V1", 1, 5, "111"),
+            ("V2", 1, 5, "111"),
+            ("V3", 1, 5, "222"),
+            ("V4", 1, 5, "333"),
+        )
+        self.client = mock.Mock(spec=GoUPC)
+        self.client.is_configured.return_value = True
+        self.client.lookup.side_effect = self.lookup
+
+    @staticmethod
+    def lookup(code):
+        if code == "222":
+            return None
+        if code == "333":
+            raise ValueError("Go UPC unavailable")
+        return {"description": f"About {code}"}
+
+    def enrich(self):
+        return GoUpcEnrichment(self.retailer.id, self.client).run()
+
+    def test_each_code_is_looked_up_once_and_applied(self):
+        self.assertEqual(self.enrich(), 3)
+
+        self.assertCountEqual(
+            [call.args[0] for call in self.client.lookup.call_args_list], ["111", "222", "333"]
+        )
+        self.assertEqual(
+            dict(Variant.objects.values_list("origin_id", "description")),
+            {"V1": "About 111", "V2": "About 111", "V3": "", "V4": ""},
+        )
+        self.assertEqual(
+            dict(UpcLookup.objects.values_list("code", "found")), {"111": True, "222": False}
+        )
+
+    def test_failed_lookups_are_retried_and_known_codes_are_not(self):
+        self.enrich()
+        self.client.lookup.reset_mock()
+
+        self.assertEqual(self.enrich(), 0)
+        self.client.lookup.assert_called_once_with("333")
+        self.assertIsNone(Variant.objects.get(origin_id="V4").go_upc_code)
+
+    def test_changed_code_reuses_the_stored_result(self):
+        self.enrich()
+        self.client.lookup.reset_mock()
+        Variant.objects.filter(origin_id="V3").update(upc="111")
+
+        self.enrich()
+
+        self.assertEqual([call.args[0] for call in self.client.lookup.call_args_list], ["333"])
+        self.assertEqual(Variant.objects.get(origin_id="V3").description, "About 111")
+
+
+class BackoffRetryTests(SimpleTestCase):
+    def setUp(self):
+        self.retry = BackoffRetry(total=3, backoff_factor=1, status_forcelist=(500, 503))
+
+    def test_rate_limited_calls_are_retried_for_every_method(self):
+        self.assertTrue(self.retry.is_retry("POST", 429))
+        self.assertTrue(self.retry.is_retry("GET", 429))
+        self.assertFalse(BackoffRetry(total=0).is_retry("GET", 429))
+
+    def test_server_errors_are_retried_for_idempotent_methods_only(self):
+        self.assertTrue(self.retry.is_retry("GET", 500))
+        self.assertFalse(self.retry.is_retry("POST", 500))
+
+    def test_backoff_is_jittered_up_to_the_exponential_backoff(self):
+        retry = self.retry.new(history=(RequestHistory("GET", "/", None, 500, None),) * 3)
+
+        with mock.patch("common.pos.http.random.uniform", return_value=1.5) as uniform:
+            self.assertEqual(retry.get_backoff_time(), 1.5)
+        uniform.assert_called_once_with(0, 4)
+
+
+class RateLimiterTests(SimpleTestCase):
+    def setUp(self):
+        self.limiter = RateLimiter(f"test-{uuid4().hex}", rate=1, capacity=2)
+
+    @mock.patch("common.pos.rate_limit.time.sleep")
+    @mock.patch("common.pos.rate_limit.get_redis_connection")
+    def test_acquire_waits_until_a_token_is_available(self, _, sleep):
+        with mock.patch.object(
+            self.limiter, "_take_token", side_effect=[0.5, 0.25, 0]
+        ), mock.patch.object(self.limiter, "_record") as record:
+            self.assertEqual(self.limiter.acquire("M1"), 0.75)
+
+        self.assertEqual([call.args[0] for call in sleep.call_args_list], [0.5, 0.25])
+        record.assert_called_once_with(mock.ANY, "M1", 0.75)
+
+    @mock.patch("common.pos.rate_limit.get_redis_connection", side_effect=NotImplementedError)
+    def test_acquire_does_not_block_without_redis(self, _):
+        self.assertEqual(self.limiter.acquire("M1"), 0)
+
+    def test_bucket_script_takes_tokens_up_to_capacity(self):
+        try:
+            connection = get_redis_connection("default")
+            connection.ping()
+        except Exception:
+            self.skipTest("Redis is not available")
+
+        self.addCleanup(connection.delete, self.limiter._key("M1", "bucket"))
+        waits = [self.limiter._take_token(connection, "M1") for _ in range(3)]
+
+        self.assertEqual(waits[:2], [0, 0])
+        self.assertGreater(waits[2], 0)
+        self.assertLessEqual(waits[2], 1)
@@ -2,13 +2,13 @@ import json
 import logging
 from http import HTTPStatus
 
-from django.core.cache import cache
 from django.http import JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 
 from common.pos.clover.clover_webhook import CloverWebhook
 from common.pos.square.square_webhook import SquareWebhook
 from .models import VariantImage
+from .tasks import queue_webhook_events
 
 logger = logging.getLogger(__name__)
 
@@ -34,7 +34,11 @@ def webhook_clover_events(request):
             {"error": "Method Not Allowed"}, status=HTTPStatus.METHOD_NOT_ALLOWED
         )
 
-    request_body = json.loads(request.body)
+    try:
+        request_body = json.loads(request.body)
+    except ValueError as e:
+        logger.error(f"Invalid Clover webhook body, exception: {e}")
+        return JsonResponse({"success": False}, status=HTTPStatus.BAD_REQUEST)
 
     if request_body.get("verificationCode") is not None:
         try:
@@ -56,14 +60,13 @@ def webhook_clover_events(request):
             )
 
     try:
-        webhook_service.process_events(body=request_body)
-    except KeyError as e:
-        logger.error("Error processing Clover request body, exception: ", e)
+        events = webhook_service.build_events(request_body)
+    except (KeyError, ValueError, AttributeError) as e:
+        logger.error(f"Error processing Clover request body, exception: {e}")
         return JsonResponse({"success": False}, status=HTTPStatus.BAD_REQUEST)
-    except Exception as e:
-        logger.error("Error processing Clover webhook event, exception: ", e)
-        return JsonResponse({"success": False}, status=HTTPStatus.INTERNAL_SERVER_ERROR)
 
+    # Events are processed by the webhook consumer, Clover only waits for the ack
+    queue_webhook_events(events)
     return JsonResponse({"success": True}, status=HTTPStatus.OK)
 
 
@@ -74,40 +77,12 @@ def webhook_square_event(request):
             {"error": "Method Not Allowed"}, status=HTTPStatus.METHOD_NOT_ALLOWED
         )
 
-    request_body = json.loads(request.body)
-
-    event_type = request_body["type"]
-    event_id = request_body["event_id"]
-    merchant_id = request_body["merchant_id"]
-
-    cached_trace = json.loads(cache.get(f"{merchant_id}_{event_id}", "{}"))
-
-    if len(cached_trace) != 0:
-        if (
-            cached_trace["event_id"] == event_id
-            and cached_trace["event_type"] == event_type
-            and cached_trace["status"] == "PROCESS"
-        ):
-            return JsonResponse(
-                {"success": False, "message": "Event was queued previously"},
-                status=HTTPStatus.TOO_EARLY,
-            )
-        elif (
-            cached_trace["event_id"] == event_id
-            and cached_trace["event_type"] == event_type
-            and cached_trace["status"] == "SUCCESS"
-        ):
-            return JsonResponse(
-                {"success": True},
-                status=HTTPStatus.OK,
-            )
-
-    webhook_service = SquareWebhook()
-    webhook_service.process_events(
-        merchant_id=merchant_id,
-        event_id=event_id,
-        event_type=event_type,
-        body=request_body.get("data").get("object"),
-    )
+    try:
+        event = SquareWebhook.build_event(json.loads(request.body))
+    except (KeyError, ValueError, AttributeError, TypeError) as e:
+        logger.error(f"Error processing Square request body, exception: {e}")
+        return JsonResponse({"success": False}, status=HTTPStatus.BAD_REQUEST)
 
+    # Redelivered events are stored once, so they are acknowledged as well
+    queue_webhook_events([event])
     return JsonResponse({"success": True}, status=HTTPStatus.OK)
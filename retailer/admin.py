@@ -7,6 +7,8 @@ from django.template.response import TemplateResponse
 from django.urls import reverse, path
 from django.utils.html import format_html
 
+from common.pos.clover.clover_client import CloverRequestClient
+from common.pos.square.square_client import SquareRequestClient
 from . import views
 from .forms import RetailerForm
 from .models import Retailer, Category, ShoppingCenter, Location
@@ -38,6 +40,8 @@ class RetailerAdmin(admin.ModelAdmin):
         "expires_at",
         "square_csrf",
         "is_sync",
+        "inventory_synced_at",
+        "orders_synced_at",
     )
     list_display = (
         "id",
@@ -50,6 +54,7 @@ class RetailerAdmin(admin.ModelAdmin):
         "action_retailer_buttons",
     )
     list_display_links = ("name",)
+    readonly_fields = ("pos_rate_limit",)
     form = RetailerForm
 
     inlines = [LocationInline]
@@ -111,9 +116,24 @@ class RetailerAdmin(admin.ModelAdmin):
             return False
         return not obj.is_access_token_expired()
 
+    def pos_rate_limit(self, obj: Retailer):
+        rate_limiter = {
+            Retailer.CLOVER: CloverRequestClient.RATE_LIMITER,
+            Retailer.SQUARE: SquareRequestClient.RATE_LIMITER,
+        }.get(obj.origin)
+        if rate_limiter is None or not obj.merchant_id:
+            return "-"
+        metrics = rate_limiter.metrics(obj.merchant_id)
+        return (
+            f"{metrics['requests']} requests, {metrics['throttled']} throttled, "
+            f"{metrics['wait_seconds']:.1f}s spent waiting"
+        )
+
     action_retailer_buttons.short_description = "Actions"
     action_retailer_buttons.allow_tags = True
 
+    pos_rate_limit.short_description = "POS rate limit (last day)"
+
     connected.boolean = True
     connected.sortable_by = True
     connected.ordering = True
@@ -0,0 +1,22 @@
+# Generated by Django 4.2.3 on 2026-10-18 13:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("retailer", "0022_alter_retailer_origin"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="retailer",
+            name="inventory_synced_at",
+            field=models.DateTimeField(
+                blank=True,
+                help_text="Start time of the last successful inventory sync, used as the delta sync watermark",
+                null=True,
+                verbose_name="Inventory Sync Date",
+            ),
+        ),
+    ]
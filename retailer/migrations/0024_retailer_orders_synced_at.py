@@ -0,0 +1,22 @@
+# Generated by Django 4.2.3 on 2026-10-18 13:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("retailer", "0023_retailer_inventory_synced_at"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="retailer",
+            name="orders_synced_at",
+            field=models.DateTimeField(
+                blank=True,
+                help_text="Start time of the last successful order sync, used as the delta sync watermark",
+                null=True,
+                verbose_name="Orders Sync Date",
+            ),
+        ),
+    ]
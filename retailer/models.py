@@ -79,6 +79,20 @@ class Retailer(BaseTimeModel):
 
     is_sync = models.BooleanField(default=False)
 
+    inventory_synced_at = models.DateTimeField(
+        verbose_name="Inventory Sync Date",
+        null=True,
+        blank=True,
+        help_text="Start time of the last successful inventory sync, used as the delta sync watermark",
+    )
+
+    orders_synced_at = models.DateTimeField(
+        verbose_name="Orders Sync Date",
+        null=True,
+        blank=True,
+        help_text="Start time of the last successful order sync, used as the delta sync watermark",
+    )
+
     status = models.CharField(max_length=12, default=STATUS_REQUESTING, choices=STATUS_CHOICES, db_index=True)
     
     note = models.TextField(default=None, blank=True, null=True)
@@ -112,6 +126,14 @@ class Retailer(BaseTimeModel):
         self.is_sync = is_sync
         self.save()
 
+    def update_inventory_synced_at(self, synced_at: datetime):
+        self.inventory_synced_at = synced_at
+        self.save(update_fields=["inventory_synced_at"])
+
+    def update_orders_synced_at(self, synced_at: datetime):
+        self.orders_synced_at = synced_at
+        self.save(update_fields=["orders_synced_at"])
+
     @staticmethod
     def send_email(message, email, subject):
         mail = EmailMessage(
@@ -1,3 +1,28 @@
+from unittest import mock
+
+from django.contrib.admin.sites import AdminSite
 from django.test import TestCase
 
-# Create your tests here.
+from common.pos.square.square_client import SquareRequestClient
+from retailer.admin import RetailerAdmin
+from retailer.models import Retailer
+
+
+class RetailerAdminRateLimitTests(TestCase):
+    def setUp(self):
+        self.admin = RetailerAdmin(Retailer, AdminSite())
+
+    def test_shows_the_rate_limit_metrics_of_the_retailer_pos(self):
+        retailer = Retailer(origin=Retailer.SQUARE, merchant_id="M1")
+        metrics = {"requests": 120, "throttled": 3, "wait_seconds": 1.5}
+
+        with mock.patch.object(
+            SquareRequestClient.RATE_LIMITER, "metrics", return_value=metrics
+        ) as get_metrics:
+            value = self.admin.pos_rate_limit(retailer)
+
+        get_metrics.assert_called_once_with("M1")
+        self.assertEqual(value, "120 requests, 3 throttled, 1.5s spent waiting")
+
+    def test_retailer_without_merchant_has_no_metrics(self):
+        self.assertEqual(self.admin.pos_rate_limit(Retailer(origin=Retailer.SQUARE)), "-")
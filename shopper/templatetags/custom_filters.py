@@ -27,6 +27,11 @@ def calculate_reliability_score(product):
     stock = 0
     variants = []
 
+    # Set on cards and by AvailableStock for a whole page at once
+    available_stock = getattr(product, "available_stock", None)
+    if available_stock is not None:
+        return available_stock
+
     if isinstance(product, Variant):
         stock = product.stock
         variants.append(product.id)
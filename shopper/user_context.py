@@ -0,0 +1,49 @@
+import datetime
+
+from django.utils.functional import cached_property
+
+from inventories.models import Reservation
+from shopper.models import ProductWishlist, RetailerWishlist
+
+
+class UserContext:
+    """
+    Wishlist and reservation ids of the current user, loaded at most once
+    per request with `values_list` so views and templates check membership
+    in a set instead of querying per object.
+    """
+
+    def __init__(self, user):
+        self.user = user
+
+    @classmethod
+    def for_request(cls, request) -> "UserContext":
+        if not hasattr(request, "_user_context"):
+            request._user_context = cls(request.user)
+        return request._user_context
+
+    def _ids(self, queryset, field) -> set:
+        if not self.user.is_authenticated:
+            return set()
+        return set(queryset.filter(user=self.user).values_list(field, flat=True))
+
+    @cached_property
+    def product_wishlist(self) -> set:
+        return self._ids(ProductWishlist.objects.all(), "product_id")
+
+    @cached_property
+    def retailer_wishlist(self) -> set:
+        return self._ids(RetailerWishlist.objects.all(), "retailer_id")
+
+    @cached_property
+    def reserved_product_ids(self) -> set:
+        """
+        Products of the user's upcoming reservations, hidden from listings.
+        """
+        return self._ids(
+            Reservation.objects.filter(
+                time_limit__gte=datetime.datetime.now(),
+                status="RESERVED",
+            ),
+            "variant__product_id",
+        )
@@ -6,11 +6,9 @@ import uuid
 from django.contrib import messages
 from django.core.paginator import Paginator
 from django.db.models import (
-    F,
-    Min,
-    Subquery,
+    Exists,
+    Prefetch,
     OuterRef,
-    DecimalField,
 )
 from django.db.models import Q, Count
 from django.http import JsonResponse, HttpResponseForbidden
@@ -21,11 +19,15 @@ from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import TemplateView, ListView, UpdateView
 from faker import Faker
 
+from common.catalog_cache import CatalogCache
 from common.pos.clover.clover_reservation import CloverReservation
+from common.pos.repositories import ProductCardRepository, UpcIndexRepository
 from common.pos.square.square_reservation import SquareReservation
-from inventories.models import Product, Variant, Reservation
-from retailer.models import Category, Retailer
+from common.stock import AvailableStock
+from inventories.models import Product, ProductCard, Variant, Reservation
+from retailer.models import Category, Location, Retailer
 from shopper.models import ProductWishlist, RetailerWishlist
+from shopper.user_context import UserContext
 
 # Create your views here.
 
@@ -36,40 +38,54 @@ class HomePageView(TemplateView):
     def get(self, request, **kwargs):
         template_name = "index.html"
         if request.user.is_authenticated:
-            upcoming_reservations = Reservation.objects.filter(
-                user=request.user,
-                time_limit__gte=datetime.datetime.now(),
-                status="RESERVED",
-            ).order_by("-time_limit")
+            upcoming_reservations = AvailableStock.attach_to_reservations(
+                Reservation.objects.filter(
+                    user=request.user,
+                    time_limit__gte=datetime.datetime.now(),
+                    status="RESERVED",
+                )
+                .select_related("variant__product__inventory__location__retailer")
+                .order_by("-time_limit")
+            )
         else:
             upcoming_reservations = []
 
-        retailers = Retailer.objects.filter(
-            status=Retailer.STATUS_APPROVED,
+        retailers = CatalogCache.get_or_set(
+            "home:retailers",
+            lambda: list(
+                Retailer.objects.filter(
+                    status=Retailer.STATUS_APPROVED,
+                ).prefetch_related(
+                    Prefetch("location_set", queryset=Location.objects.order_by("id"))
+                )
+            ),
         )
 
-        just_added = Product.objects.filter(
-            is_active=True,
-        ).order_by("-created_at")[:16]
+        just_added = CatalogCache.get_or_set(
+            "home:just_added",
+            lambda: list(
+                ProductCard.objects.filter(
+                    is_active=True,
+                ).order_by("-product_created_at")[:16]
+            ),
+        )
 
         # TODO: check user address for near you
-        near_you = Product.objects.filter(
-            is_active=True,
-        ).exclude(
-            id__in=[p.id for p in just_added] + [p.id for p in upcoming_reservations],
-        ).order_by("-total_stock")[:16]
-
-        user_product_wishlist = {}
-        if request.user.is_authenticated:
-            wishlist = ProductWishlist.objects.filter(user=request.user).all()
-            for wish in wishlist:
-                user_product_wishlist[wish.product.id] = True
-
-        user_retailers_wishlist = {}
-        if self.request.user.is_authenticated:
-            wishlist = RetailerWishlist.objects.filter(user=self.request.user).all()
-            for wish in wishlist:
-                user_retailers_wishlist[wish.retailer.id] = True
+        # Cached for every visitor, the user's reservations are excluded below
+        near_you = CatalogCache.get_or_set(
+            "home:near_you",
+            lambda: list(
+                ProductCard.objects.filter(
+                    is_active=True,
+                ).exclude(
+                    product_id__in=[p.id for p in just_added],
+                ).order_by("-total_stock")[:32]
+            ),
+        )
+        user_context = UserContext.for_request(request)
+        near_you = [
+            p for p in near_you if p.id not in user_context.reserved_product_ids
+        ][:16]
 
         return render(
             request,
@@ -79,8 +95,8 @@ class HomePageView(TemplateView):
                 "just_added": just_added,
                 "retailers": retailers,
                 "upcoming_reservations": upcoming_reservations,
-                "user_products_wishlist": user_product_wishlist,
-                "user_retailers_wishlist": user_retailers_wishlist,
+                "user_products_wishlist": user_context.product_wishlist,
+                "user_retailers_wishlist": user_context.retailer_wishlist,
             },
         )
 
@@ -101,34 +117,25 @@ class RetailerListView(ListView):
         if category_name and category_name not in ["all", ""]:
             qfilter.add(Q(category__name__icontains=category_name), qfilter.connector)
 
-        retailes_query = Retailer.objects.filter(qfilter)
-
-        queryset = []
-
-        for retailer in retailes_query:
-            variants = Variant.objects.filter(
-                product__inventory__location__retailer=retailer,
-                price__gt=0.00,
-            ).count()
-
-            if variants > 0:
-                queryset.append(retailer)
+        # Only list retailers with at least one sellable variant
+        priced_variants = Variant.objects.filter(
+            product__inventory__location__retailer=OuterRef("pk"),
+            price__gt=0.00,
+        )
 
-        return queryset
+        return (
+            Retailer.objects.filter(qfilter)
+            .filter(Exists(priced_variants))
+            .prefetch_related(
+                Prefetch("location_set", queryset=Location.objects.order_by("id"))
+            )
+            .distinct()
+            .order_by("id")
+        )
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
 
-        queryset = self.get_queryset()
-
-        paginator = Paginator(queryset, self.paginate_by)
-
-        page_number = self.request.GET.get("page")
-
-        page_obj = paginator.get_page(page_number)
-
-        context["page_obj"] = page_obj
-        context["is_paginated"] = page_obj.has_other_pages()
         context["categories"] = (
             Category.objects.values("name", "id")
             .annotate(retailer_count=Count("retailer"))
@@ -137,12 +144,9 @@ class RetailerListView(ListView):
         context["score"] = random.randint(1, 100)
         context["current_category"] = self.request.GET.get("category")
 
-        user_retailers_wishlist = {}
-        if self.request.user.is_authenticated:
-            wishlist = RetailerWishlist.objects.filter(user=self.request.user).all()
-            for wish in wishlist:
-                user_retailers_wishlist[wish.retailer.id] = True
-        context["user_retailers_wishlist"] = user_retailers_wishlist
+        context["user_retailers_wishlist"] = UserContext.for_request(
+            self.request
+        ).retailer_wishlist
 
         return context
 
@@ -164,26 +168,17 @@ class RetailerDetailsView(ListView):
 
         retailer = Retailer.objects.filter(qfilter).last()
 
+        user_context = UserContext.for_request(self.request)
+
         products = list(
-            Product.objects.filter(
-                inventory__location__retailer=retailer,
+            ProductCard.objects.filter(
+                retailer=retailer,
                 is_active=True,
-            ).order_by("name")
+            )
+            .exclude(product_id__in=user_context.reserved_product_ids)
+            .order_by("name")
         )
 
-        if self.request.user.is_authenticated:
-            upcoming_reservations = Reservation.objects.filter(
-                user=self.request.user,
-                time_limit__gte=datetime.datetime.now(),
-                status="RESERVED",
-            ).order_by("-time_limit")
-
-            if len(upcoming_reservations) > 0:
-                for res in upcoming_reservations:
-                    for product in products:
-                        if res.variant.product.id == product.id:
-                            products.remove(product)
-
         paginator = Paginator(products, 9)
 
         page_number = self.request.GET.get("page")
@@ -199,19 +194,8 @@ class RetailerDetailsView(ListView):
         origin = self.request.GET.get("origin", previous_url)
         context["origin"] = origin
 
-        in_wishlist = self.request.user.is_authenticated and RetailerWishlist.objects.filter(
-            user=self.request.user,
-            retailer=retailer
-        ).exists()
-        context["in_wishlist"] = in_wishlist
-
-        user_product_wishlist = {}
-        if self.request.user.is_authenticated:
-            wishlist = ProductWishlist.objects.filter(user=self.request.user, product__in=products).all()
-            for wish in wishlist:
-                user_product_wishlist[wish.product.id] = True
-
-        context["user_products_wishlist"] = user_product_wishlist
+        context["in_wishlist"] = retailer is not None and retailer.id in user_context.retailer_wishlist
+        context["user_products_wishlist"] = user_context.product_wishlist
         return context
 
 
@@ -405,65 +389,23 @@ class ProductDetailsPageView(TemplateView):
             .last()
         )
 
-        lowest_variant_price_subquery = (
-            Variant.objects.filter(upc=OuterRef("variants__upc"))
-            .values("upc")
-            .annotate(lowest_variant_price=Min("price"))
-            .values("lowest_variant_price")[:1]
-        )
+        user_context = UserContext.for_request(request)
+        excluded_ids = {product.id}
+        if not request.user.is_staff:
+            excluded_ids |= user_context.reserved_product_ids
 
-        products_with_ordered_variants = (
-            Product.objects.annotate(
-                variant_count=Count("variants"),
-                lowest_variant_price=Subquery(
-                    lowest_variant_price_subquery, output_field=DecimalField()
-                ),
-            )
-            .filter(
-                Q(variants__price=F("lowest_variant_price"))
-                | Q(variants__upc__isnull=True)
-                | Q(variants__upc=""),
-                variant_count=1,
-            )
-            .order_by("lowest_variant_price")
-            .exclude(id=product.id)
+        related_items = list(
+            ProductCard.objects.filter(is_related_item=True, is_active=True)
+            .exclude(product_id__in=excluded_ids)
+            .order_by("product_id")[:16]
         )
 
-        products_with_empty_upc_variants = (
-            Product.objects.filter(
-                Q(variants__upc__isnull=True) | Q(variants__upc=""),
-            )
-            .annotate(variant_count=Count("variants"))
-            .exclude(id=product.id)
+        product_variants = (
+            Variant.objects.filter(product=product, price__gt=0)
+            .prefetch_related("variantimage_set")
+            .order_by("price")
         )
-
-        products = products_with_ordered_variants | products_with_empty_upc_variants
-
-        p_id = 0
-
-        for product_related in products.order_by("id"):
-            if p_id != product_related.id and product_related.is_active:
-                related_items.append(product_related)
-
-            p_id = product_related.id
-
-        if request.user.is_authenticated and not request.user.is_staff:
-            upcoming_reservations = Reservation.objects.filter(
-                user=request.user,
-                time_limit__gte=datetime.datetime.now(),
-                status="RESERVED",
-            ).order_by("-time_limit")
-        else:
-            upcoming_reservations = []
-
-        for res in upcoming_reservations:
-            for item in related_items:
-                if res.variant.product.id == item.id:
-                    related_items.remove(item)
-
-        product_variants = Variant.objects.filter(
-            product=product, price__gt=0
-        ).order_by("price")
+        AvailableStock.attach_to_variants(product_variants)
 
         variant_images = [
             {
@@ -472,27 +414,30 @@ class ProductDetailsPageView(TemplateView):
             }
             for variant in product_variants
         ]
-        if product.variants.first().upc and not product.variants.first().sku:
-            upc = product.variants.first().upc
-        elif product.variants.first().sku and not product.variants.first().upc:
-            upc = product.variants.first().sku
-        elif product.variants.first().sku and product.variants.first().upc:
-            upc = product.variants.first().upc
+        first_variant = product.variants.first()
+        if first_variant.upc and not first_variant.sku:
+            upc = first_variant.upc
+        elif first_variant.sku and not first_variant.upc:
+            upc = first_variant.sku
+        elif first_variant.sku and first_variant.upc:
+            upc = first_variant.upc
         else:
             upc = None
 
         if upc:
-            other_retailers = (
-                Product.objects.filter(
-                    Q(variants__upc=upc) | Q(variants__sku=upc),
-                    is_active=True,
-                    variants__price__gt=0,
-                )
-                .exclude(
-                    inventory__location__retailer=product.inventory.location.retailer
-                )
-                .order_by("variants__price", "-total_stock")[:8]
+            offers = UpcIndexRepository().get_offers(
+                upc, exclude_retailer_id=product.inventory.location.retailer_id
             )
+            reserved = AvailableStock.reserved_by_variant(
+                offer.variant_id for offer in offers
+            )
+            cards = ProductCard.objects.in_bulk([offer.product_id for offer in offers])
+            for offer in offers:
+                card = cards.get(offer.product_id)
+                if card is None:
+                    continue
+                card.available_stock = offer.stock - reserved.get(offer.variant_id, 0)
+                other_retailers.append(card)
 
         previous_url = request.META.get("HTTP_REFERER", None)
 
@@ -501,11 +446,6 @@ class ProductDetailsPageView(TemplateView):
         if previous_url and "retailers" in previous_url:
             origin = reverse("retailers")
 
-        user_products_wishlist = {}
-        if self.request.user.is_authenticated:
-            wishlist = ProductWishlist.objects.filter(user=self.request.user).all()
-            for wish in wishlist:
-                user_products_wishlist[wish.product.id] = True
 
         return render(
             request,
@@ -518,7 +458,7 @@ class ProductDetailsPageView(TemplateView):
                 "variants_json": json.dumps(variant_images),
                 "previous_url": previous_url,
                 "origin": origin,
-                "user_products_wishlist": user_products_wishlist,
+                "user_products_wishlist": user_context.product_wishlist,
             },
         )
 
@@ -565,6 +505,7 @@ class MakeReservationView(TemplateView):
         reservation.save()
         reservation.reservation_code = "#{:06d}".format(reservation.id)
         reservation.save()
+        ProductCardRepository().refresh_for_variants([variation.id])
 
         messages.success(
             request,
@@ -709,9 +650,12 @@ class ReservationDetailsView(TemplateView):
             id=reservation_id, user=request.user
         ).last()
 
-        product_variants = Variant.objects.filter(
-            product=reservation.variant.product,
-        ).order_by("price")
+        product_variants = (
+            Variant.objects.filter(product=reservation.variant.product)
+            .prefetch_related("variantimage_set")
+            .order_by("price")
+        )
+        AvailableStock.attach_to_variants(list(product_variants) + [reservation.variant])
 
         variant_images = [
             {
@@ -722,25 +666,14 @@ class ReservationDetailsView(TemplateView):
         ]
 
         related_items = list(
-            Product.objects.filter(
-                inventory__location__retailer=reservation.variant.product.inventory.location.retailer,
+            ProductCard.objects.filter(
+                retailer=reservation.variant.product.inventory.location.retailer,
                 is_active=True,
-            ).exclude(id=reservation.variant.product.id)
+            ).exclude(
+                product_id__in={reservation.variant.product_id}
+                | UserContext.for_request(request).reserved_product_ids
+            )
         )
-
-        if request.user.is_authenticated:
-            upcoming_reservations = Reservation.objects.filter(
-                user=request.user,
-                time_limit__gte=datetime.datetime.now(),
-                status="RESERVED",
-            ).order_by("-time_limit")
-        else:
-            upcoming_reservations = []
-
-        for res in upcoming_reservations:
-            for product in related_items:
-                if res.variant.product.id == product.id:
-                    related_items.remove(product)
         return render(
             request,
             template_name,
@@ -787,6 +720,7 @@ class UpdateReservationView(TemplateView):
         reservation.quantity = quantity
         reservation.total = total
         reservation.save()
+        ProductCardRepository().refresh_for_variants([reservation.variant_id])
 
         messages.success(
             request,
@@ -876,7 +810,9 @@ class CancelReservationView(TemplateView):
 
         reservation_id = self.kwargs.get("reservation_id")
 
-        reservation = Reservation.objects.filter(id=reservation_id).last().delete()
+        reservation = Reservation.objects.filter(id=reservation_id).last()
+        reservation.delete()
+        ProductCardRepository().refresh_for_variants([reservation.variant_id])
 
         messages.success(
             request,
@@ -952,11 +888,15 @@ class ReservationsListView(TemplateView):
 
         template_name = "reservations_list.html"
 
-        upcoming_reservations = Reservation.objects.filter(
-            user=request.user,
-            time_limit__gte=datetime.datetime.now(),
-            status="RESERVED",
-        ).order_by("-time_limit")
+        upcoming_reservations = AvailableStock.attach_to_reservations(
+            Reservation.objects.filter(
+                user=request.user,
+                time_limit__gte=datetime.datetime.now(),
+                status="RESERVED",
+            )
+            .select_related("variant__product__inventory__location__retailer")
+            .order_by("-time_limit")
+        )
 
         return render(
             request,
@@ -972,25 +912,17 @@ class ProductListSearchView(TemplateView):
         template_name = "search-products.html"
         search = request.GET.get("search", "").strip()
 
-        products = Product.objects.filter(name__icontains=search).prefetch_related(
-            "variants",
-            "variants__variantimage_set",
-            "wishlist",
-        ).all()
-
-        user_wishlist = {}
-        if request.user.is_authenticated:
-            wishlist = ProductWishlist.objects.filter(user=request.user, product__in=products).all()
-            for wish in wishlist:
-                user_wishlist[wish.product.id] = True
+        paginator = Paginator(ProductCardRepository().search(search), 24)
+        page_obj = paginator.get_page(request.GET.get("page"))
 
         return render(
             request,
             template_name,
             {
-                "products": products,
+                "products": page_obj,
+                "page_obj": page_obj,
                 "search": search,
-                "user_products_wishlist": user_wishlist
+                "user_products_wishlist": UserContext.for_request(request).product_wishlist,
             },
         )
 
@@ -1002,7 +934,7 @@ class WishlistView(TemplateView):
 
         template_name = "wishlist.html"
 
-        product_wishlist = Product.objects.filter(wishlist__user=request.user).all()
+        product_wishlist = ProductCard.objects.filter(product__wishlist__user=request.user).all()
         retailer_wishlist = Retailer.objects.filter(wishlist__user=request.user).all()
 
         return render(
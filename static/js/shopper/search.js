@@ -0,0 +1,11 @@
+window.addEventListener("load", function () {
+  if (!document.querySelector(".infinite-more-link")) {
+    return;
+  }
+
+  new Waypoint.Infinite({
+    element: $(".infinite-container")[0],
+    offset: "bottom-in-view",
+    loadingClass: "infinite-loading",
+  });
+});
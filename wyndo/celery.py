@@ -20,6 +20,11 @@ app.conf.beat_schedule = {
         "task": "inventories.tasks.load_clover_inventory",
         "schedule": crontab(minute="5", hour="8,13,15"),
     },
+    "reconcile-clover-inventory": {
+        "task": "inventories.tasks.load_clover_inventory",
+        "schedule": crontab(minute="45", hour="3", day_of_week="sun"),
+        "kwargs": {"full_sync": True},
+    },
     "load-clover-customer": {
         "task": "inventories.tasks.fetch_clover_customer",
         "schedule": crontab(minute="10", hour="8,13,15"),
@@ -36,6 +41,11 @@ app.conf.beat_schedule = {
         "task": "inventories.tasks.load_square_inventory",
         "schedule": crontab(minute="30", hour="8,13,15"),
     },
+    "reconcile-square-inventory": {
+        "task": "inventories.tasks.load_square_inventory",
+        "schedule": crontab(minute="15", hour="4", day_of_week="sun"),
+        "kwargs": {"full_sync": True},
+    },
     "load-square-customer": {
         "task": "inventories.tasks.fetch_square_customer",
         "schedule": crontab(minute="35", hour="8,13,15"),
@@ -244,6 +244,25 @@ CELERY_RESULT_BACKEND = REDIS_URL
 CELERY_ACCEPT_CONTENT = ["application/json"]
 CELERY_TASK_SERIALIZER = "json"
 CELERY_RESULT_SERIALIZER = "json"
+# Number of retailers synced in parallel by the scheduled tasks
+SYNC_CONCURRENCY = int(getenv("SYNC_CONCURRENCY", 4))
+# Seconds the home page sections are cached for while the catalog is unchanged
+CATALOG_CACHE_TIMEOUT = int(getenv("CATALOG_CACHE_TIMEOUT", 60 * 10))
+# Queue of the POS webhook consumer, served by its own worker
+WEBHOOK_QUEUE = getenv("WEBHOOK_QUEUE", "webhooks")
+# Seconds webhook events wait for the rest of their burst before being processed,
+# per event family. Overridden with a JSON object, e.g. {"catalog": 10}
+WEBHOOK_COALESCE_WINDOWS = {
+    "catalog": 5,
+    "inventory": 2,
+    "order": 3,
+    "customer": 2,
+    "location": 2,
+    **json.loads(getenv("WEBHOOK_COALESCE_WINDOWS", "{}")),
+}
+CELERY_TASK_ROUTES = {
+    "inventories.tasks.process_webhook_events": {"queue": WEBHOOK_QUEUE},
+}
 CELERY_TIMEZONE = getenv("CELERY_TIMEZONE")
 CELERY_BROKER_CONNECTION_RETRY_ON_STARTUP = getenv(
     "CELERY_BROKER_CONNECTION_RETRY_ON_STARTUP"
@@ -261,6 +280,12 @@ CLOVER_OAUTH_PATH = "/oauth/v2/authorize"
 CLOVER_MERCHANT_INFO_PATH = "/v3/merchants/{mId}"
 CLOVER_TOKEN_PATH = "/oauth/v2/token"
 CLOVER_LOCATION_PATH = "/v3/merchants/{mId}/address"
+CLOVER_HTTP_POOL_SIZE = int(getenv("CLOVER_HTTP_POOL_SIZE", 10))
+CLOVER_HTTP_TIMEOUT = float(getenv("CLOVER_HTTP_TIMEOUT", 30))
+CLOVER_HTTP_MAX_RETRIES = int(getenv("CLOVER_HTTP_MAX_RETRIES", 5))
+CLOVER_HTTP_BACKOFF_FACTOR = float(getenv("CLOVER_HTTP_BACKOFF_FACTOR", 0.5))
+CLOVER_RATE_LIMIT = float(getenv("CLOVER_RATE_LIMIT", 16))
+CLOVER_ITEM_GROUP_CACHE_TTL = int(getenv("CLOVER_ITEM_GROUP_CACHE_TTL", 60 * 60 * 6))
 
 # Square Settings
 SQUARE_API_KEY = getenv("SQUARE_API_KEY")
@@ -269,6 +294,13 @@ SQUARE_URL = getenv("SQUARE_URL")
 SQUARE_OAUTH_PATH = "/oauth2/authorize"
 SQUARE_ENVIRONMENT = getenv("SQUARE_ENVIRONMENT")
 SQUARE_WEBHOOK_SIGNATURE_KEY = getenv("SQUARE_WEBHOOK_SIGNATURE_KEY")
+SQUARE_RATE_LIMIT = float(getenv("SQUARE_RATE_LIMIT", 10))
+
+# Go UPC Settings
+# Lookups made in parallel while enriching a retailer's variants
+GO_UPC_CONCURRENCY = int(getenv("GO_UPC_CONCURRENCY", 4))
+# Days before a code Go UPC didn't know is looked up again
+GO_UPC_MISS_RETRY_DAYS = int(getenv("GO_UPC_MISS_RETRY_DAYS", 30))
 
 # CKEditor Settings
 CKEDITOR_CONFIGS = {